@@ -0,0 +1,350 @@
+##############################################################################
+#
+#  benchmark_helper_scripts.py
+#
+#  Times and memory-profiles the helper scripts on the synthetic study made
+#  by generate_synthetic_data.py, and flags regressions against stored
+#  baseline results.  Every script runs in its own Python process: one set
+#  of runs measures wall time per stage, a separate run measures peak
+#  memory per stage with tracemalloc (which slows the code it traces).
+#
+################################################################################
+
+import sys
+import os
+import getopt
+import json
+import time
+import datetime as dt
+import platform
+import statistics
+import subprocess
+import tempfile
+import threading
+import tracemalloc
+import contextlib
+import importlib.util
+import generate_synthetic_data
+
+# Scripts that are benchmarked and the functions timed as their stages.  Stages are "<object>.<function>" where the
+# object is the script module itself ("script"), db_access, csv_reader, pd (pandas) or pd.DataFrame.
+BENCHMARKS = {"participants" : {"script" : "create_rapids_participant_file.py",
+                                "stages" : ["script.plan_device_read", "db_access.read_query", "script.stream_device_participants", "pd.DataFrame.groupby",
+                                            "pd.DataFrame.drop_duplicates"]},
+              "timezones" : {"script" : "create_multiple_timezones.py",
+                             "stages" : ["script.plan_device_read", "pd.read_sql_table", "pd.read_csv", "script.explode_device_ids", "script.read_device_timestamps",
+                                         "script.first_device_timestamps", "pd.merge",
+                                         "script.tzcodes_from_survey", "script.all_device_ids_in", "script.collapse_tz_transitions", "pd.DataFrame.to_csv"]},
+              "compare" : {"script" : "compare_data_directories.py",
+                           "stages" : ["script.find_csv_files", "script.compare_file_group", "script.pair_strategy", "csv_reader.read_csv", "script.streaming_diff_many", "script.keyed_diff"]},
+              "upload" : {"script" : "rapids_csv_to_mysql.py",
+                          "stages" : ["script.scan_sensor_schema", "script.upload_sensor", "script.read_participant_features", "script.stream_participant", "csv_reader.read_csv", "script.create_sensor_table",
+                                      "db_access.bulk_insert"]}}
+# A script or stage is flagged when it takes this many times its baseline time or memory
+DEFAULT_TIME_THRESHOLD = 1.25
+DEFAULT_MEMORY_THRESHOLD = 1.25
+# Stages faster than this in the baseline are too noisy to be flagged
+MIN_STAGE_SECONDS = 0.05
+MIN_STAGE_MB = 1.0
+
+
+def script_arguments(name, data_dir, metadata, work_dir):
+    # Command line of each benchmarked script for the synthetic study in data_dir, outputs go to work_dir
+    db_url = "sqlite:///" + os.path.abspath(os.path.join(data_dir, metadata["database"]))
+    if (name == "participants"):
+        return ["--database", "main", "--source_table", metadata["device_table"], "--destination_file", os.path.join(work_dir, "participant_file.csv"),
+                "--db_url", db_url]
+    if (name == "timezones"):
+        return ["--database", "main", "--device_source_table", metadata["device_table"], "--survey_source_table", metadata["survey_table"],
+                "--survey_col_name", metadata["survey_col_name"], "--participant_input", os.path.join(data_dir, metadata["participant_file"]),
+                "--participant_output", os.path.join(work_dir, "participant_file_modified.csv"), "--destination_file", os.path.join(work_dir, "multiple_timezones.csv"),
+                "--db_url", db_url]
+    if (name == "compare"):
+        return ["--dir1", os.path.join(data_dir, metadata["rapids_baseline"]), "--dir2", os.path.join(data_dir, metadata["rapids_candidate"])]
+    return ["-d", "main", "-t", "benchmark", "-g", "daily", "--csv", os.path.join(data_dir, metadata["rapids_baseline"], "processed"),
+            "--db-url", "sqlite:///" + os.path.join(work_dir, "upload.db")]
+
+
+class StageRecorder:
+    # Accumulates calls, wall time and (with tracemalloc running) the peak memory above the start of every stage.
+    # Nested stages each get their own peak: the tracemalloc peak is reset when a stage starts and folded into the
+    # stages around it when it ends.
+
+    def __init__(self, trace_memory):
+        self.trace_memory = trace_memory
+        self.lock = threading.RLock()
+        self.stack = []
+        self.stages = {}
+
+    def enter(self, name):
+        with self.lock:
+            frame = {"name" : name, "start" : time.perf_counter(), "memory_start" : 0, "memory_peak" : 0}
+            if (self.trace_memory):
+                current, peak = tracemalloc.get_traced_memory()
+                for outer in self.stack:
+                    outer["memory_peak"] = max(outer["memory_peak"], peak)
+                tracemalloc.reset_peak()
+                frame["memory_start"] = frame["memory_peak"] = current
+            self.stack.append(frame)
+            return frame
+
+    def exit(self, frame):
+        with self.lock:
+            seconds = time.perf_counter() - frame["start"]
+            if (self.trace_memory):
+                frame["memory_peak"] = max(frame["memory_peak"], tracemalloc.get_traced_memory()[1])
+            self.stack.remove(frame)
+            for outer in self.stack:
+                outer["memory_peak"] = max(outer["memory_peak"], frame["memory_peak"])
+            stats = self.stages.setdefault(frame["name"], {"calls" : 0, "seconds" : 0.0, "peak_mb" : 0.0})
+            stats["calls"] += 1
+            stats["seconds"] += seconds
+            stats["peak_mb"] = max(stats["peak_mb"], (frame["memory_peak"] - frame["memory_start"]) / (1024 * 1024))
+
+    def wrap(self, name, function):
+        def timed(*args, **kwargs):
+            frame = self.enter(name)
+            try:
+                return function(*args, **kwargs)
+            finally:
+                self.exit(frame)
+        return timed
+
+
+def run_script(name, script_args, trace_memory):
+    # Run one benchmarked script in this process with its stages wrapped, returns the stage statistics
+    script_file = os.path.join(os.path.dirname(os.path.abspath(__file__)), BENCHMARKS[name]["script"])
+    spec = importlib.util.spec_from_file_location(name, script_file)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+
+    recorder = StageRecorder(trace_memory)
+    owners = {"script" : module, "db_access" : sys.modules.get("db_access"), "csv_reader" : sys.modules.get("csv_reader"), "pd" : module.pd, "pd.DataFrame" : module.pd.DataFrame}
+    for stage in BENCHMARKS[name]["stages"]:
+        owner_name, function_name = stage.rsplit(".", 1)
+        owner = owners[owner_name]
+        if (owner is not None and hasattr(owner, function_name)):
+            setattr(owner, function_name, recorder.wrap(stage, getattr(owner, function_name)))
+
+    sys.argv = [script_file] + script_args
+    if (trace_memory):
+        tracemalloc.start()
+    frame = recorder.enter("total")
+    exit_code = 0
+    try:
+        with open(os.devnull, "w") as devnull, contextlib.redirect_stdout(devnull):
+            module.main()
+    except SystemExit as err:
+        exit_code = err.code if isinstance(err.code, int) else 1
+    finally:
+        recorder.exit(frame)
+    if (trace_memory):
+        tracemalloc.stop()
+    return {"exit_code" : exit_code, "stages" : recorder.stages}
+
+
+def run_worker(name, data_dir, trace_memory):
+    # Benchmark process started by run_benchmark: runs one script and prints its statistics as JSON
+    with open(os.path.join(data_dir, generate_synthetic_data.METADATA_FILE)) as metadata_in:
+        metadata = json.load(metadata_in)
+    with tempfile.TemporaryDirectory() as work_dir:
+        result = run_script(name, script_arguments(name, data_dir, metadata, work_dir), trace_memory)
+    try:
+        import resource
+        result["peak_rss_mb"] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+    except ImportError:
+        result["peak_rss_mb"] = None
+    print(json.dumps(result))
+
+
+def run_benchmark(name, data_dir, repeat, trace_memory):
+    # Time the script repeat times (median per stage) and measure its memory in one more traced run
+    def worker(trace):
+        command = [sys.executable, os.path.abspath(__file__), "--worker", name, "--data_dir", data_dir] + (["--trace_memory"] if trace else [])
+        completed = subprocess.run(command, capture_output=True, text=True, cwd=os.path.dirname(os.path.abspath(__file__)))
+        if (completed.returncode != 0):
+            raise RuntimeError(name + " benchmark failed:\n" + completed.stderr)
+        return json.loads(completed.stdout.strip().splitlines()[-1])
+
+    runs = [worker(False) for i in range(repeat)]
+    result = {"script" : BENCHMARKS[name]["script"],
+              "exit_code" : max(run["exit_code"] for run in runs),
+              "wall_seconds" : statistics.median(run["stages"]["total"]["seconds"] for run in runs),
+              "peak_rss_mb" : runs[0]["peak_rss_mb"],
+              "stages" : {}}
+    for stage in runs[0]["stages"]:
+        result["stages"][stage] = {"calls" : runs[0]["stages"][stage]["calls"],
+                                   "seconds" : statistics.median(run["stages"].get(stage, {"seconds" : 0.0})["seconds"] for run in runs)}
+    if (trace_memory):
+        traced = worker(True)
+        result["peak_traced_mb"] = traced["stages"]["total"]["peak_mb"]
+        for stage, stats in traced["stages"].items():
+            result["stages"].setdefault(stage, {"calls" : stats["calls"], "seconds" : 0.0})["peak_mb"] = stats["peak_mb"]
+    return result
+
+
+def find_regressions(results, baseline, time_threshold, memory_threshold):
+    # Compare every script and stage with the baseline, returns a list of messages for the ones over a threshold
+    regressions = []
+    for name, result in results["scripts"].items():
+        if (name not in baseline["scripts"]):
+            continue
+        base = baseline["scripts"][name]
+        checks = [(name, "time", result["wall_seconds"], base["wall_seconds"], time_threshold, 0.0)]
+        if ("peak_traced_mb" in result and "peak_traced_mb" in base):
+            checks.append((name, "memory", result["peak_traced_mb"], base["peak_traced_mb"], memory_threshold, 0.0))
+        for stage, stats in result["stages"].items():
+            if (stage == "total" or stage not in base["stages"]):
+                continue
+            base_stats = base["stages"][stage]
+            checks.append((name + " " + stage, "time", stats["seconds"], base_stats["seconds"], time_threshold, MIN_STAGE_SECONDS))
+            if ("peak_mb" in stats and "peak_mb" in base_stats):
+                checks.append((name + " " + stage, "memory", stats["peak_mb"], base_stats["peak_mb"], memory_threshold, MIN_STAGE_MB))
+        for label, kind, value, base_value, threshold, minimum in checks:
+            if (base_value >= minimum and base_value > 0 and value > base_value * threshold):
+                unit = "s" if kind == "time" else " MB"
+                regressions.append(label + ": " + kind + " " + format(value, ".3f") + unit + " vs baseline " + format(base_value, ".3f") + unit
+                                   + " (" + format(value / base_value, ".2f") + "x)")
+    return regressions
+
+
+def print_results(results):
+    print("Scale " + results["scale"] + " (" + str(results["rows"]) + " rows):")
+    for name, result in results["scripts"].items():
+        print("  " + name + ": " + format(result["wall_seconds"], ".3f") + "s"
+              + ("" if "peak_traced_mb" not in result else ", peak traced memory " + format(result["peak_traced_mb"], ".1f") + " MB")
+              + ("" if result["peak_rss_mb"] is None else ", peak RSS " + format(result["peak_rss_mb"], ".1f") + " MB")
+              + ("" if result["exit_code"] == 0 else ", exit code " + str(result["exit_code"])))
+        for stage, stats in result["stages"].items():
+            if (stage != "total"):
+                print("      " + format(stats["seconds"], "8.3f") + "s " + format(stats["calls"], "6d") + "x"
+                      + ("" if "peak_mb" not in stats else " " + format(stats["peak_mb"], "9.1f") + " MB") + "  " + stage)
+
+
+def usage():
+    print("python benchmark_helper_scripts.py [--data_dir <synthetic data folder>] [--scale <1k|100k|10m|number of rows>] [--seed <integer>] [--generate]")
+    print("                                   [--scripts <participants,timezones,compare,upload>] [--repeat <runs>] [--no_memory]")
+    print("                                   [--results_file <JSON file>] [--baseline <JSON file>] [--save_baseline]")
+    print("                                   [--time_threshold <ratio>] [--memory_threshold <ratio>]")
+
+
+def main():
+
+    try:
+        optlist, args = getopt.getopt(sys.argv[1:], "", ["data_dir=", "scale=", "seed=", "generate", "scripts=", "repeat=", "no_memory", "results_file=", "baseline=",
+                                                         "save_baseline", "time_threshold=", "memory_threshold=", "worker=", "trace_memory"])
+    except getopt.GetoptError as err:
+        print(err)
+        usage()
+        sys.exit(2)
+
+    options = {}
+    options["data_dir"] = None
+    options["scale"] = "1k"
+    options["seed"] = 0
+    options["generate"] = False
+    options["scripts"] = list(BENCHMARKS.keys())
+    options["repeat"] = 3
+    options["memory"] = True
+    options["results_file"] = "../../data/synthetic/benchmark_results.json"
+    options["baseline"] = "../../data/synthetic/benchmark_baseline.json"
+    options["save_baseline"] = False
+    options["time_threshold"] = DEFAULT_TIME_THRESHOLD
+    options["memory_threshold"] = DEFAULT_MEMORY_THRESHOLD
+    options["worker"] = None
+    options["trace_memory"] = False
+
+    for option_tuple in optlist:
+        if (option_tuple[0] == "--data_dir"):
+            options["data_dir"] = option_tuple[1]
+        elif (option_tuple[0] == "--scale"):
+            options["scale"] = option_tuple[1]
+        elif (option_tuple[0] == "--seed"):
+            options["seed"] = int(option_tuple[1])
+        elif (option_tuple[0] == "--generate"):
+            options["generate"] = True
+        elif (option_tuple[0] == "--scripts"):
+            options["scripts"] = option_tuple[1].split(",")
+        elif (option_tuple[0] == "--repeat"):
+            options["repeat"] = max(1, int(option_tuple[1]))
+        elif (option_tuple[0] == "--no_memory"):
+            options["memory"] = False
+        elif (option_tuple[0] == "--results_file"):
+            options["results_file"] = option_tuple[1]
+        elif (option_tuple[0] == "--baseline"):
+            options["baseline"] = option_tuple[1]
+        elif (option_tuple[0] == "--save_baseline"):
+            options["save_baseline"] = True
+        elif (option_tuple[0] == "--time_threshold"):
+            options["time_threshold"] = float(option_tuple[1])
+        elif (option_tuple[0] == "--memory_threshold"):
+            options["memory_threshold"] = float(option_tuple[1])
+        elif (option_tuple[0] == "--worker"):
+            options["worker"] = option_tuple[1]
+        elif (option_tuple[0] == "--trace_memory"):
+            options["trace_memory"] = True
+
+    if (options["data_dir"] is None):
+        options["data_dir"] = os.path.join("../../data/synthetic", str(options["scale"]).lower())
+    options["data_dir"] = os.path.abspath(options["data_dir"])
+    if (options["worker"] is not None):
+        run_worker(options["worker"], options["data_dir"], options["trace_memory"])
+        return
+    for name in options["scripts"]:
+        if (name not in BENCHMARKS):
+            print("Unknown script " + name + ", choose from " + ",".join(BENCHMARKS.keys()))
+            exit(2)
+
+    # The synthetic study is generated when asked to or when it does not exist yet
+    metadata_file = os.path.join(options["data_dir"], generate_synthetic_data.METADATA_FILE)
+    if (options["generate"] or not os.path.exists(metadata_file)):
+        print("Generating synthetic data in " + options["data_dir"] + "...")
+        generate_synthetic_data.generate(options["data_dir"], options["scale"], options["seed"])
+    with open(metadata_file) as metadata_in:
+        metadata = json.load(metadata_in)
+
+    import pandas as pd
+    import numpy as np
+    import sqlalchemy
+    results = {"scale" : metadata["scale"], "rows" : metadata["rows"], "seed" : metadata["seed"], "created" : dt.datetime.now().isoformat(timespec="seconds"),
+               "python" : platform.python_version(), "pandas" : pd.__version__, "numpy" : np.__version__, "sqlalchemy" : sqlalchemy.__version__,
+               "machine" : platform.machine(), "scripts" : {}}
+    for name in options["scripts"]:
+        print("Benchmarking " + BENCHMARKS[name]["script"] + "...")
+        results["scripts"][name] = run_benchmark(name, options["data_dir"], options["repeat"], options["memory"])
+    print_results(results)
+
+    # Results and baselines are kept per scale, so one file holds the results of every scale
+    all_results = {}
+    if (os.path.exists(options["results_file"])):
+        with open(options["results_file"]) as results_in:
+            all_results = json.load(results_in)
+    all_results[results["scale"]] = results
+    os.makedirs(os.path.dirname(os.path.abspath(options["results_file"])), exist_ok=True)
+    with open(options["results_file"], "w") as results_out:
+        json.dump(all_results, results_out, indent=1)
+    print("Wrote results to " + options["results_file"])
+
+    baselines = {}
+    if (os.path.exists(options["baseline"])):
+        with open(options["baseline"]) as baseline_in:
+            baselines = json.load(baseline_in)
+    if (options["save_baseline"]):
+        baselines[results["scale"]] = results
+        with open(options["baseline"], "w") as baseline_out:
+            json.dump(baselines, baseline_out, indent=1)
+        print("Saved the results as the " + results["scale"] + " baseline in " + options["baseline"])
+    elif (results["scale"] in baselines):
+        regressions = find_regressions(results, baselines[results["scale"]], options["time_threshold"], options["memory_threshold"])
+        if (len(regressions) > 0):
+            print("REGRESSIONS against the " + results["scale"] + " baseline from " + baselines[results["scale"]]["created"] + ":")
+            for regression in regressions:
+                print("  " + regression)
+            exit(1)
+        print("No regressions against the " + results["scale"] + " baseline from " + baselines[results["scale"]]["created"] + ".")
+    else:
+        print("No " + results["scale"] + " baseline in " + options["baseline"] + ", run with --save_baseline to store one.")
+
+
+if __name__ == "__main__":
+    main()
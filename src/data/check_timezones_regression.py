@@ -0,0 +1,168 @@
+##############################################################################
+#
+#  check_timezones_regression.py
+#
+#  Regression check of create_multiple_timezones.py against the row-by-row
+#  implementation it replaced.  A synthetic study made by
+#  generate_synthetic_data.py (participants with one to three devices,
+#  missing and repeated survey answers) gets one extra participant whose
+#  device_id is a substring of another participant's device_id and who has
+#  no survey answer.  The script is run with tz_default remove, ignore and a
+#  custom tzcode, and its TZCODES and participant files are compared with
+#  the ones the old implementation (legacy_timezones below) writes.  The
+#  only expected difference is the substring participant: the old
+#  str.contains() check kept it by mistake, the exact id match removes it.
+#
+################################################################################
+
+import sys
+import os
+import getopt
+import sqlite3
+import subprocess
+import tempfile
+import numpy as np
+import pandas as pd
+import generate_synthetic_data
+
+# tz_default values checked
+TZ_DEFAULTS = ["remove", "ignore", "America/Chicago"]
+# Label of the participant added to the synthetic study, its device_id is a prefix of another participant's device_id
+SUBSTRING_LABEL = "PSUBSTR"
+
+
+def usage():
+    print("python check_timezones_regression.py [--scale <1k|100k|number of aware_device rows>] [--seed <integer>] [--keep_dir <folder to keep the fixture and outputs in>]")
+
+
+# The TZCODES rows and modified participant rows of the implementation before the device_id explosion and the
+# missing time zone filter were vectorized, with DataFrame.append replaced by pd.concat (append no longer exists)
+def legacy_timezones(participant_df, survey_df, device_df, survey_col_name, tz_default):
+    joined_nostamp_df = pd.merge(participant_df, survey_df, left_on="label", right_on=survey_col_name, how='left')
+    to_add = []
+    for index, row in joined_nostamp_df.iterrows():
+        id_list = row["device_id"].split(';')
+        if len(id_list) > 1:
+            for id in id_list:
+                to_add.append(dict(row, device_id=id))
+    joined_nostamp_df = pd.concat([joined_nostamp_df, pd.DataFrame(to_add, columns=joined_nostamp_df.columns)])
+    joined_df = pd.merge(joined_nostamp_df, device_df, how='left', on='device_id')
+    joined_df['time_zone'] = joined_df['time_zone'].astype(str)
+    joined_df['tzcode'] = 'TBD'
+    for code, tzcode in [('1', 'America/Puerto_Rico'), ('2', 'America/New_York'), ('3', 'America/Chicago'), ('4', 'America/Denver'),
+                         ('5', 'America/Los_Angeles'), ('6', 'America/Anchorage'), ('7', 'Pacific/Honolulu')]:
+        joined_df['tzcode'] = np.where(joined_df['time_zone'].str.startswith(code), tzcode, joined_df['tzcode'])
+
+    modified_participant_df = None
+    if tz_default == "remove":
+        ids_with_tz = pd.merge(participant_df, survey_df, left_on="label", right_on=survey_col_name)
+        def drop_count(device_ids):
+            return sum(1 for id in device_ids.split(';') if ids_with_tz['device_id'].str.contains(id).any() == False)
+        modified_participant_df = participant_df[participant_df['device_id'].map(drop_count) == 0]
+        joined_df = joined_df[joined_df['device_id'].map(drop_count) == 0].drop_duplicates(['device_id'], keep='first')
+    elif tz_default == "ignore":
+        joined_df = joined_df[joined_df.tzcode != 'TBD'].drop_duplicates(['device_id'], keep='first')
+    else:
+        joined_df['tzcode'] = np.where(joined_df['tzcode'].str.startswith('TBD'), tz_default, joined_df['tzcode'])
+        joined_df = joined_df.drop_duplicates(['device_id'], keep='first')
+    joined_df = joined_df.dropna(subset=['timestamp'])
+    return joined_df[['device_id', 'tzcode', 'timestamp']], modified_participant_df
+
+
+# Create the fixture in work_dir: the synthetic study plus the substring participant.  Returns the database file, the
+# participant file and the substring participant's device_id.
+def create_fixture(work_dir, scale, seed):
+    db_file = os.path.join(work_dir, "study.db")
+    participant_file = os.path.join(work_dir, "participant_file.csv")
+    for name in [db_file, participant_file]:
+        if (os.path.exists(name)):
+            os.remove(name)
+    generate_synthetic_data.generate_database(db_file, participant_file, generate_synthetic_data.scale_rows(scale), seed)
+
+    connection = sqlite3.connect(db_file)
+    surveyed = pd.read_sql("SELECT eid FROM tz_survey", connection)["eid"]
+    participants = pd.read_csv(participant_file)
+    surveyed_ids = participants.loc[participants["label"].isin(surveyed), "device_id"].str.split(";").explode()
+    substring_id = surveyed_ids.iloc[0][:-4]
+    connection.execute("INSERT INTO aware_device (_id, timestamp, device_id, label) VALUES (?, ?, ?, ?)",
+                       (10**9, generate_synthetic_data.START_MS, substring_id, SUBSTRING_LABEL))
+    connection.commit()
+    connection.close()
+    extra = pd.DataFrame([{"device_id" : substring_id, "fitbit_id" : "", "empatica_id" : "", "pid" : SUBSTRING_LABEL, "label" : SUBSTRING_LABEL,
+                           "platform" : "android", "start_date" : "2020-01-01", "end_date" : "2022-12-31"}])
+    pd.concat([participants, extra], ignore_index=True).to_csv(participant_file, index=False)
+    return db_file, participant_file, substring_id
+
+
+# Run create_multiple_timezones.py on the fixture and compare its files with the legacy ones.  Returns a list of
+# failure messages.
+def check(work_dir, db_file, participant_file, substring_id, tz_default):
+    failures = []
+    name = tz_default.replace("/", "_")
+    tzcodes_file = os.path.join(work_dir, "tzcodes_" + name + ".csv")
+    participant_output = os.path.join(work_dir, "participant_file_modified_" + name + ".csv")
+    script = os.path.join(os.path.dirname(os.path.abspath(__file__)), "create_multiple_timezones.py")
+    subprocess.run([sys.executable, script, "--database", "main", "--device_source_table", "aware_device", "--survey_source_table", "tz_survey",
+                    "--survey_col_name", "eid", "--participant_input", participant_file, "--participant_output", participant_output,
+                    "--destination_file", tzcodes_file, "--tz_default", tz_default, "--db_url", "sqlite:///" + os.path.abspath(db_file)],
+                   check=True, stdout=subprocess.DEVNULL)
+
+    connection = sqlite3.connect(db_file)
+    survey_df = pd.read_sql("SELECT * FROM tz_survey", connection)
+    device_df = pd.read_sql("SELECT device_id, timestamp FROM aware_device", connection)
+    connection.close()
+    legacy_df, legacy_participant_df = legacy_timezones(pd.read_csv(participant_file), survey_df, device_df, "eid", tz_default)
+
+    if (tz_default == "remove"):
+        # The one intended change: the substring participant no longer passes as having time zone data
+        if (substring_id not in set(legacy_df["device_id"]) or SUBSTRING_LABEL not in set(legacy_participant_df["label"])):
+            failures.append("the legacy implementation did not keep the substring participant, the fixture doesn't exercise the fix")
+        legacy_df = legacy_df[legacy_df["device_id"] != substring_id]
+        legacy_participant_df = legacy_participant_df[legacy_participant_df["label"] != SUBSTRING_LABEL]
+        if (not pd.read_csv(participant_output).equals(legacy_participant_df.reset_index(drop=True))):
+            failures.append("the modified participant file differs")
+
+    tzcodes_df = pd.read_csv(tzcodes_file)
+    expected_df = legacy_df.reset_index(drop=True).astype({"timestamp" : tzcodes_df["timestamp"].dtype})
+    if (not tzcodes_df.equals(expected_df)):
+        failures.append("the TZCODES file differs (" + str(len(tzcodes_df)) + " rows, " + str(len(expected_df)) + " expected)")
+    return failures
+
+
+def main():
+
+    try:
+        optlist, args = getopt.getopt(sys.argv[1:], "", ["scale=", "seed=", "keep_dir="])
+    except getopt.GetoptError as err:
+        print(err)
+        usage()
+        sys.exit(2)
+
+    options = {}
+    options["scale"] = "1k"
+    options["seed"] = 0
+    options["keep_dir"] = None
+
+    for option_tuple in optlist:
+        if (option_tuple[0] == "--scale"):
+            options["scale"] = option_tuple[1]
+        elif (option_tuple[0] == "--seed"):
+            options["seed"] = int(option_tuple[1])
+        elif (option_tuple[0] == "--keep_dir"):
+            options["keep_dir"] = option_tuple[1]
+
+    with tempfile.TemporaryDirectory(prefix="tz_regression_") as temp_dir:
+        work_dir = temp_dir if options["keep_dir"] is None else options["keep_dir"]
+        os.makedirs(work_dir, exist_ok=True)
+        db_file, participant_file, substring_id = create_fixture(work_dir, options["scale"], options["seed"])
+        failed = False
+        for tz_default in TZ_DEFAULTS:
+            failures = check(work_dir, db_file, participant_file, substring_id, tz_default)
+            print(("FAIL " if failures else "OK   ") + "tz_default " + tz_default + ("" if not failures else ": " + "; ".join(failures)))
+            failed = failed or len(failures) > 0
+    if (failed):
+        exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,13 +1,458 @@
 import sys
 import os
 import getopt
+import math
+import json
+import tempfile
+import numpy as np
 import pandas as pd
-import glob
+from concurrent.futures import ProcessPoolExecutor
+import csv_reader
+import stage_profiler
+import execution_plan
+
+# Bytes of one row hash (pd.util.hash_pandas_object returns uint64)
+ROW_HASH_BYTES = 8
+# A chunk of parsed CSV rows (with its normalised copy for hashing) takes roughly this many times its size on disk
+PARSED_CHUNK_EXPANSION = 10
+# Partitions are diffed with np.unique and a pandas alignment, roughly this many copies of the hashes
+PARTITION_WORK_COPIES = 4
+# Upper bound on spill partitions per file pair, keeps the number of spill files manageable
+MAX_SPILL_PARTITIONS = 4096
+# Number of differing rows kept for printing in streaming mode (the total is always counted)
+STREAMING_DIFF_ROWS_SHOWN = 100
+# Stands in for missing values of text columns when rows are hashed, so they hash alike whatever their type (None, NaN, NA)
+MISSING_HASH_VALUE = "\x00<missing>"
+# Fingerprint manifest kept in each data root by --incremental
+MANIFEST_FILE = ".compare_manifest.json"
+# Key columns looked for by --keyed when no --key is given
+KEY_CANDIDATES = ["local_segment", "timestamp", "pid"]
+# Number of changed cells printed per file in keyed mode (all of them go to the --report file)
+KEYED_DIFF_CELLS_SHOWN = 20
+
+# Schema caches of this process (one per --float32 setting), shared by every file pair it diffs
+csv_schemas = {}
+
+# Read one side of a file pair with csv_reader: files with the same name (e.g. every participant's phone_screen.csv)
+# share their dtypes, repetitive string columns are categoricals and with --float32 floats are read as float32
+def read_data_csv(csv_file, settings):
+    return schema_cache(settings["float32"]).read(os.path.basename(csv_file), csv_file)
+
+def schema_cache(float32):
+    if (float32 not in csv_schemas):
+        csv_schemas[float32] = csv_reader.CsvSchemaCache(float32=float32)
+    return csv_schemas[float32]
+
+# Recursively collect every CSV file below base_dir with a single os.scandir walk.
+# Returns a dictionary keyed by the path relative to base_dir (using "/" separators) with the full path as value.
+def find_csv_files(base_dir):
+    csv_files = {}
+    pending_dirs = [""]
+    while (len(pending_dirs) > 0):
+        rel_dir = pending_dirs.pop()
+        try:
+            entries = os.scandir(os.path.join(base_dir, rel_dir))
+        except FileNotFoundError:
+            continue
+        with entries:
+            for entry in entries:
+                rel_path = rel_dir + "/" + entry.name if rel_dir else entry.name
+                if entry.is_dir():
+                    pending_dirs.append(rel_path)
+                elif entry.name.endswith(".csv"):
+                    csv_files[rel_path] = entry.path
+    return csv_files
+
+# Average size in bytes of the lines at the start of a CSV file, used to estimate row counts
+def average_line_bytes(csv_file, sample_bytes=1 << 16):
+    with open(csv_file, "rb") as csv_in:
+        sample = csv_in.read(sample_bytes)
+    return max(1, len(sample) / max(1, sample.count(b"\n")))
+
+# A uint64 hash of every row of df that depends on its values rather than on their dtypes, so rows the in-memory diff
+# finds equal hash alike: numbers and booleans are hashed as float64 (1 and 1.0 match, -0.0 matches 0.0, every NaN
+# is the same NaN), other columns as objects with missing values replaced by MISSING_HASH_VALUE (missing values match each other)
+def hash_rows(df):
+    normalised = {}
+    for column in df.columns:
+        values = df[column]
+        if (pd.api.types.is_numeric_dtype(values) or pd.api.types.is_bool_dtype(values)):
+            normalised[column] = (values.astype("float64") + 0.0).where(values.notna())
+        else:
+            normalised[column] = values.astype(object).where(values.notna(), MISSING_HASH_VALUE)
+    return pd.util.hash_pandas_object(pd.DataFrame(normalised, index=df.index), index=False).to_numpy()
+
+# Read a CSV file in chunks parsed like read_data_csv (same schema cache) and yield each chunk with a uint64 hash per row
+def hash_csv_chunks(csv_file, chunk_rows, float32, columns=None):
+    for chunk in schema_cache(float32).read_chunks(os.path.basename(csv_file), csv_file, chunk_rows=chunk_rows):
+        if (columns is not None):
+            chunk = chunk[columns]
+        yield chunk, hash_rows(chunk)
+
+# Hash every row of csv_file and append the hashes to one spill file per partition (hash % partitions)
+def spill_row_hashes(csv_file, spill_prefix, partitions, chunk_rows, float32, columns=None):
+    for chunk, hashes in hash_csv_chunks(csv_file, chunk_rows, float32, columns):
+        partition_ids = hashes % partitions
+        order = np.argsort(partition_ids, kind="stable")
+        bounds = np.searchsorted(partition_ids[order], np.arange(partitions + 1))
+        for partition in range(partitions):
+            if (bounds[partition] < bounds[partition + 1]):
+                with open(spill_prefix + str(partition), "ab") as spill_out:
+                    hashes[order[bounds[partition]:bounds[partition + 1]]].tofile(spill_out)
+
+def read_hash_counts(spill_file):
+    if (not os.path.exists(spill_file)):
+        return pd.Series(dtype=np.int64)
+    hashes, counts = np.unique(np.fromfile(spill_file, dtype=np.uint64), return_counts=True)
+    return pd.Series(counts, index=hashes)
+
+# Empty example arrays of surplus rows: (row hashes, occurrences in the other file, surplus counts)
+def no_surplus_examples():
+    return (np.empty(0, dtype=np.uint64), np.empty(0, dtype=np.int64), np.empty(0, dtype=np.int64))
+
+# Append the surplus hashes of one partition to the example arrays until they cover STREAMING_DIFF_ROWS_SHOWN rows,
+# so only the rows that can be printed are remembered however many rows differ
+def add_surplus_examples(examples, row_hashes, other_counts, surplus_counts):
+    missing_rows = STREAMING_DIFF_ROWS_SHOWN - int(examples[2].sum())
+    if (missing_rows <= 0 or len(row_hashes) == 0):
+        return examples
+    kept = int(np.searchsorted(np.cumsum(surplus_counts), missing_rows)) + 1
+    return tuple(np.concatenate([old, new[:kept]]) for old, new in zip(examples, (row_hashes, other_counts, surplus_counts)))
+
+# Collect the rows of csv_file whose hash is one of the example hashes (arrays from add_surplus_examples).
+# As with the duplicate counter of the in-memory diff, the n-th occurrence of a row is reported only when the other
+# file has fewer than n occurrences.  At most max_rows rows are kept.
+def collect_surplus_rows(csv_file, examples, side, chunk_rows, max_rows, float32, columns=None):
+    rows = []
+    seen = {}
+    if (len(examples[0]) == 0 or max_rows <= 0):
+        return rows
+    other_counts = dict(zip(examples[0].tolist(), examples[1].tolist()))
+    for chunk, hashes in hash_csv_chunks(csv_file, chunk_rows, float32, columns):
+        for position in np.flatnonzero(np.isin(hashes, examples[0])):
+            row_hash = int(hashes[position])
+            occurrence = seen.get(row_hash, 0)
+            seen[row_hash] = occurrence + 1
+            if (occurrence >= other_counts[row_hash]):
+                rows.append(list(chunk.iloc[position]) + [occurrence, side])
+                if (len(rows) >= max_rows):
+                    return rows
+    return rows
+
+# Out-of-core version of the diff in compare_file_group.  Row hashes of the baseline file and of each candidate file are
+# partitioned to spill files on disk and each partition is diffed on its own, so memory stays within memory_budget bytes
+# whatever the file size.  The baseline is hashed once for all the candidates.  Rows are parsed and hashed by value
+# (hash_rows), so the result is the one of the in-memory diff.  float32 is the --float32 setting.  Returns (number of differing rows,
+# printable diff of the first differing rows) for each candidate.
+def streaming_diff_many(dir1_file, dir2_files, memory_budget, float32=False):
+    columns1 = list(pd.read_csv(dir1_file, nrows=0).columns)
+    diffs = [None] * len(dir2_files)
+    for position, dir2_file in enumerate(dir2_files):
+        columns2 = list(pd.read_csv(dir2_file, nrows=0).columns)
+        if (set(columns1) != set(columns2)):
+            diffs[position] = (1, "Columns differ: "+str(columns1)+" vs "+str(columns2))
+    if (all(diff is not None for diff in diffs)):
+        return diffs
+
+    line_bytes = average_line_bytes(dir1_file)
+    chunk_rows = max(1000, int(memory_budget / (2 * PARSED_CHUNK_EXPANSION * line_bytes)))
+    estimated_rows = (os.path.getsize(dir1_file) + max(os.path.getsize(dir2_file) for dir2_file in dir2_files)) / line_bytes
+    partitions = math.ceil(estimated_rows * ROW_HASH_BYTES * PARTITION_WORK_COPIES / memory_budget)
+    partitions = min(MAX_SPILL_PARTITIONS, max(1, partitions))
+
+    with tempfile.TemporaryDirectory(prefix="compare_spill_") as spill_dir:
+        spill_row_hashes(dir1_file, os.path.join(spill_dir, "dir1_"), partitions, chunk_rows, float32)
+        for position, dir2_file in enumerate(dir2_files):
+            if (diffs[position] is not None):
+                continue
+            diff_rows = 0
+            left_examples = no_surplus_examples()
+            right_examples = no_surplus_examples()
+            spill_prefix = os.path.join(spill_dir, "dir2_" + str(position) + "_")
+            spill_row_hashes(dir2_file, spill_prefix, partitions, chunk_rows, float32, columns1)
+            for partition in range(partitions):
+                counts1 = read_hash_counts(os.path.join(spill_dir, "dir1_" + str(partition)))
+                counts2 = read_hash_counts(spill_prefix + str(partition))
+                counts1, counts2 = counts1.align(counts2, fill_value=0)
+                row_hashes = counts1.index.to_numpy(dtype=np.uint64)
+                counts1 = counts1.to_numpy(dtype=np.int64)
+                counts2 = counts2.to_numpy(dtype=np.int64)
+                difference = counts1 - counts2
+                diff_rows = diff_rows + int(np.abs(difference).sum())
+                left = difference > 0
+                right = difference < 0
+                left_examples = add_surplus_examples(left_examples, row_hashes[left], counts2[left], difference[left])
+                right_examples = add_surplus_examples(right_examples, row_hashes[right], counts1[right], -difference[right])
+                # The candidate's spill file is not needed any more
+                if (os.path.exists(spill_prefix + str(partition))):
+                    os.remove(spill_prefix + str(partition))
+            diffs[position] = surplus_diff(dir1_file, dir2_file, columns1, diff_rows, left_examples, right_examples, chunk_rows, float32)
+    return diffs
+
+# The differing rows found by streaming_diff_many for one candidate file: their count and a printable diff of up to
+# STREAMING_DIFF_ROWS_SHOWN of them (the example rows kept by add_surplus_examples)
+def surplus_diff(dir1_file, dir2_file, columns1, diff_rows, left_examples, right_examples, chunk_rows, float32):
+    if (diff_rows == 0):
+        return (0, "")
+    rows = collect_surplus_rows(dir1_file, left_examples, "left_only", chunk_rows, STREAMING_DIFF_ROWS_SHOWN, float32)
+    rows = rows + collect_surplus_rows(dir2_file, right_examples, "right_only", chunk_rows, STREAMING_DIFF_ROWS_SHOWN - len(rows), float32, columns1)
+    merged = pd.DataFrame(rows, columns=columns1 + ["duplicate_counter", "_merge"])
+    diff_text = str(merged)
+    if (diff_rows > len(rows)):
+        diff_text = diff_text + "\n(showing "+str(len(rows))+" of "+str(diff_rows)+" differing rows)"
+    return (diff_rows, diff_text)
+
+# How to diff a file pair: "memory" when the estimated working set of the in-memory diff fits memory_budget bytes,
+# "streaming" (streaming_diff_many) otherwise.  Keyed diffs always run in memory.  Pairs small enough to fit even at
+# PARSED_CHUNK_EXPANSION times their size on disk are not sampled.  Returns the strategy and the estimates (None when
+# not sampled).
+def pair_strategy(dir1_file, dir2_file, settings):
+    if (settings["streaming"]):
+        return "streaming", None
+    size = os.path.getsize(dir1_file) + os.path.getsize(dir2_file)
+    if (size * PARSED_CHUNK_EXPANSION * execution_plan.WORKING_SET_FACTOR <= settings["memory_budget"] and not settings["plan"]):
+        return "memory", None
+    estimates = [execution_plan.estimate_csv(dir1_file), execution_plan.estimate_csv(dir2_file)]
+    if (settings["keyed"]):
+        return "memory", estimates
+    return execution_plan.choose_strategy(estimates, settings["memory_budget"]), estimates
+
+def load_manifest(base_dir):
+    manifest_file = os.path.join(base_dir, MANIFEST_FILE)
+    if (os.path.exists(manifest_file)):
+        with open(manifest_file) as manifest_in:
+            return json.load(manifest_in)
+    return {"files" : {}, "results" : {}}
+
+def save_manifest(base_dir, manifest):
+    manifest_file = os.path.join(base_dir, MANIFEST_FILE)
+    with open(manifest_file + ".tmp", "w") as manifest_out:
+        json.dump(manifest, manifest_out)
+    os.replace(manifest_file + ".tmp", manifest_file)
+
+# Size, mtime, row count and an order-insensitive content digest of a CSV file.  The digest is the sum (mod 2**64) of
+# the row hashes, so files with the same rows in a different order get the same digest while duplicated rows still count.
+# The rows are hashed by value as in streaming_diff_many, so the digest depends on the --float32 setting.  The previous
+# fingerprint is reused without reading the file when its size, mtime and --float32 setting have not changed.
+def file_fingerprint(csv_file, previous, chunk_rows, float32):
+    stat = os.stat(csv_file)
+    if (previous is not None and previous["size"] == stat.st_size and previous["mtime_ns"] == stat.st_mtime_ns and previous.get("float32") == float32):
+        return previous
+    digest = np.uint64(0)
+    rows = 0
+    with np.errstate(over="ignore"):
+        for chunk, hashes in hash_csv_chunks(csv_file, chunk_rows, float32):
+            digest = digest + hashes.sum(dtype=np.uint64)
+            rows = rows + len(hashes)
+    return {"size" : stat.st_size, "mtime_ns" : stat.st_mtime_ns, "digest" : format(int(digest), "016x"), "rows" : rows, "float32" : float32}
+
+# The settings a diff result depends on, kept with the results cached by --incremental so that a result is only reused
+# by a run that would diff the same way (whole rows, or keyed with the same key and tolerances)
+def diff_settings(settings):
+    if (not settings["keyed"]):
+        return {"keyed" : False}
+    return {"keyed" : True, "key" : settings["key"], "tolerances" : settings["tolerances"], "default_tolerance" : settings["default_tolerance"]}
+
+# Convert a numpy/pandas cell value into something json can write (NaN and NA become None)
+def plain_value(value):
+    if (isinstance(value, np.generic)):
+        value = value.item()
+    if (value is pd.NA or value is pd.NaT or (isinstance(value, float) and math.isnan(value))):
+        return None
+    return value
+
+# Boolean array, True where the two columns differ.  Numeric columns are equal within atol + rtol * |dir2 value|,
+# cells that are missing on both sides are equal.
+def changed_cells(column1, column2, tolerance):
+    if (pd.api.types.is_numeric_dtype(column1) and pd.api.types.is_numeric_dtype(column2)):
+        values1 = column1.to_numpy(dtype=np.float64, na_value=np.nan)
+        values2 = column2.to_numpy(dtype=np.float64, na_value=np.nan)
+        with np.errstate(invalid="ignore"):
+            equal = (values1 == values2) | (np.abs(values1 - values2) <= tolerance["atol"] + tolerance["rtol"] * np.abs(values2))
+        return ~(equal | (np.isnan(values1) & np.isnan(values2)))
+    missing1 = column1.isna().to_numpy()
+    missing2 = column2.isna().to_numpy()
+    equal = (column1.astype(object).to_numpy() == column2.astype(object).to_numpy())
+    return ~((equal & ~missing1 & ~missing2) | (missing1 & missing2))
+
+# Cell-level diff of two files joined on key columns.  Rows sharing a key are paired up in file order.
+# Returns the key values of rows found on one side only, a list of changed cells, the number of changed rows and the
+# columns found in only one of the files.  Every paired row counts as changed when a column is only in one file.
+def keyed_diff(df1, df2, key, tolerances, default_tolerance):
+    index = key + ["duplicate_counter"]
+    df1['duplicate_counter'] = df1.groupby(key, dropna=False, observed=True).cumcount()
+    df2['duplicate_counter'] = df2.groupby(key, dropna=False, observed=True).cumcount()
+    df1 = df1.set_index(index)
+    df2 = df2.set_index(index)
+
+    only1 = df1.index.difference(df2.index, sort=False)
+    only2 = df2.index.difference(df1.index, sort=False)
+    common = df1.index.intersection(df2.index, sort=False)
+    aligned1 = df1.reindex(common)
+    aligned2 = df2.reindex(common)
+
+    cells = []
+    columns_only1 = [column for column in df1.columns if column not in df2.columns]
+    columns_only2 = [column for column in df2.columns if column not in df1.columns]
+    changed_rows = np.full(len(common), len(columns_only1) + len(columns_only2) > 0)
+    for column in [c for c in df1.columns if c in df2.columns]:
+        changed = changed_cells(aligned1[column], aligned2[column], tolerances.get(column, default_tolerance))
+        changed_rows = changed_rows | changed
+        for position in np.flatnonzero(changed):
+            cells.append({"key" : [plain_value(v) for v in common[position]], "column" : column,
+                          "dir1" : plain_value(aligned1[column].iat[position]), "dir2" : plain_value(aligned2[column].iat[position])})
+    rows_only1 = [[plain_value(v) for v in row_key] for row_key in only1]
+    rows_only2 = [[plain_value(v) for v in row_key] for row_key in only2]
+    return rows_only1, rows_only2, cells, int(changed_rows.sum()), columns_only1, columns_only2
+
+# Diff a baseline file against the matching file of each candidate root (a single pair in the classic two directory
+# comparison).  The baseline file is read, counted and fingerprinted once for all the candidates.  Runs in a worker
+# process when --jobs > 1, so it only takes and returns picklable values.  previous holds, per candidate, the manifest
+# entries of an earlier run when --incremental is used.  Returns one result per candidate file.
+def compare_file_group(task):
+    file_name, dir1_file, dir2_files, settings, previous = task
+    results = [{"file" : file_name, "diff_rows" : 0, "diff_text" : "", "skipped" : False, "strategy" : None} for dir2_file in dir2_files]
+    pending = list(range(len(dir2_files)))
+
+    if (settings["incremental"]):
+        chunk_rows = max(1000, int(settings["memory_budget"] / (PARSED_CHUNK_EXPANSION * average_line_bytes(dir1_file))))
+        fingerprint1 = file_fingerprint(dir1_file, previous[0]["fingerprint1"], chunk_rows, settings["float32"])
+        for position in pending:
+            result = results[position]
+            result["fingerprint1"] = fingerprint1
+            result["fingerprint2"] = file_fingerprint(dir2_files[position], previous[position]["fingerprint2"], chunk_rows, settings["float32"])
+            digest1 = result["fingerprint1"]["digest"]
+            digest2 = result["fingerprint2"]["digest"]
+            # Same rows on both sides, no need to diff
+            if (digest1 == digest2 and result["fingerprint1"]["rows"] == result["fingerprint2"]["rows"]):
+                result["skipped"] = True
+            # Both files are unchanged since a previous run with the same diff settings found diffs between them
+            elif (previous[position]["result"] is not None and previous[position]["result"]["digest1"] == digest1 and previous[position]["result"]["digest2"] == digest2
+                  and previous[position]["result"].get("settings") == diff_settings(settings)):
+                result["skipped"] = True
+                result["diff_rows"] = previous[position]["result"]["diff_rows"]
+                result["diff_text"] = "(both files unchanged since a previous run, diff not repeated)"
+        pending = [position for position in pending if not results[position]["skipped"]]
+
+    for position in pending:
+        results[position]["strategy"] = pair_strategy(dir1_file, dir2_files[position], settings)[0]
+    streamed = [position for position in pending if results[position]["strategy"] == "streaming"]
+    if (len(streamed) > 0):
+        for position, diff in zip(streamed, streaming_diff_many(dir1_file, [dir2_files[position] for position in streamed], settings["memory_budget"], settings["float32"])):
+            results[position]["diff_rows"], results[position]["diff_text"] = diff
+    in_memory = [position for position in pending if results[position]["strategy"] == "memory"]
+    if (len(in_memory) == 0):
+        return results
+
+    df1 = read_data_csv(dir1_file, settings)
+    counted1 = None
+    for position in in_memory:
+        result = results[position]
+        df2 = read_data_csv(dir2_files[position], settings)
+
+        if (settings["keyed"]):
+            key = settings["key"]
+            if (key is None):
+                key = [column for column in KEY_CANDIDATES if column in df1.columns and column in df2.columns]
+            if (len(key) > 0 and all(column in df1.columns and column in df2.columns for column in key)):
+                # keyed_diff adds its counter to the frames it gets, the baseline is shared by the candidates
+                rows_only1, rows_only2, cells, changed_rows, columns_only1, columns_only2 = keyed_diff(df1.copy(deep=False), df2, key, settings["tolerances"], settings["default_tolerance"])
+                result["key"] = key + ["duplicate_counter"]
+                result["rows_only_in_dir1"] = rows_only1
+                result["rows_only_in_dir2"] = rows_only2
+                result["changed_cells"] = cells
+                result["columns_only_in_dir1"] = columns_only1
+                result["columns_only_in_dir2"] = columns_only2
+                result["diff_rows"] = len(rows_only1) + len(rows_only2) + changed_rows
+                if (result["diff_rows"] > 0):
+                    diff_text = str(len(cells))+" changed cells in "+str(changed_rows)+" rows, "+str(len(rows_only1))+" rows only in dir1, "+str(len(rows_only2))+" rows only in dir2 (key: "+",".join(key)+")"
+                    if (len(columns_only1) + len(columns_only2) > 0):
+                        diff_text = diff_text + "\nColumns only in dir1: "+str(columns_only1)+", only in dir2: "+str(columns_only2)
+                    if (len(cells) > 0):
+                        diff_text = diff_text + "\n" + str(pd.DataFrame(cells[:KEYED_DIFF_CELLS_SHOWN]))
+                    result["diff_text"] = diff_text
+                continue
+
+        # observed=True: grouping by categorical columns must not build every combination of their categories.
+        # dropna=False: rows with missing values are numbered too, as they are by the streaming diff
+        if (counted1 is None):
+            counted1 = df1.assign(duplicate_counter=df1.groupby(list(df1.columns), dropna=False, observed=True).cumcount())
+        df2['duplicate_counter'] = df2.groupby(list(df2.columns), dropna=False, observed=True).cumcount()
+        merged = counted1.merge(df2, indicator=True, how='outer')
+        merged = merged[merged['_merge'] != 'both']
+        if (len(merged) > 0):
+            result["diff_rows"] = len(merged)
+            result["diff_text"] = str(merged)
+    return results
+
+# Write the per-file results as a JSON document or, for a .parquet path, as a flat table with one row per difference
+def write_report(report_file, options, results):
+    if (report_file.endswith(".parquet")):
+        records = []
+        for result in results:
+            # With several candidate roots every row also names its candidate
+            candidate = {"candidate" : result["candidate"]} if "candidate" in result else {}
+            if (result["status"] in ["missing_in_dir1", "missing_in_dir2"]):
+                records.append(dict({"file" : result["file"], "change" : result["status"], "key" : None, "column" : None, "dir1" : None, "dir2" : None}, **candidate))
+            for row_key in result.get("rows_only_in_dir1", []):
+                records.append(dict({"file" : result["file"], "change" : "row_only_in_dir1", "key" : json.dumps(row_key), "column" : None, "dir1" : None, "dir2" : None}, **candidate))
+            for row_key in result.get("rows_only_in_dir2", []):
+                records.append(dict({"file" : result["file"], "change" : "row_only_in_dir2", "key" : json.dumps(row_key), "column" : None, "dir1" : None, "dir2" : None}, **candidate))
+            for change, columns in [("column_only_in_dir1", result.get("columns_only_in_dir1", [])), ("column_only_in_dir2", result.get("columns_only_in_dir2", []))]:
+                for column in columns:
+                    records.append(dict({"file" : result["file"], "change" : change, "key" : None, "column" : column, "dir1" : None, "dir2" : None}, **candidate))
+            for cell in result.get("changed_cells", []):
+                records.append(dict({"file" : result["file"], "change" : "changed_cell", "key" : json.dumps(cell["key"]), "column" : cell["column"],
+                                     "dir1" : None if cell["dir1"] is None else str(cell["dir1"]), "dir2" : None if cell["dir2"] is None else str(cell["dir2"])}, **candidate))
+        columns = ["file", "change", "key", "column", "dir1", "dir2"] + (["candidate"] if isinstance(options["dir2"], list) else [])
+        pd.DataFrame(records, columns=columns).to_parquet(report_file, index=False)
+    else:
+        with open(report_file, "w") as report_out:
+            json.dump({"dir1" : options["dir1"], "dir2" : options["dir2"], "files" : results}, report_out, indent=1)
+
+# Table of the status of every file (rows) in every candidate root (columns): identical, different (with the number of
+# differing rows), missing_in_dir1 (only in the candidate) or missing_in_dir2 (not in the candidate)
+def matrix_frame(candidates, matrix):
+    return pd.DataFrame([[file_name] + [statuses.get(run, "") for run in range(len(candidates))] for file_name, statuses in sorted(matrix.items())],
+                        columns=["file"] + candidates)
+
+# Print the files that are not identical in every candidate root, and the number of differing files of each root
+def print_matrix(candidates, matrix, run_summaries):
+    matrix_df = matrix_frame(candidates, matrix)
+    matrix_df.columns = ["file"] + ["run"+str(run + 1) for run in range(len(candidates))]
+    differing = matrix_df[(matrix_df.drop(columns="file") != "identical").any(axis=1)]
+    for run, candidate in enumerate(candidates):
+        print("run"+str(run + 1)+": "+candidate+": "+str(run_summaries[run]["matched"])+" matched files, "+str(run_summaries[run]["differing"])+" with diffs, "
+              +str(run_summaries[run]["missing"])+" without a match")
+    if (len(differing) == 0):
+        print("Every file is identical in every run.")
+    else:
+        print(str(len(differing))+" of "+str(len(matrix_df))+" files differ in at least one run:")
+        print(differing.to_string(index=False))
+
+# Write the file by run matrix as CSV (or Parquet for a .parquet path)
+def write_matrix(matrix_file, candidates, matrix):
+    matrix_df = matrix_frame(candidates, matrix)
+    if (matrix_file.endswith(".parquet")):
+        matrix_df.to_parquet(matrix_file, index=False)
+    else:
+        matrix_df.to_csv(matrix_file, index=False)
+
+# Yield the results of compare_file_group for every task, in the same order as tasks.  With more
+# than one job the groups are diffed in a process pool and results are streamed back as they finish.
+def compare_file_groups(tasks, jobs):
+    if (jobs <= 1):
+        for task in tasks:
+            yield compare_file_group(task)
+    else:
+        with ProcessPoolExecutor(max_workers=jobs) as executor:
+            for results in executor.map(compare_file_group, tasks):
+                yield results
 
 def main():
 
     try:
-        optlist, args = getopt.getopt(sys.argv[1:], "", [])
+        optlist, args = getopt.getopt(sys.argv[1:], "", ["dir1=", "dir2=", "noraw", "nointerim", "noprocessed", "jobs=", "streaming", "memory-budget=", "incremental", "keyed", "key=", "atol=", "rtol=", "tolerances=", "float32", "report=", "profile=", "profile_cprofile=", "plan", "matrix="])
     except getopt.GetoptError as err:
         print(err)
         usage()
@@ -18,105 +463,244 @@ def main():
     options["dir2"] = "/home/douglasvbellew/Workspaces/rapids/keystroke_final_test/rapids/data"
     options["compare_raw"] = True
     options["compare_interim"] = True
+    options["compare_processed"] = True
+    options["jobs"] = 1
+    options["streaming"] = False
+    options["memory_budget"] = 512
+    options["incremental"] = False
+    options["keyed"] = False
+    options["key"] = None
+    options["atol"] = 0.0
+    options["rtol"] = 1e-9
+    options["tolerances"] = None
+    options["float32"] = False
+    options["report"] = None
+    options["profile"] = None
+    options["profile_cprofile"] = None
+    options["plan"] = False
+    options["matrix"] = None
+    candidates = []
     
     for option_tuple in optlist:
         if (option_tuple[0] == "--noraw"):
             options["compare_raw"] = False
         elif (option_tuple[0] == "--nointerim"):
             options["compare_interim"] = False
+        elif (option_tuple[0] == "--noprocessed"):
+            options["compare_processed"] = False
         elif (option_tuple[0] == "--dir1"):
-            options["last_processed_id"] = option_tuple[1]
+            options["dir1"] = option_tuple[1]
         elif (option_tuple[0] == "--dir2"):
-            options["last_processed_id"] = option_tuple[1]    
+            candidates.append(option_tuple[1])
+        elif (option_tuple[0] == "--jobs"):
+            options["jobs"] = int(option_tuple[1])
+        elif (option_tuple[0] == "--streaming"):
+            options["streaming"] = True
+        elif (option_tuple[0] == "--memory-budget"):
+            options["memory_budget"] = int(option_tuple[1])
+        elif (option_tuple[0] == "--incremental"):
+            options["incremental"] = True
+        elif (option_tuple[0] == "--keyed"):
+            options["keyed"] = True
+        elif (option_tuple[0] == "--key"):
+            options["keyed"] = True
+            options["key"] = option_tuple[1].split(",")
+        elif (option_tuple[0] == "--atol"):
+            options["atol"] = float(option_tuple[1])
+        elif (option_tuple[0] == "--rtol"):
+            options["rtol"] = float(option_tuple[1])
+        elif (option_tuple[0] == "--tolerances"):
+            options["tolerances"] = option_tuple[1]
+        elif (option_tuple[0] == "--float32"):
+            options["float32"] = True
+        elif (option_tuple[0] == "--report"):
+            options["report"] = option_tuple[1]
+        elif (option_tuple[0] == "--profile"):
+            options["profile"] = option_tuple[1]
+        elif (option_tuple[0] == "--profile_cprofile"):
+            options["profile_cprofile"] = option_tuple[1]
+        elif (option_tuple[0] == "--plan"):
+            options["plan"] = True
+        elif (option_tuple[0] == "--matrix"):
+            options["matrix"] = option_tuple[1]
+    
+    # --dir2 can be given several times: every candidate root is compared with the --dir1 baseline
+    if (len(candidates) > 0):
+        options["dir2"] = candidates[0] if len(candidates) == 1 else candidates
+    else:
+        candidates = [options["dir2"]]
+    multiple = len(candidates) > 1
+    
+    if (options["keyed"] and options["streaming"]):
+        print("--keyed/--key and --streaming can not be used together.")
+        usage()
+        sys.exit(2)
+    
+    # Per column tolerances: {"column name" : {"atol" : ..., "rtol" : ...}}, missing values use --atol/--rtol
+    default_tolerance = {"atol" : options["atol"], "rtol" : options["rtol"]}
+    tolerances = {}
+    if (options["tolerances"] is not None):
+        with open(options["tolerances"]) as tolerances_in:
+            for column, tolerance in json.load(tolerances_in).items():
+                tolerances[column] = dict(default_tolerance, **tolerance)
     
     compare_dirs = []
     if (options["compare_raw"]):
         compare_dirs.append("raw")
     if(options["compare_interim"]):
         compare_dirs.append("interim")
+    if(options["compare_processed"]):
+        compare_dirs.append("processed")
     
+    # Each worker process gets its own share of the memory budget
+    settings = {"streaming" : options["streaming"], "incremental" : options["incremental"], "memory_budget" : options["memory_budget"] * 1024 * 1024 // max(1, options["jobs"]),
+                "keyed" : options["keyed"], "key" : options["key"], "tolerances" : tolerances, "default_tolerance" : default_tolerance, "float32" : options["float32"], "plan" : options["plan"]}
+    profiler = stage_profiler.StageProfiler("compare_data_directories", options["profile"], options["profile_cprofile"])
+    report_results = []
+    summary = {"matched" : 0, "missing" : 0, "differing" : 0, "skipped" : 0, "streamed" : 0}
+    # Per candidate root: differing matched files and files without a match
+    run_summaries = [{"matched" : 0, "missing" : 0, "differing" : 0} for candidate in candidates]
+    # Status of every file in every candidate root, for --matrix
+    matrix = {}
+    plan_steps = []
+    if (options["incremental"]):
+        manifest1 = load_manifest(options["dir1"])
+        manifests2 = [load_manifest(candidate) for candidate in candidates]
+        previous_results = [manifest1["results"].setdefault(os.path.abspath(candidate), {}) for candidate in candidates]
+
+    def record(file_name, run, status, result=None):
+        matrix.setdefault(file_name, {})[run] = status
+        if (status in ["missing_in_dir1", "missing_in_dir2"]):
+            summary["missing"] = summary["missing"] + 1
+            run_summaries[run]["missing"] = run_summaries[run]["missing"] + 1
+            report_results.append(dict({"file" : file_name, "status" : status}, **({"candidate" : candidates[run]} if multiple else {})))
+
     for comp_dir in compare_dirs:
-        if (comp_dir == "raw"):
-            dir1_files = glob.glob(os.path.join(options["dir1"],comp_dir,"**","*.csv"))
-            dir1_files.sort()
-            dir2_files = glob.glob(os.path.join(options["dir2"],comp_dir,"**","*.csv"))
-            dir2_files.sort()            
-        elif (comp_dir == "interim"):
-            dir1_files = glob.glob(os.path.join(options["dir1"],comp_dir,"**","**","*.csv"))
-            dir1_files.sort()
-            dir2_files = glob.glob(os.path.join(options["dir2"],comp_dir,"**","**","*.csv"))
-            dir2_files.sort()
+        with profiler.stage("find_csv_files") as stage:
+            dir1_files = find_csv_files(os.path.join(options["dir1"],comp_dir))
+            candidate_files = [find_csv_files(os.path.join(candidate,comp_dir)) for candidate in candidates]
+            stage["rows"] = len(dir1_files) + sum(len(dir2_files) for dir2_files in candidate_files)
 
         print(len(dir1_files))
-        print(len(dir2_files))
-        #print(dir1_files[:10])
-        #print(dir2_files[:10])
+        for dir2_files in candidate_files:
+            print(len(dir2_files))
         if (len(dir1_files) == 0):
             print("Directory: "+os.path.join(options["dir1"],comp_dir)+" has no files to compare.")
-        if (len(dir2_files) == 0):
-            print("Directory: "+os.path.join(options["dir2"],comp_dir)+" has no files to compare.")
-        if ((len(dir1_files) > 0) and (len(dir2_files) > 0)):
-            pop_dir_1 = True
-            pop_dir_2 = True
-            this_pass = 0
-            while ((len(dir1_files) > 0) or (len(dir2_files) > 0)):
+        for run, dir2_files in enumerate(candidate_files):
+            if (len(dir2_files) == 0):
+                print("Directory: "+os.path.join(candidates[run],comp_dir)+" has no files to compare.")
+        compared_runs = [run for run, dir2_files in enumerate(candidate_files) if len(dir1_files) > 0 and len(dir2_files) > 0]
+        if (len(compared_runs) == 0):
+            continue
+
+        # Pair files by relative path: a set join instead of walking two sorted lists
+        for run in compared_runs:
+            dir2_files = candidate_files[run]
+            for rel_path in sorted(dir1_files.keys() - dir2_files.keys()):
+                print("Didn't find file match for:" + dir1_files[rel_path] + (" in " + candidates[run] if multiple else ""))
+                record(comp_dir + "/" + rel_path, run, "missing_in_dir2")
+            for rel_path in sorted(dir2_files.keys() - dir1_files.keys()):
+                print("Didn't find file match for:" + dir2_files[rel_path])
+                record(comp_dir + "/" + rel_path, run, "missing_in_dir1")
+
+        # One task per baseline file, with the matching file of every candidate root that has one
+        tasks = []
+        task_runs = []
+        for rel_path in sorted(dir1_files.keys()):
+            runs = [run for run in compared_runs if rel_path in candidate_files[run]]
+            if (len(runs) == 0):
+                continue
+            file_name = comp_dir + "/" + rel_path
+            previous = None
+            if (options["incremental"]):
+                previous = [{"fingerprint1" : manifest1["files"].get(file_name), "fingerprint2" : manifests2[run]["files"].get(file_name), "result" : previous_results[run].get(file_name)}
+                            for run in runs]
+            tasks.append((file_name, dir1_files[rel_path], [candidate_files[run][rel_path] for run in runs], settings, previous))
+            task_runs.append(runs)
+
+        # --plan: only estimate how each pair would be diffed
+        if (options["plan"]):
+            with profiler.stage("plan", rows=len(tasks)):
+                for (file_name, dir1_file, dir2_files, task_settings, previous), runs in zip(tasks, task_runs):
+                    for run, dir2_file in zip(runs, dir2_files):
+                        strategy, estimates = pair_strategy(dir1_file, dir2_file, settings)
+                        note = "--streaming" if options["streaming"] else "keyed diffs run in memory" if options["keyed"] else None
+                        plan_steps.append((file_name + (" (" + candidates[run] + ")" if multiple else ""), estimates or [], strategy, note))
+            continue
+
+        # Matched files are diffed afterwards (in parallel with --jobs), results print in file order
+        this_pass = 0
+        for results, runs in zip(profiler.iterate("compare_file_group", compare_file_groups(tasks, options["jobs"])), task_runs):
+            for result, run in zip(results, runs):
                 this_pass = this_pass + 1
                 if (this_pass%5 == 0):
                     print("this_pass = "+str(this_pass))
-                if (pop_dir_1):
-                    dir1_file = dir1_files.pop(0)
-                if (pop_dir_2):
-                    dir2_file = dir2_files.pop(0)
-                pop_dir_1 = True
-                pop_dir_2 = True
-                
-                no_file_1 = False
-                no_file_2 = False
-                dir1_file_parts = dir1_file.split("/")
-                dir2_file_parts = dir2_file.split("/")
-                if (dir1_file_parts[-3] < dir2_file_parts[-3]):
-                    no_file_2 = True
-                elif (dir1_file_parts[-3] > dir2_file_parts[-3]):
-                    no_file_1 = True    
-                elif (dir1_file_parts[-2] < dir2_file_parts[-2]):
-                    no_file_2 = True
-                elif (dir1_file_parts[-2] > dir2_file_parts[-2]):
-                    no_file_1 = True
-                elif (dir1_file_parts[-1] < dir2_file_parts[-1]):
-                    no_file_2 = True
-                elif (dir1_file_parts[-1] > dir2_file_parts[-1]):
-                    no_file_1 = True 
-                    
-                if (no_file_2):
-                    print("Didn't find file match for:" + dir1_file)
-                    pop_dir_2 = False
-                    continue
-                elif (no_file_1):
-                    print("Didn't find file match for:" + dir2_file)
-                    pop_dir_1 = False
-                    continue
-                    
-                df1 = pd.read_csv(dir1_file)
-                df2 = pd.read_csv(dir2_file)
-                
-                df1['duplicate_counter'] = df1.groupby(list(df1.columns)).cumcount()
-                df2['duplicate_counter'] = df2.groupby(list(df2.columns)).cumcount()
-                merged = df1.merge(df2, indicator=True, how='outer')
-                merged = merged[merged['_merge'] != 'both']
-                if (len(merged) > 0):
-                    print("For file: "+os.path.join(comp_dir,dir1_file_parts[-3],dir1_file_parts[-2],dir1_file_parts[-1])+" there are diffs:")
-                    print(merged)
+                summary["matched"] = summary["matched"] + 1
+                run_summaries[run]["matched"] = run_summaries[run]["matched"] + 1
+                if (result["skipped"]):
+                    summary["skipped"] = summary["skipped"] + 1
+                if (result["strategy"] == "streaming"):
+                    summary["streamed"] = summary["streamed"] + 1
+                if (result["diff_rows"] > 0):
+                    summary["differing"] = summary["differing"] + 1
+                    run_summaries[run]["differing"] = run_summaries[run]["differing"] + 1
+                    print("For file: "+result["file"]+(" in "+candidates[run] if multiple else "")+" there are diffs:")
+                    print(result["diff_text"])
+                record(result["file"], run, "different (" + str(result["diff_rows"]) + " rows)" if result["diff_rows"] > 0 else "identical")
+                if (options["incremental"]):
+                    manifest1["files"][result["file"]] = result["fingerprint1"]
+                    manifests2[run]["files"][result["file"]] = result["fingerprint2"]
+                    if (result["diff_rows"] > 0):
+                        previous_results[run][result["file"]] = {"digest1" : result["fingerprint1"]["digest"], "digest2" : result["fingerprint2"]["digest"], "diff_rows" : result["diff_rows"],
+                                                                     "settings" : diff_settings(settings)}
+                    else:
+                        previous_results[run].pop(result["file"], None)
+                if (options["report"] is not None):
+                    result["status"] = "different" if result["diff_rows"] > 0 else "identical"
+                    if (multiple):
+                        result["candidate"] = candidates[run]
+                    for field in ["diff_text", "fingerprint1", "fingerprint2"]:
+                        result.pop(field, None)
+                    report_results.append(result)
                 # if "timestamp" in df1.columns:
                 #     df1 = df1.sort_values(by=["timestamp"])
                 #     df2 = df2.sort_values(by=["timestamp"])
                 # elif "local_segment" in df1.columns:
                 #     df1 = df1.sort_values(by=["local_segment"])
                 #     df2 = df2.sort_values(by=["local_segment"])                       
-        
+    
+    if (options["plan"]):
+        execution_plan.print_plan("compare_data_directories.py", plan_steps, settings["memory_budget"])
+        print(str(sum(1 for step in plan_steps if step[2] == "streaming"))+" of "+str(len(plan_steps))+" matched files would be diffed in streaming mode.")
+        profiler.finish()
+        return
+    if (options["incremental"]):
+        with profiler.stage("save_manifest"):
+            save_manifest(options["dir1"], manifest1)
+            for candidate, manifest2 in zip(candidates, manifests2):
+                save_manifest(candidate, manifest2)
+        print("Skipped the diff of "+str(summary["skipped"])+" matched files with unchanged fingerprints.")
+    if (options["report"] is not None):
+        with profiler.stage("write_report", rows=len(report_results)):
+            write_report(options["report"], options, report_results)
+        print("Wrote diff report to "+options["report"])
+    if (multiple):
+        print_matrix(candidates, matrix, run_summaries)
+    if (options["matrix"] is not None):
+        with profiler.stage("write_matrix", rows=len(matrix)):
+            write_matrix(options["matrix"], candidates, matrix)
+        print("Wrote the file by run matrix to "+options["matrix"])
+    print("Summary: "+str(summary["matched"])+" matched files, "+str(summary["missing"])+" files without a match, "+str(summary["differing"])+" matched files with diffs.")
+    if (summary["streamed"] > 0 and not options["streaming"]):
+        print("Diffed "+str(summary["streamed"])+" matched files that don't fit in the memory budget in streaming mode.")
+    profiler.finish()
 
 
 def usage():
-    print("python compare_data_directories.py --dir1 <first base directory> --dir2 <second base directory [--noraw] [--noinerim]")
+    print("python compare_data_directories.py --dir1 <first base directory> --dir2 <second base directory> [--dir2 <another candidate> ...] [--noraw] [--nointerim] [--noprocessed] [--jobs <number of worker processes>] [--streaming] [--memory-budget <MB>] [--incremental]")
+    print("                                   [--keyed] [--key <col1,col2,...>] [--atol <tolerance>] [--rtol <tolerance>] [--tolerances <JSON file>] [--float32] [--report <JSON or .parquet file>]")
+    print("                                   [--plan] [--matrix <CSV or .parquet file>]")
+    print("                                   [--profile <JSON report file>] [--profile_cprofile <pstats file>]")
     
 if __name__ == "__main__":
     main()
\ No newline at end of file
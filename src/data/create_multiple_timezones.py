@@ -20,21 +20,322 @@
 import pandas as pd
 import sqlalchemy as db
 import numpy as np
-from pathlib import Path
 import getopt
 import sys
+import db_access
+import stage_profiler
+import table_cache
+import execution_plan
+
+# Milliseconds in a day, device timestamps are epoch milliseconds
+DAY_MS = 24 * 3600 * 1000
+# start_date and end_date are local dates of an unknown time zone, the study window is widened by a day on each side
+WINDOW_MARGIN_MS = DAY_MS
+
+# Number of device_ids sent to the database in each IN (...) list by --device_pushdown
+DEVICE_ID_BATCH = 500
+
+# Default mapping of the time_zone codes in the survey table to tzcodes.  Can be replaced with --tz_mapping.
+TZ_CODES = {"1" : "America/Puerto_Rico",
+            "2" : "America/New_York",
+            "3" : "America/Chicago",
+            "4" : "America/Denver",
+            "5" : "America/Los_Angeles",
+            "6" : "America/Anchorage",
+            "7" : "Pacific/Honolulu"}
 
 def usage():
     print("Error: Unknow options.  Please run with the correct arguments:")
     print("python create_multiple_timezones.py  --database <database name> --device_source_table <tablename> --survey_source_table <tablename> --survey_col_name <name of col in survey source table that matches 'label' col of device source table> ")
     print("                                         [--mysqlconfig <.my.cnf location>] [--destination_file <full path of output file>] ")
     print("                                         [--tz_default <default for missing time zone data>] [--participant_input <path to participant file CSV>] [--participant_output <desired path for modified participant CSV>]")
+    print("                                         [--device_pushdown] [--chunksize <rows per fetch>] [--db_url <SQLAlchemy URL used instead of the MySQL connection>]")
+    print("                                         [--tz_mapping <CSV with time_zone,tzcode columns>] [--tz_output <rows|transitions>] [--survey_time_col <name of col with the time of each survey response>]")
+    print("                                         [--profile <JSON report file>] [--profile_cprofile <pstats file>]")
+    print("                                         [--cache_dir <table cache folder>] [--cache_max_mb <MB>] [--refresh] [--memory-budget <MB>] [--plan]")
+
+
+
+# Return one row per device_id for the rows of df that list several device_ids separated by ';'
+def explode_device_ids(df):
+    multi_id_df = df[df["device_id"].str.contains(";", regex=False)]
+    return multi_id_df.assign(device_id=multi_id_df["device_id"].str.split(";")).explode("device_id")
+
+
+# Read the device_id and timestamp of the device_source_table rows belonging to device_ids.  The device_ids are sent to
+# the database in batches so only the needed rows are returned, and the rows are fetched with a server-side cursor in
+# chunks of chunksize rows.  schema names the database of device_source_table when it isn't the engine's.
+def read_device_timestamps(engine, device_source_table, device_ids, chunksize, schema=None):
+    chunks = list(stream_device_timestamps(engine, device_source_table, device_ids, chunksize, schema))
+    if (len(chunks) == 0):
+        return pd.DataFrame(columns=['device_id', 'timestamp'])
+    return pd.concat(chunks, ignore_index=True)
+
+
+# Yield the device_id and timestamp rows read by read_device_timestamps chunk by chunk, all rows of the table when
+# device_ids is None
+def stream_device_timestamps(engine, device_source_table, device_ids, chunksize, schema=None):
+    device_table = db.table(device_source_table, db.column('device_id'), db.column('timestamp'), schema=schema)
+    if (device_ids is None):
+        yield from db_access.stream_query(engine, db.select(device_table.c.device_id, device_table.c.timestamp), chunksize)
+        return
+    device_ids = sorted(device_ids)
+    for start in range(0, len(device_ids), DEVICE_ID_BATCH):
+        query = db.select(device_table.c.device_id, device_table.c.timestamp).where(device_table.c.device_id.in_(device_ids[start:start + DEVICE_ID_BATCH]))
+        yield from db_access.stream_query(engine, query, chunksize)
+
+
+# The earliest timestamp of each of device_ids in device_source_table, with the device's number of rows in device_rows
+# (as first_device_timestamps returns them).  The grouping runs on the database server, so one row per device is fetched
+# whatever the number of rows of the devices.
+def read_first_device_timestamps(engine, device_source_table, device_ids, chunksize, schema=None):
+    device_table = db.table(device_source_table, db.column('device_id'), db.column('timestamp'), schema=schema)
+    device_ids = sorted(device_ids)
+    chunks = []
+    for start in range(0, len(device_ids), DEVICE_ID_BATCH):
+        query = (db.select(device_table.c.device_id, db.func.min(device_table.c.timestamp).label('timestamp'), db.func.count().label('device_rows'))
+                 .where(device_table.c.device_id.in_(device_ids[start:start + DEVICE_ID_BATCH])).group_by(device_table.c.device_id))
+        chunks.append(db_access.read_query(engine, query, chunksize, columns=['device_id', 'timestamp', 'device_rows']))
+    if (len(chunks) == 0):
+        return pd.DataFrame({"device_id" : pd.Series(dtype=object), "timestamp" : pd.Series(dtype='float64'), "device_rows" : pd.Series(dtype='int64')})
+    return pd.concat(chunks, ignore_index=True).astype({'device_rows' : 'int64'})
+
+
+# Reduce device_id, timestamp chunks to the first row of each device_id (in table order), with the device's number of
+# rows in device_rows.  The TZCODES file keeps one row per device (the first one), so this is all create_timezones needs
+# from a device table too large to load.
+def first_device_timestamps(chunks):
+    first_rows = pd.DataFrame(columns=['device_id', 'timestamp'])
+    device_rows = pd.Series(dtype='int64')
+    for chunk in chunks:
+        device_rows = device_rows.add(chunk['device_id'].value_counts(), fill_value=0)
+        chunk = chunk.drop_duplicates('device_id', keep='first')
+        first_rows = pd.concat([first_rows, chunk], ignore_index=True).drop_duplicates('device_id', keep='first') if len(first_rows) > 0 else chunk
+    return first_rows.assign(device_rows=first_rows['device_id'].map(device_rows).astype('int64'))
+
+
+# Estimate the size of the device_id and timestamp columns of device_source_table and choose how to read them: "memory"
+# when the estimate fits memory_budget bytes, "streaming" (first_device_timestamps) otherwise
+def plan_device_read(engine, device_source_table, memory_budget, schema=None):
+    estimate = execution_plan.estimate_table(engine, device_source_table, ['device_id', 'timestamp'], schema)
+    return estimate, execution_plan.choose_strategy([estimate], memory_budget)
+
+
+# Survey time_zone values as mapping keys.  Codes read as floats (because of missing values) lose their ".0".
+def survey_code(value):
+    if (isinstance(value, float) and value.is_integer()):
+        return str(int(value))
+    return str(value).strip()
+
+
+# Read a --tz_mapping CSV file with time_zone and tzcode columns into a mapping dictionary
+def read_tz_mapping(mapping_file):
+    mapping_df = pd.read_csv(mapping_file, dtype=str)
+    return dict(zip(mapping_df['time_zone'].map(survey_code), mapping_df['tzcode'].str.strip()))
+
+
+# Map survey time_zone codes to tzcodes, 'TBD' where the code is missing or not in tz_mapping.
+# The lookup is done once per distinct code through a categorical instead of once per row.
+def tzcodes_from_survey(time_zone, tz_mapping):
+    codes = time_zone.astype('category')
+    lookup = {code : tz_mapping.get(survey_code(code), 'TBD') for code in codes.cat.categories}
+    return codes.map(lookup).astype(object).fillna('TBD')
+
+
+# Keep only the rows where a device's tzcode changes: the first row of each device and every row whose tzcode differs
+# from the device's previous row in timestamp order.  Only used with survey_time_col, the one case where a device has
+# several rows (one per survey response it has rows under).
+def collapse_tz_transitions(df):
+    df = df.sort_values(['device_id', 'timestamp'], kind='stable')
+    changed = (df['device_id'] != df['device_id'].shift()) | (df['tzcode'] != df['tzcode'].shift())
+    return df[changed]
+
+
+# Return a boolean Series that is True for rows where every ';' separated id in device_ids is in valid_ids
+def all_device_ids_in(device_ids, valid_ids):
+    return device_ids.str.split(";").explode().isin(valid_ids).groupby(level=0).all()
+
+
+# Times as epoch milliseconds (the unit of aware_device timestamps), NaN where missing.  Numbers are taken as epoch
+# milliseconds (epoch seconds when they are too small to be milliseconds), text as UTC dates or date times.
+def epoch_ms(values):
+    if (pd.api.types.is_numeric_dtype(values)):
+        values = values.astype('float64')
+        return values.where(values.abs() >= 1e11, values * 1000)
+    times = pd.to_datetime(values, utc=True, format="mixed", errors="coerce")
+    return (times - pd.Timestamp(0, tz="UTC")) / pd.Timedelta(milliseconds=1)
+
+
+# One row per device_id of participant_df and survey response of its participant: device_id, label, time_zone,
+# survey_response (the response's rank in time for the device) and response_from, the epoch ms from which the response
+# is in effect.  The first response is in effect from the start, so rows before it take the earliest known time zone.
+# A participant without responses gets one row with a missing time_zone.  window_start and window_end bound the
+# participant's study from start_date to the end of end_date (with WINDOW_MARGIN_MS), unbounded when the participant
+# file has no dates.
+def survey_intervals(participant_df, survey_df, survey_col_name, survey_time_col):
+    participants = participant_df[['label', 'device_id']].assign(
+        window_start=epoch_ms(participant_df['start_date']) - WINDOW_MARGIN_MS if 'start_date' in participant_df else np.nan,
+        window_end=epoch_ms(participant_df['end_date']) + DAY_MS + WINDOW_MARGIN_MS if 'end_date' in participant_df else np.nan)
+    participants = participants.assign(device_id=participants['device_id'].str.split(";")).explode("device_id")
+    responses = pd.DataFrame({"label" : survey_df[survey_col_name], "time_zone" : survey_df['time_zone'], "response_from" : epoch_ms(survey_df[survey_time_col])})
+    intervals = pd.merge(participants, responses, on='label', how='left')
+    intervals = intervals.sort_values(['device_id', 'response_from'], kind='stable', na_position='first')
+    intervals['survey_response'] = intervals.groupby('device_id').cumcount()
+    # Responses without a time sort first, only the first of them can be placed (from the start)
+    intervals = intervals[(intervals['survey_response'] == 0) | intervals['response_from'].notna()]
+    intervals['response_from'] = intervals['response_from'].where(intervals['survey_response'] > 0, -np.inf)
+    intervals['window_start'] = intervals['window_start'].fillna(-np.inf)
+    intervals['window_end'] = intervals['window_end'].fillna(np.inf)
+    return intervals.reset_index(drop=True)
+
+
+# Attach each device_id, timestamp row of the chunks to the survey response in effect at its timestamp (an as-of join
+# on intervals, see survey_intervals), dropping rows outside the participant's study window, and reduce them to the
+# first timestamp of each device and response with the number of rows it stands for in device_rows.  Each chunk is
+# joined on its own, so no more than a chunk's rows are ever joined.
+def first_interval_timestamps(chunks, intervals):
+    keys = intervals[['device_id', 'survey_response', 'response_from', 'window_start', 'window_end']].sort_values('response_from', kind='stable')
+    reduced = []
+    for chunk in chunks:
+        chunk = chunk[chunk['device_id'].isin(keys['device_id'])].dropna(subset=['timestamp'])
+        chunk = chunk.assign(asof_time=chunk['timestamp'].astype('float64')).sort_values('asof_time', kind='stable')
+        matched = pd.merge_asof(chunk, keys, left_on='asof_time', right_on='response_from', by='device_id', direction='backward')
+        matched = matched[(matched['asof_time'] >= matched['window_start']) & (matched['asof_time'] < matched['window_end'])]
+        reduced.append(matched.groupby(['device_id', 'survey_response'], as_index=False).agg(timestamp=('timestamp', 'min'), device_rows=('timestamp', 'size')))
+    if (len(reduced) == 0):
+        reduced = [pd.DataFrame({"device_id" : pd.Series(dtype=object), "survey_response" : pd.Series(dtype='int64'), "timestamp" : pd.Series(dtype='float64'), "device_rows" : pd.Series(dtype='int64')})]
+    first_rows = pd.concat(reduced, ignore_index=True).groupby(['device_id', 'survey_response'], as_index=False).agg(timestamp=('timestamp', 'min'), device_rows=('device_rows', 'sum'))
+    first_rows = pd.merge(first_rows, intervals[['device_id', 'survey_response', 'label', 'time_zone']], on=['device_id', 'survey_response'], how='left')
+    return first_rows.sort_values(['device_id', 'timestamp'], kind='stable').reset_index(drop=True)
+
+
+# Build the TZCODES rows (device_id, tzcode, timestamp) for the participants in participant_df from the survey and
+# device tables, following options (the same keys as the command line options, with "strategy" the plan_device_read
+# choice for the device table).  The tables are read through tables (a table_cache.TableCache) from schema, the
+# engine's database when None; a streamed device table bypasses the cache.  With survey_time_col each device row is
+# joined to the survey response in effect at its time within the participant's study window (first_interval_timestamps)
+# and a device gets a row for every response it has rows under.  Returns the TZCODES DataFrame, the
+# participants that have time zone data when tz_default is "remove" (None otherwise) and a message for the user.
+def create_timezones(engine, participant_df, options, profiler, tables, schema=None):
+    # create PANDAS dataframes from SQL tables
+    with profiler.stage("read_survey_table") as stage:
+        survey_df = tables.read(engine, options["survey_source_table"], None, lambda: pd.read_sql_table(options["survey_source_table"], engine, schema=schema), schema) # particiapt label, time_zone integer
+        stage["rows"] = len(survey_df)
+
+    interval_join = options.get("survey_time_col") is not None
+    if (interval_join):
+        # One row per device_id and survey response with the time the response takes effect
+        with profiler.stage("survey_intervals", rows=len(participant_df)):
+            joined_nostamp_df = survey_intervals(participant_df, survey_df, options["survey_col_name"], options["survey_time_col"])
+    else:
+        # Create table with device_id, participant label, and time_zone integer
+        with profiler.stage("explode_device_ids", rows=len(participant_df)):
+            joined_nostamp_df = pd.merge(participant_df, survey_df, left_on="label", right_on=options["survey_col_name"], how='left')
+
+            # Address the fact that some rows in joined_nostamp_df have multiple device_ids per row by creating a dataframe with one row per device_id which is then appended to joined_nostamp_df. Duplicates deleted later. 
+            joined_nostamp_df = pd.concat([joined_nostamp_df, explode_device_ids(joined_nostamp_df)])
+
+    # device_id, timestamp.  With --device_pushdown only the rows of the participants' devices are pulled from the database
+    # (and the table cache isn't used), without survey_time_col only their earliest timestamp.
+    with profiler.stage("read_device_table") as stage:
+        device_ids = None
+        if (options["device_pushdown"]):
+            device_ids = set(joined_nostamp_df['device_id'][~joined_nostamp_df['device_id'].str.contains(';', regex=False)])
+        if (interval_join):
+            if (options.get("strategy", "memory") == "streaming"):
+                chunks = stream_device_timestamps(engine, options["device_source_table"], device_ids, options["chunksize"], schema)
+            elif (options["device_pushdown"]):
+                chunks = [read_device_timestamps(engine, options["device_source_table"], device_ids, options["chunksize"], schema)]
+            else:
+                chunks = [tables.read(engine, options["device_source_table"], ['device_id', 'timestamp'],
+                                      lambda: pd.read_sql_table(options["device_source_table"], engine, schema=schema, columns=['device_id', 'timestamp']), schema)]
+            device_df = first_interval_timestamps(chunks, joined_nostamp_df)
+        elif (options["device_pushdown"]):
+            device_df = read_first_device_timestamps(engine, options["device_source_table"], device_ids, options["chunksize"], schema)
+        elif (options.get("strategy", "memory") == "streaming"):
+            device_df = first_device_timestamps(stream_device_timestamps(engine, options["device_source_table"], device_ids, options["chunksize"], schema))
+        else:
+            device_df = tables.read(engine, options["device_source_table"], ['device_id', 'timestamp'],
+                                    lambda: pd.read_sql_table(options["device_source_table"], engine, schema=schema, columns=['device_id', 'timestamp']), schema)
+        stage["rows"] = len(device_df)
+    
+    # Adds timestamp data from device_df (already joined to the survey responses with survey_time_col)
+    if (interval_join):
+        joined_df = device_df
+    else:
+        with profiler.stage("merge_timestamps") as stage:
+            joined_df = pd.merge(joined_nostamp_df, device_df, how='left', on='device_id') 
+            stage["rows"] = len(joined_df)
+    # A device keeps its first row, with survey_time_col its first row under each survey response
+    first_row_key = ['device_id', 'survey_response'] if interval_join else ['device_id']
+
+    # Column tzcode is populated with tz codes based on value of time_zone
+    with profiler.stage("map_tzcodes", rows=len(joined_df)):
+        joined_df['tzcode'] = tzcodes_from_survey(joined_df['time_zone'], options["tz_mapping"])
+
+    with profiler.stage("apply_tz_default", rows=len(joined_df)):
+        modified_participant_df = None
+        # tz_default option applied in following if loop:
+        # Remove participants from participant CSV file that do not have time zone data. Create multiple_timezone.csv including only remaining participants. 
+        if options["tz_default"] == "remove": 
+
+            # Create a set of the device_ids that have a time zone specified in the survey data (a code found in the mapping)
+            survey_with_tz = survey_df[tzcodes_from_survey(survey_df['time_zone'], options["tz_mapping"]).ne('TBD').to_numpy()]
+            ids_with_tz = pd.merge(participant_df, survey_with_tz, left_on="label", right_on=options["survey_col_name"])
+            ids_with_tz = set(ids_with_tz['device_id'].str.split(';').explode())
+
+            # Remove rows from particiant_df where there is a device_id without a time zone code
+            modified_participant_df = participant_df[all_device_ids_in(participant_df['device_id'], ids_with_tz)]
+
+            # Remove rows from joined_df where there is a device_id without a time zone code, and the rows of survey
+            # responses without one
+            joined_df = joined_df[joined_df['tzcode'].ne('TBD')]
+            joined_df = joined_df[all_device_ids_in(joined_df['device_id'], ids_with_tz)]
+            joined_df = joined_df.drop_duplicates(first_row_key, keep='first')
+        
+            message = "A new participant CSV file has been saved as " + options["participant_output"] + ". Indicate this location in config.yaml under [CREATE_PARTICIPANT_FILES][CSV_FILE_PATH] before creating participant files with RAPIDS."
+
+        # Simply print how many participants there are in the participant file with missing time zone data. 
+        elif options["tz_default"] == "ignore": 
+
+            #Checks to see if there are any participants with missing tzcodes. 
+            if (joined_df["tzcode"].eq('TBD')).any() == True:
+                # A streamed device table has one row per device, device_rows counts the rows it stands for
+                missing_rows = joined_df.loc[joined_df["tzcode"].eq('TBD'), "device_rows"].fillna(1).sum() if "device_rows" in joined_df else joined_df["tzcode"].eq('TBD').sum()
+                message = "There were " + str(int(missing_rows)) + " participants with missing tz codes. You will need to change values of [IF_MISSING_TZCODE] and/or [DEFAULT_TZCODE] under [TIMEZONE][MULTIPLE] in config.yaml. Refer to https://www.rapids.science/1.9/setup/configuration/#timezone-of-your-study for reference."
+                joined_df = joined_df[joined_df.tzcode != 'TBD']
+            else:
+                message = "There were no participants with missing tz codes."
+        
+            #Drop duplicate rows which occurs for participants that responded to the study survey multiple times
+            joined_df = joined_df.drop_duplicates(first_row_key, keep='first')
+
+        # Fills missing tzcodes with custom value from user
+        else:
+            joined_df['tzcode'] = np.where(joined_df['tzcode'].str.startswith('TBD'), options['tz_default'], joined_df['tzcode'])
+            message = "You selected to use a time zone of '" + options['tz_default'] + "' for any participants that do not have time zone data."
+
+            # Drop duplicate rows which occurs for participants that responded to the study survey multiple times
+            joined_df = joined_df.drop_duplicates(first_row_key, keep='first')
+    
+    # Removes rows with multiple device_ids per row which were already used to create new rows with one device_id per row earlier
+    joined_df = joined_df.dropna(subset=['timestamp'])
+
+    # A dataframe is created with the columns of interest for RAPIDS
+    final_df = joined_df[['device_id', 'tzcode', 'timestamp']]
+    if (options["tz_output"] == "transitions" and not interval_join):
+        # Without survey_time_col every device already has a single row, there is nothing to collapse
+        print("--tz_output transitions has no effect without --survey_time_col, each device keeps its one row.")
+    elif (options["tz_output"] == "transitions"):
+        with profiler.stage("collapse_tz_transitions", rows=len(final_df)):
+            final_df = collapse_tz_transitions(final_df)
+    return final_df, modified_participant_df, message
 
 
 def main():
 
     try:
-        optlist, args = getopt.getopt(sys.argv[1:], "", ["mysqlconfig=", "database=", "device_source_table=", "survey_source_table=", "survey_col_name=", "destination_file=", "tz_default=", "participant_input=", "participant_output="])
+        optlist, args = getopt.getopt(sys.argv[1:], "", ["mysqlconfig=", "database=", "device_source_table=", "survey_source_table=", "survey_col_name=", "destination_file=", "tz_default=", "participant_input=", "participant_output=", "device_pushdown", "chunksize=", "db_url=", "tz_mapping=", "tz_output=", "survey_time_col=", "profile=", "profile_cprofile=", "cache_dir=", "cache_max_mb=", "refresh", "memory-budget=", "plan"])
     except getopt.GetoptError as err:
         print(err)
         usage()
@@ -43,11 +344,24 @@ def main():
     # Set default options
     print("Creating multiple_timezones.csv...")    
     options = {}
-    options["mysqlconfig"] = str(str(Path.home()) + '/.my.cnf')
+    options["mysqlconfig"] = db_access.DEFAULT_MYSQLCONFIG
+    options["db_url"] = None
     options["destination_file"] = "../../../data/external/multiple_timezones.csv"
     options["tz_default"] = "remove"
     options["participant_input"] = "../../../data/external/participant_file.csv"
     options["participant_output"] = "../../../data/external/participant_file_modified.csv"
+    options["device_pushdown"] = False
+    options["chunksize"] = 50000
+    options["tz_mapping"] = TZ_CODES
+    options["tz_output"] = "rows"
+    options["survey_time_col"] = None
+    options["profile"] = None
+    options["profile_cprofile"] = None
+    options["cache_dir"] = None
+    options["cache_max_mb"] = table_cache.DEFAULT_CACHE_MAX_MB
+    options["refresh"] = False
+    options["memory_budget"] = execution_plan.DEFAULT_MEMORY_BUDGET_MB
+    options["plan"] = False
     
     # OVERRIDE GENERAL DEFAULTS WITH COMMAND LINE ARGUMENTS
     for option_tuple in optlist:    
@@ -69,116 +383,70 @@ def main():
             options["participant_input"] = option_tuple[1]
         elif (option_tuple[0] == "--participant_output"):
             options["participant_output"] = option_tuple[1]
+        elif (option_tuple[0] == "--device_pushdown"):
+            options["device_pushdown"] = True
+        elif (option_tuple[0] == "--chunksize"):
+            options["chunksize"] = int(option_tuple[1])
+        elif (option_tuple[0] == "--db_url"):
+            options["db_url"] = option_tuple[1]
+        elif (option_tuple[0] == "--tz_mapping"):
+            options["tz_mapping"] = read_tz_mapping(option_tuple[1])
+        elif (option_tuple[0] == "--tz_output"):
+            options["tz_output"] = option_tuple[1]
+        elif (option_tuple[0] == "--survey_time_col"):
+            options["survey_time_col"] = option_tuple[1]
+        elif (option_tuple[0] == "--profile"):
+            options["profile"] = option_tuple[1]
+        elif (option_tuple[0] == "--profile_cprofile"):
+            options["profile_cprofile"] = option_tuple[1]
+        elif (option_tuple[0] == "--cache_dir"):
+            options["cache_dir"] = option_tuple[1]
+        elif (option_tuple[0] == "--cache_max_mb"):
+            options["cache_max_mb"] = int(option_tuple[1])
+        elif (option_tuple[0] == "--refresh"):
+            options["refresh"] = True
+        elif (option_tuple[0] == "--memory-budget"):
+            options["memory_budget"] = int(option_tuple[1])
+        elif (option_tuple[0] == "--plan"):
+            options["plan"] = True
 
     if (not "database" in options or not "device_source_table" in options or not "survey_source_table" in options or not "survey_col_name" in options):
         usage()
         exit(2)    
 
-    # Force Connection type by using Loopback IP address.
-    myDB = db.engine.URL.create(drivername="mysql", host="127.0.0.1", database = options["database"], query={"read_default_file" : options["mysqlconfig"]})
-
-    # engine = db.create_engine(name_or_url=myDB, pool_pre_ping=True)            
-    engine = db.create_engine(myDB, pool_pre_ping=True)
-
-    # create PANDAS dataframes from SQL tables
-    survey_df = pd.read_sql_table(options["survey_source_table"], engine) # particiapt label, time_zone integer
-    participant_df = pd.read_csv(options["participant_input"]) #  participant label, device_id
-    device_df = pd.read_sql_table(options["device_source_table"], engine, columns=['device_id', 'timestamp']) # device_id, timestamp
-
-    # Create table with device_id, participant label, and time_zone integer
-    joined_nostamp_df = pd.merge(participant_df, survey_df, left_on="label", right_on=options["survey_col_name"], how='left')
-
-    # Address the fact that some rows in joined_nostamp_df have multiple device_ids per row by creating a dataframe with one row per device_id which is then appended to joined_nostamp_df. Duplicates deleted later. 
-    to_add_df = pd.DataFrame(columns=list(joined_nostamp_df.columns))
-    for index, row in joined_nostamp_df.iterrows():
-        id_list = row["device_id"].split(';')
-        if len(id_list) > 1:
-            for id in id_list:
-                to_add_df = to_add_df.append({'device_id' : id, 'pid' : row['pid'], 'label' : row['label'], 'platform' : row['platform'], 'start_date' : row['start_date'], 'end_date' : row['end_date'], 'eid' : row['eid'], 'time_zone' : row['time_zone'], 'time_zone_text' : row['time_zone_text']}, ignore_index = True)
-        else:
-            pass
-    joined_nostamp_df = joined_nostamp_df.append(to_add_df)
-    
-    # Adds timestamp data from device_df 
-    joined_df = pd.merge(joined_nostamp_df, device_df, how='left', on='device_id') 
+    profiler = stage_profiler.StageProfiler("create_multiple_timezones", options["profile"], options["profile_cprofile"])
+    engine = db_access.create_db_engine(options["database"], options["mysqlconfig"], options["db_url"])
+    tables = table_cache.TableCache(options["cache_dir"], options["cache_max_mb"], options["refresh"])
 
-    # time_zone integers converted to strings
-    joined_df['time_zone'] = joined_df['time_zone'].astype(str)
+    # A device table whose estimated working set doesn't fit in --memory-budget is streamed
+    with profiler.stage("plan"):
+        estimate, options["strategy"] = plan_device_read(engine, options["device_source_table"], options["memory_budget"] * 1024 * 1024)
+    if (options["plan"]):
+        execution_plan.print_plan("create_multiple_timezones.py", [("read_device_table", [estimate], options["strategy"], "only the participants' devices" if options["device_pushdown"] else None)],
+                                  options["memory_budget"] * 1024 * 1024)
+        db_access.print_query_stats(engine)
+        profiler.finish()
+        return
+    if (options["strategy"] == "streaming"):
+        print("The " + options["device_source_table"] + " table doesn't fit in the memory budget (" + execution_plan.describe(estimate) + "), streaming it.")
 
-    # Column tzcode is populated with tz codes based on value of time_zone
-    joined_df['tzcode'] = np.where(joined_df['time_zone'].str.startswith('1'), 'America/Puerto_Rico', 'TBD')
-    joined_df['tzcode'] = np.where(joined_df['time_zone'].str.startswith('2'), 'America/New_York', joined_df['tzcode'])
-    joined_df['tzcode'] = np.where(joined_df['time_zone'].str.startswith('3'), 'America/Chicago', joined_df['tzcode'])
-    joined_df['tzcode'] = np.where(joined_df['time_zone'].str.startswith('4'), 'America/Denver', joined_df['tzcode'])
-    joined_df['tzcode'] = np.where(joined_df['time_zone'].str.startswith('5'), 'America/Los_Angeles', joined_df['tzcode'])
-    joined_df['tzcode'] = np.where(joined_df['time_zone'].str.startswith('6'), 'America/Anchorage', joined_df['tzcode'])
-    joined_df['tzcode'] = np.where(joined_df['time_zone'].str.startswith('7'), 'Pacific/Honolulu', joined_df['tzcode'])
-
-    # tz_default option applied in following if loop:
-    # Remove participants from participant CSV file that do not have time zone data. Create multiple_timezone.csv including only remaining participants. 
-    if options["tz_default"] == "remove": 
-
-        # Create df that acts as a reference of device_ids that have a time zone specified in the survey data
-        ids_with_tz = pd.merge(participant_df, survey_df, left_on="label", right_on=options["survey_col_name"])
-
-        # Remove rows from particiant_df where there is a device_id without a time zone code
-        participant_df['drop_bool'] = 0
-        for index, row in participant_df.iterrows():
-            id_list = row["device_id"].split(';')
-            for id in id_list:
-                if ids_with_tz['device_id'].str.contains(id).any() == False: # now I need to make it so that it checks a dataframe or list of ids that isn't all of participant ids 
-                    participant_df.loc[index, 'drop_bool'] += 1
-                else:
-                    pass
-        participant_df = participant_df[participant_df['drop_bool'] == 0]
-        participant_df = participant_df.drop('drop_bool', axis = 1)
-
-        # Create new participant file with only participants that have time zones specified in the survey table
-        participant_df.to_csv(options["participant_output"], index=False)
-
-        # Remove rows from joined_df where there is a device_id without a time zone code
-        joined_df['drop_bool'] = 0
-        for index, row in joined_df.iterrows():
-            id_list = row["device_id"].split(';')
-            for id in id_list:
-                if ids_with_tz['device_id'].str.contains(id).any() == False: # now I need to make it so that it checks a dataframe or list of ids that isn't all of joined ids 
-                    joined_df.loc[index, 'drop_bool'] += 1
-                else:
-                    pass
-        joined_df = joined_df[joined_df['drop_bool'] == 0]
-        joined_df = joined_df.drop('drop_bool', axis = 1).drop_duplicates(['device_id'], keep='first')
-        
-        message = "A new participant CSV file has been saved as " + options["destination_file"] + ". Indicate this location in config.yaml under [CREATE_PARTICIPANT_FILES][CSV_FILE_PATH] before creating participant files with RAPIDS."
+    with profiler.stage("read_participant_file") as stage:
+        participant_df = pd.read_csv(options["participant_input"]) #  participant label, device_id
+        stage["rows"] = len(participant_df)
+    final_df, modified_participant_df, message = create_timezones(engine, participant_df, options, profiler, tables)
 
-    # Simply print how many participants there are in the participant file with missing time zone data. 
-    elif options["tz_default"] == "ignore": 
+    # Create new participant file with only participants that have time zones specified in the survey table
+    if (modified_participant_df is not None):
+        with profiler.stage("write_participant_file", rows=len(modified_participant_df)):
+            modified_participant_df.to_csv(options["participant_output"], index=False)
 
-        #Checks to see if there are any participants with missing tzcodes. 
-        if (joined_df["tzcode"].eq('TBD')).any() == True:
-            message = "There were " + str(joined_df["tzcode"].eq('TBD').sum()) + " participants with missing tz codes. You will need to change values of [IF_MISSING_TZCODE] and/or [DEFAULT_TZCODE] under [TIMEZONE][MULTIPLE] in config.yaml. Refer to https://www.rapids.science/1.9/setup/configuration/#timezone-of-your-study for reference."
-            joined_df = joined_df[joined_df.tzcode != 'TBD']
-        else:
-            message = "There were no participants with missing tz codes."
-        
-        #Drop duplicate rows which occurs for participants that responded to the study survey multiple times
-        joined_df = joined_df.drop_duplicates(['device_id'], keep='first')
-
-    # Fills missing tzcodes with custom value from user
-    else:
-        joined_df['tzcode'] = np.where(joined_df['tzcode'].str.startswith('TBD'), options['tz_default'], joined_df['tzcode'])
-        message = "You selected to use a time zone of '" + options['tz_default'] + "' for any participants that do not have time zone data."
-
-        # Drop duplicate rows which occurs for participants that responded to the study survey multiple times
-        joined_df = joined_df.drop_duplicates(['device_id'], keep='first')
-    
-    # Removes rows with multiple device_ids per row which were already used to create new rows with one device_id per row earlier
-    joined_df = joined_df.dropna(subset=['timestamp'])
-
-    # A dataframe is created with the columns of interest for RAPIDS and is exported as a csv with path specified by options["destination_file"]
-    final_df = joined_df[['device_id', 'tzcode', 'timestamp']]
-    final_df.to_csv(options["destination_file"], index=False)
+    # The TZCODES rows are exported as a csv with path specified by options["destination_file"]
+    with profiler.stage("write_tzcodes_file", rows=len(final_df)):
+        final_df.to_csv(options["destination_file"], index=False)
     print(message)
     print("Created " + options["destination_file"] + ". Please change file path field in [TIMEZONE][TZCODES_FILE] config.yaml as needed.")
+    db_access.print_query_stats(engine)
+    profiler.finish()
 
 if __name__ == "__main__":
 
@@ -16,22 +16,104 @@ import sys
 import os
 import getopt
 import datetime as dt
-from pathlib import Path
 import sqlalchemy as db
 import pandas as pd
+import numpy as np
 import csv
+import db_access
+import stage_profiler
+import table_cache
+import execution_plan
+
+# Rapids participant aware_csv file format:
+#   device_id,fitbit_id,empatica_id,pid,label,platform,start_date,end_date
+# From Sal Requirements:
+#   device_id a list of device-ids per person separated with ;
+#   platform will be either ios or android
+#   pid the label column from aware_device
+#   label the label column for aware_device
+PARTICIPANT_COLUMNS = ["device_id","fitbit_id","empatica_id","pid","label","platform","start_date","end_date"]
+# aware_device columns the participant file is built from
+DEVICE_COLUMNS = ["device_id", "label", "model", "timestamp"]
 
 def usage():
     print("Error: Unknow options.  Please run the following to set the environment and correct arguments:")
     print("conda activate rapids_r4_0")
     print("python create_rapids_participant_file.py  --database <database name> --source_table <tablename> ")
-    print("                                         [--mysqlconfig <.my.cnf location>] [--destination_file <full path of output file>]")
+    print("                                         [--mysqlconfig <.my.cnf location>] [--destination_file <full path of output file>] [--chunksize <rows per fetch>]")
+    print("                                         [--db_url <SQLAlchemy URL used instead of the MySQL connection>] [--profile <JSON report file>] [--profile_cprofile <pstats file>]")
+    print("                                         [--cache_dir <table cache folder>] [--cache_max_mb <MB>] [--refresh] [--memory-budget <MB>] [--plan]")
     
+
+# Read the aware_device rows of source_table.  Only the columns needed for the participant file are selected, and rows
+# are streamed in chunks of chunksize rows.  The snapshot in tables (a table_cache.TableCache) is used while the table
+# is unchanged.  schema names the database of source_table when it isn't the engine's.
+def read_device_rows(engine, source_table, chunksize, tables, schema=None):
+    data_table = db.table(str(source_table), *[db.column(column) for column in DEVICE_COLUMNS], schema=schema)
+    query = db.select(*data_table.c)
+    return tables.read(engine, str(source_table), DEVICE_COLUMNS, lambda: db_access.read_query(engine, query, chunksize), schema)
+
+# Streaming version of read_device_rows for tables too large to load: the rows are reduced chunk by chunk to one row per
+# participant (the label's first row, with all of its device_ids joined with ';'), which build_participants turns into
+# the same participant rows as the whole table.  The table cache isn't used.  Returns the rows and the number of
+# aware_device rows read.
+def stream_device_participants(engine, source_table, chunksize, schema=None):
+    data_table = db.table(str(source_table), *[db.column(column) for column in DEVICE_COLUMNS], schema=schema)
+    reduced = pd.DataFrame(columns=DEVICE_COLUMNS)
+    rows = 0
+    for chunk in db_access.stream_query(engine, db.select(*data_table.c), chunksize):
+        rows = rows + len(chunk)
+        chunk = chunk.assign(label=normalize_labels(chunk["label"]))
+        combined = pd.concat([reduced, chunk], ignore_index=True) if len(reduced) > 0 else chunk
+        device_ids = combined.groupby("label", sort=False)["device_id"].agg(";".join)
+        reduced = combined.drop_duplicates("label", keep="first").set_index("label")
+        reduced["device_id"] = device_ids
+        reduced = reduced.reset_index()[DEVICE_COLUMNS]
+    return reduced, rows
+
+# Estimate the size of the aware_device columns read from source_table and choose how to read them: "memory"
+# (read_device_rows) when the estimate fits memory_budget bytes, "streaming" (stream_device_participants) otherwise
+def plan_device_read(engine, source_table, memory_budget, schema=None):
+    estimate = execution_plan.estimate_table(engine, str(source_table), DEVICE_COLUMNS, schema)
+    return estimate, execution_plan.choose_strategy([estimate], memory_budget)
+
+# Participant labels with the characters RAPIDS can't handle replaced
+def normalize_labels(labels):
+    return labels.fillna("None").astype(str).str.replace("'","_apostrophe_").str.replace("’","_fancyapostrophe_").str.replace(" ","_space_")
+
+# Build the participant file rows (PARTICIPANT_COLUMNS) from the aware_device rows in df, with end_date set to now.
+# Participants are keyed by their label, with characters RAPIDS can't handle replaced.  The first row of a label gives
+# the participant's platform and start date, and all of its device_ids are joined with ';'
+def build_participants(df, now):
+    df = df.assign(label=normalize_labels(df["label"]))
+    participants = df.drop_duplicates("label", keep="first").set_index("label")
+    participants["device_id"] = df.groupby("label", sort=False)["device_id"].agg(";".join)
+    participants["fitbit_id"] = ""
+    participants["empatica_id"] = ""
+    participants["pid"] = participants.index.str.rstrip()
+    participants["label"] = participants["pid"]
+    participants["platform"] = np.where(participants["model"] == "iPhone", "ios", "android")
+    participants["start_date"] = [dt.datetime.fromtimestamp(int(timestamp//1000)).strftime("%Y-%m-%d") for timestamp in participants["timestamp"]]
+    participants["end_date"] = now.strftime("%Y-%m-%d")
+    return participants[PARTICIPANT_COLUMNS].reset_index(drop=True)
+
+# Write the participant rows to destination_file, creating its directory if needed.  Returns the number of rows written.
+def write_participant_file(participants, destination_file):
+    path,filename = os.path.split(destination_file)
+    # If output directory doesn't exist... make it.
+    if path != "" and not os.path.exists(path):
+        print("Warning - directory: "+path+ " does not exist.  Creating it.")
+        os.makedirs(path)
+    with open(destination_file,'w') as csvout:
+        writer = csv.writer(csvout,delimiter=',')
+        writer.writerow(PARTICIPANT_COLUMNS)
+        writer.writerows(participants[PARTICIPANT_COLUMNS].itertuples(index=False, name=None))
+    return len(participants)
     
 def main():
 
     try:
-        optlist, args = getopt.getopt(sys.argv[1:], "", ["mysqlconfig=", "database=", "source_table=", "destination_file="])
+        optlist, args = getopt.getopt(sys.argv[1:], "", ["mysqlconfig=", "database=", "source_table=", "destination_file=", "chunksize=", "db_url=", "profile=", "profile_cprofile=", "cache_dir=", "cache_max_mb=", "refresh", "memory-budget=", "plan"])
     except getopt.GetoptError as err:
         print(err)
         usage()
@@ -41,10 +123,19 @@ def main():
     now = dt.datetime.now()
     print("Starting create_rapids_participant_file.py: "+str(now))
     options = {}
-    options["mysqlconfig"] = str(str(Path.home()) + '/.my.cnf')
+    options["mysqlconfig"] = db_access.DEFAULT_MYSQLCONFIG
+    options["db_url"] = None
     #options["database"] = "douglasvbellew"
     #options["source_table"] = 'aware_device_may'
     options["destination_file"] = "../../data/external/participant_data.csv"
+    options["chunksize"] = 50000
+    options["profile"] = None
+    options["profile_cprofile"] = None
+    options["cache_dir"] = None
+    options["cache_max_mb"] = table_cache.DEFAULT_CACHE_MAX_MB
+    options["refresh"] = False
+    options["memory_budget"] = execution_plan.DEFAULT_MEMORY_BUDGET_MB
+    options["plan"] = False
     
     # OVERRIDE GENERAL DEFAULTS WITH COMMAND LINE ARGUMENTS
     for option_tuple in optlist:    
@@ -56,94 +147,70 @@ def main():
             options["source_table"] = option_tuple[1]
         elif (option_tuple[0] == "--destination_file"):
             options["destination_file"] = option_tuple[1]
+        elif (option_tuple[0] == "--chunksize"):
+            options["chunksize"] = int(option_tuple[1])
+        elif (option_tuple[0] == "--db_url"):
+            options["db_url"] = option_tuple[1]
+        elif (option_tuple[0] == "--profile"):
+            options["profile"] = option_tuple[1]
+        elif (option_tuple[0] == "--profile_cprofile"):
+            options["profile_cprofile"] = option_tuple[1]
+        elif (option_tuple[0] == "--cache_dir"):
+            options["cache_dir"] = option_tuple[1]
+        elif (option_tuple[0] == "--cache_max_mb"):
+            options["cache_max_mb"] = int(option_tuple[1])
+        elif (option_tuple[0] == "--refresh"):
+            options["refresh"] = True
+        elif (option_tuple[0] == "--memory-budget"):
+            options["memory_budget"] = int(option_tuple[1])
+        elif (option_tuple[0] == "--plan"):
+            options["plan"] = True
     
     if (not "database" in options or not "source_table" in options):
         usage()
         exit(2)    
         
         
-    # chokes on "localhost" (Possible remote ssh issue?).  Force Connection type by using Loopback IP address.
-    myDB = db.engine.url.URL(drivername="mysql",
-                            host="127.0.0.1",
-                            database = options["database"],
-                            query={"read_default_file" : options["mysqlconfig"]})
-
-    #engine = db.create_engine(name_or_url=myDB, pool_pre_ping=True)            
-    engine = db.create_engine(myDB, pool_pre_ping=True)
-    
-    result_set = {}
-    with engine.connect() as connection:
-        metadata  = db.MetaData()
-        #orig_data = db.Table('kb_test_data', metadata, autoload=True, autoload_with=engine)  
-        data_table = db.Table(str(options["source_table"]), metadata, autoload=True, autoload_with=engine)  
-        #FBCHANGE NO ID COLUMN       
-        #query = db.select([orig_data]).where(orig_data.columns._id > options["last_processed_id"]).offset(options["batches_complete"] * options["batch_fetch"]).limit(options["batch_fetch"])
-        query = db.select([data_table])
-        result_proxy = connection.execute(query)
-        result_set = result_proxy.fetchall()
+    profiler = stage_profiler.StageProfiler("create_rapids_participant_file", options["profile"], options["profile_cprofile"])
+    engine = db_access.create_db_engine(options["database"], options["mysqlconfig"], options["db_url"])
+    tables = table_cache.TableCache(options["cache_dir"], options["cache_max_mb"], options["refresh"])
     
+    # Tables whose estimated working set doesn't fit in --memory-budget are streamed
+    with profiler.stage("plan"):
+        estimate, strategy = plan_device_read(engine, options["source_table"], options["memory_budget"] * 1024 * 1024)
+    if (options["plan"]):
+        execution_plan.print_plan("create_rapids_participant_file.py", [("read_device_table", [estimate], strategy, None)], options["memory_budget"] * 1024 * 1024)
+        db_access.print_query_stats(engine)
+        profiler.finish()
+        return
+    if (strategy == "streaming"):
+        print("The " + options["source_table"] + " table doesn't fit in the memory budget (" + execution_plan.describe(estimate) + "), streaming it.")
+
+    with profiler.stage("read_device_table") as stage:
+        if (strategy == "streaming"):
+            df, rows = stream_device_participants(engine, options["source_table"], options["chunksize"])
+        else:
+            df = read_device_rows(engine, options["source_table"], options["chunksize"], tables)
+            rows = len(df)
+        stage["rows"] = rows
     
-    if (len(result_set) > 0):
+    if (rows > 0):
     # Put Result into PANDAS dataframe
         pd.set_option("max_colwidth",30)
         pd.set_option("large_repr", "truncate")
         pd.set_option("display.width", None)
-        df = pd.DataFrame(result_set)
-        df.columns = result_set[0].keys()
-        print("Retrieved "+ str(len(df))+ " aware_device table rows.")
+        print("Retrieved "+ str(rows)+ " aware_device table rows.")
         
-        participants = {}
-        combined = 0
-        for current_row in range(len(df)):
-            label = str(df.at[current_row, "label"]).replace("'","_apostrophe_").replace("’","_fancyapostrophe_").replace(" ","_space_")
-            if label in participants:
-                participants[label]["device_id"] = participants[label]["device_id"] + ";" + df.at[current_row, "device_id"]
-                combined = combined + 1
-            else:
-                participant = {}
-                participant["device_id"] = df.at[current_row, "device_id"]
-                participant["fitbit_id"] = ""
-                participant["empatica_id"] = ""
-                participant["pid"] = str(df.at[current_row, "label"]).replace("'","_apostrophe_").replace("’","_fancyapostrophe_").replace(" ","_space_").rstrip()
-                participant["label"] = str(df.at[current_row, "label"]).replace("'","_apostrophe_").replace("’","_fancyapostrophe_").replace(" ","_space_").rstrip()
-                if (df.at[current_row, "model"] == "iPhone"):
-                    participant["platform"] = "ios"
-                else:
-                    participant["platform"] = "android"
-                participant["start_date"] =  dt.datetime.fromtimestamp(int(df.at[current_row, "timestamp"]//1000)).strftime("%Y-%m-%d")
-                participant["end_date"] = now.strftime("%Y-%m-%d")
-                participants[label] = participant
+        with profiler.stage("build_participants", rows=len(df)):
+            participants = build_participants(df, now)
+        combined = rows - len(participants)
         print("Combined "+str(combined)+" rows due to label matches")
-        path,filename = os.path.split(options["destination_file"])
-        # If output directory doesn't exist... make it.
-        if not os.path.exists(path):
-            print("Warning - directory: "+path+ " does not exist.  Creating it.")
-            os.makedirs(path)
-            
-        # Rapids participant aware_csv file format:
-        #   device_id,fitbit_id,empatica_id,pid,label,platform,start_date,end_date
-        # From Sal Requirements:
-        #   device_id a list of device-ids per person separated with ;
-        #   platform will be either ios or android
-        #   pid the label column from aware_device
-        #   label the label column for aware_device
-        
-        with open(options["destination_file"],'w') as csvout:
-            writer = csv.writer(csvout,delimiter=',')
-            writer.writerow(["device_id","fitbit_id","empatica_id","pid","label","platform","start_date","end_date"])
-            write_count = 0
-            for participant in participants:
-                write_count = write_count + 1
-                writer.writerow([participants[participant]["device_id"],
-                                participants[participant]["fitbit_id"],
-                                participants[participant]["empatica_id"],
-                                participants[participant]["pid"],
-                                participants[participant]["label"],
-                                participants[participant]["platform"],
-                                participants[participant]["start_date"],
-                                participants[participant]["end_date"]])
-            print("Created "+str(len(participants.keys()))+" participant entries from "+str(len(result_set))+" database entries.")
-            print("Wrote "+str(write_count)+" participant entries.")
+        with profiler.stage("write_participant_file", rows=len(participants)):
+            write_count = write_participant_file(participants, options["destination_file"])
+        print("Created "+str(len(participants))+" participant entries from "+str(rows)+" database entries.")
+        print("Wrote "+str(write_count)+" participant entries.")
+    db_access.print_query_stats(engine)
+    profiler.finish()
 if __name__ == "__main__":
 
     main()
@@ -0,0 +1,192 @@
+##############################################################################
+#
+#  csv_reader.py
+#
+#  Memory-lean reading of RAPIDS raw and feature CSVs for the helper scripts.
+#  Files are parsed with pyarrow's multithreaded CSV reader (pandas' C parser
+#  when pyarrow is not installed) with the column types given up front:
+#  repetitive string columns such as pid and local_segment become
+#  categoricals, float columns can be downcast to float32 and only the
+#  requested columns are converted.  The types of a kind of file (e.g. every
+#  participant's phone_screen.csv) are inferred once and shared by a
+#  CsvSchemaCache, so all participants of a sensor get the same dtypes.
+#  Large files can also be read as a stream of fixed-size chunks.
+#
+################################################################################
+
+import threading
+import pandas as pd
+
+try:
+    import pyarrow as pa
+    import pyarrow.csv as pa_csv
+except ImportError:
+    pa = None
+
+# String columns repeated on many rows of RAPIDS files, read as categoricals
+CATEGORY_COLUMNS = ["device_id", "pid", "local_segment", "local_segment_label"]
+# Strings pd.read_csv reads as missing values by default
+NA_VALUES = ["", "#N/A", "#N/A N/A", "#NA", "-1.#IND", "-1.#QNAN", "-NaN", "-nan", "1.#IND", "1.#QNAN", "<NA>", "N/A", "NA", "NULL",
+             "NaN", "None", "n/a", "nan", "null"]
+# Values pd.read_csv reads as booleans
+TRUE_VALUES = ["True", "TRUE", "true"]
+FALSE_VALUES = ["False", "FALSE", "false"]
+NUMERIC_DTYPES = ["int64", "float64", "float32"]
+DEFAULT_CHUNK_ROWS = 50000
+
+
+def arrow_type(dtype):
+    return {"str" : pa.string(), "category" : pa.dictionary(pa.int32(), pa.string()), "int64" : pa.int64(), "float64" : pa.float64(),
+            "float32" : pa.float32(), "bool" : pa.bool_()}[dtype]
+
+
+# Read csv_file with the given dtypes ({column: "str", "category", "int64", "float64", "float32" or "bool"}), columns
+# missing from dtypes are inferred.  usecols limits the columns that are read.  Raises ValueError when a value does not
+# fit its dtype.
+def read_csv(csv_file, dtypes=None, usecols=None):
+    dtypes = dtypes or {}
+    if pa is None:
+        return pd.read_csv(csv_file, dtype=dtypes, usecols=usecols, true_values=TRUE_VALUES, false_values=FALSE_VALUES)
+    convert_options = pa_csv.ConvertOptions(column_types={column : arrow_type(dtype) for column, dtype in dtypes.items()},
+                                            include_columns=usecols, null_values=NA_VALUES, strings_can_be_null=True,
+                                            true_values=TRUE_VALUES, false_values=FALSE_VALUES)
+    table = pa_csv.read_csv(csv_file, convert_options=convert_options)
+    # The table's buffers are released while the DataFrame is built, instead of holding both copies until the end
+    return table.to_pandas(split_blocks=True, self_destruct=True)
+
+
+# Yield csv_file as DataFrames of chunk_rows rows (the last one shorter), parsed a block at a time so only about one
+# chunk of the file is in memory.  dtypes and usecols are as for read_csv, skip_rows data rows at the start of the
+# file are skipped.  Raises ValueError when a value does not fit its dtype, after yielding the chunks before it.
+def read_csv_chunks(csv_file, dtypes=None, usecols=None, chunk_rows=DEFAULT_CHUNK_ROWS, skip_rows=0):
+    dtypes = dtypes or {}
+    if pa is None:
+        yield from pd.read_csv(csv_file, dtype=dtypes, usecols=usecols, true_values=TRUE_VALUES, false_values=FALSE_VALUES,
+                               skiprows=range(1, skip_rows + 1), chunksize=chunk_rows)
+        return
+    convert_options = pa_csv.ConvertOptions(column_types={column : arrow_type(dtype) for column, dtype in dtypes.items()},
+                                            include_columns=usecols, null_values=NA_VALUES, strings_can_be_null=True,
+                                            true_values=TRUE_VALUES, false_values=FALSE_VALUES)
+    read_options = pa_csv.ReadOptions(skip_rows_after_names=skip_rows)
+    # The reader's record batches follow its block size, they are regrouped into chunks of chunk_rows rows
+    pending = []
+    pending_rows = 0
+    with pa_csv.open_csv(csv_file, read_options=read_options, convert_options=convert_options) as reader:
+        for batch in reader:
+            pending.append(batch)
+            pending_rows += batch.num_rows
+            while pending_rows >= chunk_rows:
+                table = pa.Table.from_batches(pending)
+                rest = table.slice(chunk_rows)
+                pending = rest.to_batches()
+                pending_rows = rest.num_rows
+                yield table.slice(0, chunk_rows).to_pandas(split_blocks=True)
+    if pending_rows > 0:
+        yield pa.Table.from_batches(pending).to_pandas(split_blocks=True)
+
+
+def infer_dtypes(csv_file, usecols=None, float32=False, category_columns=CATEGORY_COLUMNS, whole_file=False, skip_rows=0):
+    # The dtypes pd.read_csv would infer for csv_file, as a dtypes argument for read_csv.  Dates and times are kept as
+    # their text (pyarrow would parse them), all-missing columns are floats.  Unless whole_file is set, pyarrow infers
+    # the types from the first block (1 MB) of the file only, or from the block after the first skip_rows data rows.
+    dtypes = {}
+    if pa is not None and not whole_file:
+        convert_options = pa_csv.ConvertOptions(include_columns=usecols, null_values=NA_VALUES, strings_can_be_null=True,
+                                                true_values=TRUE_VALUES, false_values=FALSE_VALUES)
+        read_options = pa_csv.ReadOptions(skip_rows_after_names=skip_rows)
+        with pa_csv.open_csv(csv_file, read_options=read_options, convert_options=convert_options) as reader:
+            schema = reader.schema
+        for field in schema:
+            if pa.types.is_boolean(field.type):
+                dtypes[field.name] = "bool"
+            elif pa.types.is_integer(field.type):
+                dtypes[field.name] = "int64"
+            elif pa.types.is_floating(field.type) or pa.types.is_null(field.type):
+                dtypes[field.name] = "float32" if float32 else "float64"
+            else:
+                dtypes[field.name] = "category" if field.name in category_columns else "str"
+        return dtypes
+    for column, dtype in pd.read_csv(csv_file, usecols=usecols, low_memory=False).dtypes.items():
+        if pd.api.types.is_bool_dtype(dtype):
+            dtypes[column] = "bool"
+        elif pd.api.types.is_integer_dtype(dtype):
+            dtypes[column] = "int64"
+        elif pd.api.types.is_float_dtype(dtype):
+            dtypes[column] = "float32" if float32 else "float64"
+        else:
+            dtypes[column] = "category" if column in category_columns else "str"
+    return dtypes
+
+
+class CsvSchemaCache:
+    # The dtypes of each kind of file, inferred from the first file read and widened when a later file has values that
+    # don't fit them (e.g. an integer column with missing values becomes float, a numeric column with text becomes str).
+    # Safe to use from several threads.
+
+    def __init__(self, float32=False, category_columns=CATEGORY_COLUMNS):
+        self.float32 = float32
+        self.category_columns = category_columns
+        self.lock = threading.Lock()
+        self.dtypes = {}
+
+    def merge(self, dtypes, inferred):
+        merged = dict(dtypes)
+        for column, dtype in inferred.items():
+            previous = merged.get(column, dtype)
+            if (previous == dtype):
+                merged[column] = dtype
+            elif (previous in NUMERIC_DTYPES and dtype in NUMERIC_DTYPES):
+                merged[column] = "float32" if self.float32 else "float64"
+            else:
+                merged[column] = "category" if column in self.category_columns else "str"
+        return merged
+
+    # Read csv_file with the dtypes shared by the files of kind key (e.g. the sensor's file name)
+    def read(self, key, csv_file, usecols=None):
+        with self.lock:
+            dtypes = self.dtypes.get(key, {})
+        if (len(dtypes) > 0):
+            try:
+                df = read_csv(csv_file, dtypes, usecols)
+                if (all(column in dtypes for column in df.columns)):
+                    return df
+            except ValueError:
+                pass
+        merged = self.merge(dtypes, infer_dtypes(csv_file, usecols, self.float32, self.category_columns))
+        try:
+            df = read_csv(csv_file, merged, usecols)
+        except ValueError:
+            # A later part of the file doesn't fit the types inferred from its start
+            merged = self.merge(dtypes, infer_dtypes(csv_file, usecols, self.float32, self.category_columns, whole_file=True))
+            df = read_csv(csv_file, merged, usecols)
+        with self.lock:
+            self.dtypes[key] = self.merge(self.dtypes.get(key, {}), merged)
+        return df
+
+    # Yield csv_file in chunks of chunk_rows rows read with the dtypes shared by the files of kind key.  When a later
+    # part of the file doesn't fit the dtypes, they are widened and the file is read on from the first row not yet
+    # yielded, so a chunk's dtypes can be wider than the ones of the chunks before it.
+    def read_chunks(self, key, csv_file, usecols=None, chunk_rows=DEFAULT_CHUNK_ROWS):
+        with self.lock:
+            dtypes = self.dtypes.get(key, {})
+        inferred = infer_dtypes(csv_file, usecols, self.float32, self.category_columns)
+        if not all(column in dtypes for column in inferred):
+            dtypes = self.merge(dtypes, inferred)
+        rows = 0
+        while True:
+            try:
+                for df in read_csv_chunks(csv_file, dtypes, usecols, chunk_rows, rows):
+                    rows += len(df)
+                    yield df
+                break
+            except ValueError:
+                # Widen the dtypes from the block after the rows already yielded, from the rest of the file if the
+                # value that didn't fit is further on
+                merged = self.merge(dtypes, infer_dtypes(csv_file, usecols, self.float32, self.category_columns, skip_rows=rows))
+                if (merged == dtypes):
+                    merged = self.merge(dtypes, infer_dtypes(csv_file, usecols, self.float32, self.category_columns, whole_file=True))
+                if (merged == dtypes):
+                    raise
+                dtypes = merged
+        with self.lock:
+            self.dtypes[key] = self.merge(self.dtypes.get(key, {}), dtypes)
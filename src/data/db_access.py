@@ -0,0 +1,152 @@
+##############################################################################
+#
+#  db_access.py
+#
+#  Shared database access for the helper scripts: a pooled SQLAlchemy engine
+#  for the MySQL server (or any SQLAlchemy URL, e.g. SQLite for local testing),
+#  chunked reads over a server-side cursor, bulk inserts, and per-query timing
+#  and row counts.
+#
+################################################################################
+
+import os
+import re
+import tempfile
+import threading
+import time
+import weakref
+from pathlib import Path
+import sqlalchemy as db
+import pandas as pd
+
+DEFAULT_MYSQLCONFIG = str(Path.home()) + '/.my.cnf'
+
+# Query statistics of each engine created by create_db_engine
+_query_stats = weakref.WeakKeyDictionary()
+
+
+class QueryStats:
+    # Count, total time and rows of every statement run through an engine, grouped by the start of the statement text
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.statements = {}
+
+    def record(self, statement, seconds, rows, count=1):
+        key = re.sub(r"\s+", " ", statement).strip()[:100]
+        with self.lock:
+            stats = self.statements.setdefault(key, {"count": 0, "seconds": 0.0, "rows": 0})
+            stats["count"] += count
+            stats["seconds"] += seconds
+            stats["rows"] += max(rows, 0)
+
+    def summary(self, top=5):
+        with self.lock:
+            statements = sorted(self.statements.items(), key=lambda item: item[1]["seconds"], reverse=True)
+        lines = ["Database: " + str(sum(s["count"] for k, s in statements)) + " queries, " + str(sum(s["rows"] for k, s in statements)) + " rows, "
+                 + format(sum(s["seconds"] for k, s in statements), ".2f") + "s"]
+        for statement, stats in statements[:top]:
+            lines.append("  " + format(stats["seconds"], "8.2f") + "s " + format(stats["count"], "6d") + "x " + format(stats["rows"], "10d") + " rows  " + statement)
+        return "\n".join(lines)
+
+
+def _before_cursor_execute(connection, cursor, statement, parameters, context, executemany):
+    connection.info.setdefault("query_start", []).append(time.perf_counter())
+
+
+def _after_cursor_execute(connection, cursor, statement, parameters, context, executemany):
+    seconds = time.perf_counter() - connection.info["query_start"].pop()
+    _query_stats[connection.engine].record(statement, seconds, cursor.rowcount)
+
+
+# Create a pooled engine.  Without db_url it connects to the MySQL server on the loopback address (some setups choke on
+# "localhost") with the credentials in the mysqlconfig file.  driver selects the MySQL DBAPI ("mysqldb" or "pymysql").
+# pool_size and max_overflow only apply to backends with a QueuePool (not e.g. in-memory SQLite).
+def create_db_engine(database=None, mysqlconfig=DEFAULT_MYSQLCONFIG, db_url=None, driver="mysqldb", pool_size=5, max_overflow=5, connect_args=None):
+    if db_url is not None:
+        url = db_url
+    else:
+        url = db.engine.URL.create(drivername="mysql+" + driver,
+                                   host="127.0.0.1",
+                                   database=database,
+                                   query={"read_default_file": os.path.expanduser(mysqlconfig)})
+    url = db.engine.make_url(url)
+    pool_args = {}
+    if issubclass(url.get_dialect().get_pool_class(url), db.pool.QueuePool):
+        pool_args = {"pool_size": pool_size, "max_overflow": max_overflow}
+    engine = db.create_engine(url, pool_pre_ping=True, connect_args=connect_args or {}, **pool_args)
+    _query_stats[engine] = QueryStats()
+    db.event.listen(engine, "before_cursor_execute", _before_cursor_execute)
+    db.event.listen(engine, "after_cursor_execute", _after_cursor_execute)
+    return engine
+
+
+def query_stats(engine):
+    return _query_stats[engine]
+
+
+def print_query_stats(engine, top=5):
+    if engine in _query_stats:
+        print(_query_stats[engine].summary(top))
+
+
+# Yield the result of query as DataFrames of at most chunksize rows, fetched over a server-side cursor
+def stream_query(engine, query, chunksize=50000):
+    with engine.connect().execution_options(stream_results=True) as connection:
+        for chunk in pd.read_sql(query, connection, chunksize=chunksize):
+            if engine in _query_stats:
+                # Rows of a streamed SELECT are only known once they have been fetched
+                _query_stats[engine].record(str(query), 0.0, len(chunk), count=0)
+            yield chunk
+
+
+# Read the whole result of query into one DataFrame, fetched in chunks.  columns names the result when it is empty.
+def read_query(engine, query, chunksize=50000, columns=None):
+    chunks = list(stream_query(engine, query, chunksize))
+    if len(chunks) == 0:
+        return pd.DataFrame(columns=columns)
+    return pd.concat(chunks, ignore_index=True)
+
+
+def _insert_executemany(connection, table_name, schema, df, batch_size):
+    # Multi-row INSERTs of batch_size rows each, NaN values are inserted as NULL
+    insert = db.table(table_name, *[db.column(c) for c in df.columns], schema=schema).insert()
+    records = df.astype(object).where(df.notna(), None).to_dict('records')
+    for start in range(0, len(records), batch_size):
+        connection.execute(insert, records[start:start + batch_size])
+
+
+def _escape_backslashes(value):
+    return value.replace('\\', '\\\\') if isinstance(value, str) else value
+
+
+def _insert_load_data(connection, table_name, schema, df):
+    # MySQL fast path: write the rows to a temporary CSV file and load it with LOAD DATA LOCAL INFILE
+    preparer = connection.dialect.identifier_preparer
+    # LOAD DATA reads \ as its escape character (and \N as NULL), backslashes in text are doubled so they load as written
+    text_columns = [c for c in df.columns if pd.api.types.is_object_dtype(df[c]) or pd.api.types.is_string_dtype(df[c]) or isinstance(df[c].dtype, pd.CategoricalDtype)]
+    if text_columns:
+        df = df.assign(**{c: df[c].map(_escape_backslashes) for c in text_columns})
+    with tempfile.NamedTemporaryFile('w', suffix='.csv', delete=False) as csv_out:
+        df.to_csv(csv_out, index=False, header=False, na_rep='\\N')
+    try:
+        qualified_table_name = preparer.quote(table_name) if schema is None else schema + "." + preparer.quote(table_name)
+        load_query = f"""
+        LOAD DATA LOCAL INFILE '{csv_out.name}' INTO TABLE {qualified_table_name}
+        FIELDS TERMINATED BY ',' OPTIONALLY ENCLOSED BY '"' LINES TERMINATED BY '\\n'
+        ({', '.join(preparer.quote(c) for c in df.columns)});
+        """
+        connection.execute(db.text(load_query))
+    finally:
+        os.remove(csv_out.name)
+
+
+# Append the rows of df to table_name.  method is "executemany" (batched multi-row INSERTs), "load_data" (LOAD DATA
+# LOCAL INFILE, MySQL only, other databases fall back to executemany) or "to_sql" (pandas).
+def bulk_insert(connection, table_name, df, schema=None, method="executemany", batch_size=1000):
+    if method == 'load_data' and connection.dialect.name == 'mysql':
+        _insert_load_data(connection, table_name, schema, df)
+    elif method == 'to_sql':
+        df.to_sql(table_name, con=connection, schema=schema, if_exists='append', index=False)
+    else:
+        _insert_executemany(connection, table_name, schema, df, batch_size)
@@ -0,0 +1,89 @@
+##############################################################################
+#
+#  execution_plan.py
+#
+#  Pre-flight size estimates for the helper scripts' --memory-budget and
+#  --plan options.  Before a script loads a database table or a CSV file it
+#  estimates the number of rows (information_schema.TABLES on MySQL, COUNT(*)
+#  elsewhere, the file size for CSV files) and the memory one row takes once
+#  loaded (measured on a small sample of rows).  A source whose estimated
+#  working set fits the memory budget is loaded into memory as before, a
+#  larger one is processed in chunks ("streaming").
+#
+################################################################################
+
+import io
+import os
+import sqlalchemy as db
+import pandas as pd
+
+DEFAULT_MEMORY_BUDGET_MB = 1024
+# Rows read to measure the memory a loaded row takes
+SAMPLE_ROWS = 1000
+# The scripts hold a few copies of what they load (the rows plus the merges and groupings built from them)
+WORKING_SET_FACTOR = 3
+
+
+def sample_row_bytes(sample_df):
+    # Average memory of one row of sample_df, as pandas holds it (strings included)
+    if (len(sample_df) == 0):
+        return 0
+    return int(sample_df.memory_usage(deep=True, index=False).sum() / len(sample_df))
+
+
+def table_rows(engine, table, schema=None):
+    # Row count of table and how it was obtained.  MySQL's information_schema estimate doesn't scan the table (it can be
+    # off by some percent for InnoDB), other databases are counted.
+    with engine.connect() as connection:
+        if (engine.dialect.name == 'mysql'):
+            tables = db.table("TABLES", db.column("TABLE_SCHEMA"), db.column("TABLE_NAME"), db.column("TABLE_ROWS"), schema="information_schema")
+            rows = connection.execute(db.select(tables.c.TABLE_ROWS).where(tables.c.TABLE_SCHEMA == (db.func.database() if schema is None else schema),
+                                                                           tables.c.TABLE_NAME == table)).scalar()
+            if (rows is not None):
+                return int(rows), "information_schema"
+        source_table = db.table(table, schema=schema)
+        return int(connection.execute(db.select(db.func.count()).select_from(source_table)).scalar()), "count"
+
+
+def estimate_table(engine, table, columns, schema=None):
+    # Estimated rows and loaded size of the columns of table
+    rows, method = table_rows(engine, table, schema)
+    source_table = db.table(table, *[db.column(column) for column in columns], schema=schema)
+    with engine.connect() as connection:
+        sample_df = pd.read_sql(db.select(*source_table.c).limit(SAMPLE_ROWS), connection)
+    row_bytes = sample_row_bytes(sample_df)
+    return {"source" : table if schema is None else schema + "." + table, "rows" : rows, "method" : method, "bytes" : rows * row_bytes}
+
+
+def estimate_csv(csv_file):
+    # Estimated rows and loaded size of csv_file, from its size and its first SAMPLE_ROWS rows
+    size = os.path.getsize(csv_file)
+    with open(csv_file, "rb") as csv_in:
+        lines = [csv_in.readline() for i in range(SAMPLE_ROWS + 1)]
+    lines = [line for line in lines if len(line) > 0]
+    sample_bytes = sum(len(line) for line in lines[1:])
+    if (len(lines) <= 1 or sample_bytes == 0):
+        return {"source" : csv_file, "rows" : 0, "method" : "file size", "bytes" : 0}
+    sample_df = pd.read_csv(io.BytesIO(b"".join(lines)))
+    rows = int((size - len(lines[0])) * len(sample_df) / sample_bytes)
+    return {"source" : csv_file, "rows" : rows, "method" : "file size", "bytes" : rows * sample_row_bytes(sample_df)}
+
+
+def choose_strategy(estimates, memory_budget, factor=WORKING_SET_FACTOR):
+    # "memory" when the working set of the estimated sources fits memory_budget (bytes), "streaming" otherwise
+    return "memory" if sum(estimate["bytes"] for estimate in estimates) * factor <= memory_budget else "streaming"
+
+
+def describe(estimate):
+    return (estimate["source"] + ": ~" + format(estimate["rows"], ",") + " rows (" + estimate["method"] + "), ~"
+            + format(estimate["bytes"] / (1024 * 1024), ",.1f") + " MB loaded")
+
+
+def print_plan(script, steps, memory_budget):
+    # steps is a list of (step name, estimates, strategy, note).  Printed at once, plans of studies run in threads don't mix.
+    lines = ["Plan for " + script + " (memory budget " + format(memory_budget / (1024 * 1024), ",.0f") + " MB):"]
+    for step, estimates, strategy, note in steps:
+        lines.append("  " + step + ": " + ("in memory" if strategy == "memory" else "streaming") + (" (" + note + ")" if note else ""))
+        for estimate in estimates:
+            lines.append("    " + describe(estimate))
+    print("\n".join(lines))
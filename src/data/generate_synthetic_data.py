@@ -0,0 +1,264 @@
+##############################################################################
+#
+#  generate_synthetic_data.py
+#
+#  Creates a deterministic synthetic AWARE study for testing and benchmarking
+#  the helper scripts: an aware_device and a time zone survey table in a
+#  SQLite database (standing in for the MySQL server), the matching RAPIDS
+#  participant CSV, and two RAPIDS data directories (raw, interim and
+#  processed/features) that differ in a few rows.  The same scale and seed
+#  always produce the same data.
+#
+################################################################################
+
+import sys
+import os
+import getopt
+import json
+import shutil
+import sqlite3
+import numpy as np
+import pandas as pd
+
+# Named scales, the number of aware_device rows (and of raw sensor rows in the RAPIDS tree)
+SCALES = {"1k" : 1000, "100k" : 100000, "10m" : 10000000}
+# Rows generated and written at a time, bounds memory use at the 10m scale
+CHUNK_ROWS = 1000000
+# Device timestamps are spread over 2020-2022 (milliseconds, as in AWARE)
+START_MS = 1577836800000
+SPAN_MS = 3 * 365 * 24 * 3600 * 1000
+# Phone models and their share of the devices, "iPhone" makes a participant's platform ios
+MODELS = {"iPhone" : ("Apple", 0.4), "Pixel 6" : ("Google", 0.2), "SM-G991U" : ("samsung", 0.3), "moto g power" : ("motorola", 0.1)}
+# Share of participants answering the time zone survey, and of those answering it twice
+SURVEY_RESPONSE_RATE = 0.9
+SURVEY_REPEAT_RATE = 0.05
+# Survey time_zone codes 1-7 (see TZ_CODES in create_multiple_timezones.py), weighted towards the continental US
+SURVEY_CODE_WEIGHTS = [0.02, 0.4, 0.25, 0.1, 0.2, 0.02, 0.01]
+# RAPIDS segments written for every day of the feature files: label, start hour, end hour
+SEGMENTS = [("daily", 0, 24), ("night", 0, 6), ("morning", 6, 12), ("afternoon", 12, 18), ("evening", 18, 24)]
+# Feature columns of each sensor, "count" features are integers and the others floats
+FEATURES = {"battery" : ["countdischarge", "sumdurationdischarge", "avgconsumptionrate"],
+            "screen" : ["countepisodeunlock", "sumdurationunlock", "maxdurationunlock"]}
+# Share of empty (NaN) float feature values
+FEATURE_NAN_RATE = 0.02
+# Share of feature rows changed in the candidate RAPIDS directory
+CANDIDATE_CHANGE_RATE = 0.001
+# Metadata file describing the generated data, read by benchmark_helper_scripts.py
+METADATA_FILE = "synthetic_data.json"
+
+
+def scale_rows(scale):
+    if (str(scale).lower() in SCALES):
+        return SCALES[str(scale).lower()]
+    return int(scale)
+
+
+def splitmix64(values):
+    # Deterministic 64 bit hash of every value (uint64 arithmetic wraps around)
+    z = values.astype(np.uint64) + np.uint64(0x9E3779B97F4A7C15)
+    z = (z ^ (z >> np.uint64(30))) * np.uint64(0xBF58476D1CE4E5B9)
+    z = (z ^ (z >> np.uint64(27))) * np.uint64(0x94D049BB133111EB)
+    return z ^ (z >> np.uint64(31))
+
+
+def device_ids(device_indices, seed):
+    # UUID formatted device_ids, the same device index and seed always give the same id
+    base = np.asarray(device_indices, dtype=np.uint64) * np.uint64(2) + np.uint64(seed) * np.uint64(1 << 40)
+    high = splitmix64(base).tolist()
+    low = splitmix64(base + np.uint64(1)).tolist()
+    return [f"{h >> 32:08x}-{(h >> 16) & 0xffff:04x}-{h & 0xffff:04x}-{l >> 48:04x}-{l & 0xffffffffffff:012x}" for h, l in zip(high, low)]
+
+
+def participant_labels(participant_indices):
+    return ["P" + format(i, "07d") for i in participant_indices]
+
+
+# Write the aware_device and tz_survey tables to db_file and the matching participant CSV.  Participants own 1-3
+# consecutive devices, one aware_device row each.  Returns the number of participants, device rows and survey rows.
+def generate_database(db_file, participant_file, rows, seed):
+    counts = {"participants" : 0, "device_rows" : 0, "survey_rows" : 0}
+    models = list(MODELS.keys())
+    model_weights = [MODELS[m][1] for m in models]
+    connection = sqlite3.connect(db_file)
+    chunk = 0
+    while (counts["device_rows"] < rows):
+        rng = np.random.default_rng([seed, 1, chunk])
+        devices = rng.integers(1, 4, CHUNK_ROWS // 2)
+        ends = counts["device_rows"] + np.cumsum(devices)
+        participant_count = int(np.searchsorted(ends, rows) + 1) if ends[-1] >= rows else len(devices)
+        devices = devices[:participant_count]
+        devices[-1] -= max(0, counts["device_rows"] + devices.sum() - rows)
+        device_count = int(devices.sum())
+
+        device_index = np.arange(counts["device_rows"], counts["device_rows"] + device_count)
+        participant_index = np.repeat(np.arange(counts["participants"], counts["participants"] + participant_count), devices)
+        model = np.array(models)[rng.choice(len(models), device_count, p=model_weights)]
+        device_df = pd.DataFrame({"_id" : device_index + 1,
+                                  "timestamp" : START_MS + rng.integers(0, SPAN_MS, device_count),
+                                  "device_id" : device_ids(device_index, seed),
+                                  "brand" : [MODELS[m][0] for m in model],
+                                  "manufacturer" : [MODELS[m][0] for m in model],
+                                  "model" : model,
+                                  "release" : np.where(model == "iPhone", "16.1", "13"),
+                                  "label" : participant_labels(participant_index)})
+        device_df.to_sql("aware_device", connection, if_exists="append", index=False)
+
+        # One participant file row per participant, with its first device's platform and registration date
+        participants = device_df.drop_duplicates("label", keep="first").set_index("label")
+        # A participant's devices are consecutive rows, so their ids are joined by slicing
+        device_ends = np.cumsum(devices).tolist()
+        ids = device_df["device_id"].tolist()
+        participants["device_id"] = [";".join(ids[end - count:end]) for end, count in zip(device_ends, devices.tolist())]
+        participants["fitbit_id"] = ""
+        participants["empatica_id"] = ""
+        participants["pid"] = participants.index
+        participants["label"] = participants.index
+        participants["platform"] = np.where(participants["model"] == "iPhone", "ios", "android")
+        participants["start_date"] = pd.to_datetime(participants["timestamp"], unit="ms").dt.strftime("%Y-%m-%d")
+        participants["end_date"] = "2022-12-31"
+        columns = ["device_id", "fitbit_id", "empatica_id", "pid", "label", "platform", "start_date", "end_date"]
+        participants[columns].to_csv(participant_file, mode="w" if chunk == 0 else "a", header=(chunk == 0), index=False)
+
+        # Most participants answer the time zone survey, a few of them twice (the answers can differ)
+        labels = participants.index.to_numpy()
+        answered = labels[rng.random(participant_count) < SURVEY_RESPONSE_RATE]
+        repeated = answered[rng.random(len(answered)) < SURVEY_REPEAT_RATE]
+        survey_df = pd.DataFrame({"eid" : np.concatenate([answered, repeated]),
+                                  "time_zone" : rng.choice(np.arange(1, 8), len(answered) + len(repeated), p=SURVEY_CODE_WEIGHTS)})
+        survey_df.to_sql("tz_survey", connection, if_exists="append", index=False)
+
+        counts["participants"] += participant_count
+        counts["device_rows"] += device_count
+        counts["survey_rows"] += len(survey_df)
+        chunk += 1
+    connection.execute("CREATE INDEX aware_device_device_id ON aware_device (device_id)")
+    connection.commit()
+    connection.close()
+    return counts
+
+
+def segment_columns(days):
+    # RAPIDS segment columns for every segment of the given number of days
+    day = np.repeat(np.arange(days), len(SEGMENTS))
+    label = np.tile([s[0] for s in SEGMENTS], days)
+    start = pd.Timestamp("2020-01-01") + pd.to_timedelta(day, unit="D") + pd.to_timedelta(np.tile([s[1] for s in SEGMENTS], days), unit="h")
+    end = pd.Timestamp("2020-01-01") + pd.to_timedelta(day, unit="D") + pd.to_timedelta(np.tile([s[2] for s in SEGMENTS], days), unit="h") - pd.Timedelta(seconds=1)
+    start_text = start.strftime("%Y-%m-%d %H:%M:%S")
+    end_text = end.strftime("%Y-%m-%d %H:%M:%S")
+    return pd.DataFrame({"local_segment" : label + "#" + start_text + "," + end_text,
+                         "local_segment_label" : label,
+                         "local_segment_start_datetime" : start_text,
+                         "local_segment_end_datetime" : end_text})
+
+
+def feature_frame(rng, sensor, feature_rows):
+    df = segment_columns(max(1, feature_rows // len(SEGMENTS)))
+    for feature in FEATURES[sensor]:
+        column = "phone_" + sensor + "_rapids_" + feature
+        if (feature.startswith("count")):
+            df[column] = rng.integers(0, 60, len(df))
+        else:
+            df[column] = np.where(rng.random(len(df)) < FEATURE_NAN_RATE, np.nan, rng.gamma(2.0, 30.0, len(df)))
+    return df
+
+
+def write_csv(df, base_dir, rel_path):
+    path = os.path.join(base_dir, rel_path)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    df.to_csv(path, index=False)
+
+
+# Write the baseline and candidate RAPIDS data directories for the first participants.  The candidate differs from the
+# baseline in a few feature values, is missing the last raw row of the first participant and the interim file of the
+# last participant.
+def generate_rapids_tree(baseline_dir, candidate_dir, rows, seed, participant_count):
+    feature_participants = int(min(participant_count, max(5, min(500, rows // 2000))))
+    raw_rows = max(1, rows // (feature_participants * len(FEATURES)))
+    feature_rows = max(len(SEGMENTS), rows // 10 // (feature_participants * len(FEATURES)))
+    device_id_list = device_ids(np.arange(feature_participants * 3), seed)
+    for participant_index, pid in enumerate(participant_labels(range(feature_participants))):
+        rng = np.random.default_rng([seed, 2, participant_index])
+        timestamp = START_MS + np.sort(rng.integers(0, SPAN_MS // 36, raw_rows))
+        device_id = np.array(device_id_list[participant_index * 3 : participant_index * 3 + 3])[rng.integers(0, 3, raw_rows)]
+        raw = {"battery" : pd.DataFrame({"timestamp" : timestamp, "device_id" : device_id, "battery_level" : rng.integers(1, 101, raw_rows), "battery_status" : rng.integers(2, 6, raw_rows)}),
+               "screen" : pd.DataFrame({"timestamp" : timestamp, "device_id" : device_id, "screen_status" : rng.integers(0, 4, raw_rows)})}
+        episodes = max(1, raw_rows // 4)
+        episode_start = START_MS + np.sort(rng.integers(0, SPAN_MS // 36, episodes))
+        episode_duration = rng.gamma(2.0, 2.0, episodes)
+        interim = pd.DataFrame({"episode_id" : np.arange(episodes), "episode" : "unlock",
+                                "start_timestamp" : episode_start, "end_timestamp" : episode_start + (episode_duration * 60000).astype(np.int64),
+                                "duration" : episode_duration})
+        features = {sensor : feature_frame(rng, sensor, feature_rows) for sensor in FEATURES}
+
+        for sensor, df in raw.items():
+            write_csv(df, baseline_dir, os.path.join("raw", pid, "phone_" + sensor + "_raw.csv"))
+            write_csv(df.iloc[:-1] if participant_index == 0 and len(df) > 1 else df, candidate_dir, os.path.join("raw", pid, "phone_" + sensor + "_raw.csv"))
+        write_csv(interim, baseline_dir, os.path.join("interim", pid, "phone_screen_episodes.csv"))
+        if (participant_index < feature_participants - 1):
+            write_csv(interim, candidate_dir, os.path.join("interim", pid, "phone_screen_episodes.csv"))
+        for sensor, df in features.items():
+            write_csv(df, baseline_dir, os.path.join("processed", "features", pid, "phone_" + sensor + ".csv"))
+            changed = rng.random(len(df)) < CANDIDATE_CHANGE_RATE
+            changed[0] = changed[0] or participant_index == 0
+            candidate_df = df.copy()
+            candidate_df.loc[changed, candidate_df.columns[-1]] = candidate_df.loc[changed, candidate_df.columns[-1]].fillna(0.0) + 1.0
+            write_csv(candidate_df, candidate_dir, os.path.join("processed", "features", pid, "phone_" + sensor + ".csv"))
+    return {"feature_participants" : feature_participants, "raw_rows_per_file" : raw_rows, "feature_rows_per_file" : len(features["battery"])}
+
+
+# Generate the complete synthetic study in output_dir, replacing data generated there before.  Returns its metadata.
+def generate(output_dir, scale, seed=0):
+    rows = scale_rows(scale)
+    os.makedirs(output_dir, exist_ok=True)
+    metadata = {"scale" : str(scale), "rows" : rows, "seed" : seed,
+                "database" : "study.db", "device_table" : "aware_device", "survey_table" : "tz_survey", "survey_col_name" : "eid",
+                "participant_file" : "participant_file.csv",
+                "rapids_baseline" : os.path.join("rapids_baseline", "data"), "rapids_candidate" : os.path.join("rapids_candidate", "data")}
+    for name in [metadata["database"], metadata["participant_file"], METADATA_FILE]:
+        if (os.path.exists(os.path.join(output_dir, name))):
+            os.remove(os.path.join(output_dir, name))
+    for name in ["rapids_baseline", "rapids_candidate"]:
+        shutil.rmtree(os.path.join(output_dir, name), ignore_errors=True)
+
+    metadata.update(generate_database(os.path.join(output_dir, metadata["database"]), os.path.join(output_dir, metadata["participant_file"]), rows, seed))
+    metadata.update(generate_rapids_tree(os.path.join(output_dir, metadata["rapids_baseline"]), os.path.join(output_dir, metadata["rapids_candidate"]), rows, seed, metadata["participants"]))
+    with open(os.path.join(output_dir, METADATA_FILE), "w") as metadata_out:
+        json.dump(metadata, metadata_out, indent=1)
+    return metadata
+
+
+def usage():
+    print("python generate_synthetic_data.py [--output_dir <folder>] [--scale <1k|100k|10m|number of rows>] [--seed <integer>]")
+
+
+def main():
+
+    try:
+        optlist, args = getopt.getopt(sys.argv[1:], "", ["output_dir=", "scale=", "seed="])
+    except getopt.GetoptError as err:
+        print(err)
+        usage()
+        sys.exit(2)
+
+    options = {}
+    options["output_dir"] = "../../data/synthetic"
+    options["scale"] = "1k"
+    options["seed"] = 0
+
+    for option_tuple in optlist:
+        if (option_tuple[0] == "--output_dir"):
+            options["output_dir"] = option_tuple[1]
+        elif (option_tuple[0] == "--scale"):
+            options["scale"] = option_tuple[1]
+        elif (option_tuple[0] == "--seed"):
+            options["seed"] = int(option_tuple[1])
+
+    metadata = generate(options["output_dir"], options["scale"], options["seed"])
+    print("Created " + str(metadata["device_rows"]) + " aware_device rows for " + str(metadata["participants"]) + " participants and "
+          + str(metadata["survey_rows"]) + " survey rows in " + os.path.join(options["output_dir"], metadata["database"]) + ".")
+    print("Created RAPIDS data directories for " + str(metadata["feature_participants"]) + " participants in " + os.path.join(options["output_dir"], metadata["rapids_baseline"])
+          + " and " + os.path.join(options["output_dir"], metadata["rapids_candidate"]) + ".")
+
+
+if __name__ == "__main__":
+    main()
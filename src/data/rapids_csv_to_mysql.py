@@ -1,7 +1,34 @@
 import argparse
-from sqlalchemy import create_engine, text
+from concurrent.futures import ThreadPoolExecutor
+from sqlalchemy import inspect, text
+import csv
+import datetime
+import hashlib
 import os
+import queue
+import threading
+import time
+import numpy as np
 import pandas as pd
+import csv_reader
+import db_access
+import stage_profiler
+
+# Segment columns RAPIDS writes before the feature columns of every phone_<sensor>.csv
+SEGMENT_COLUMNS = ['local_segment', 'local_segment_label', 'local_segment_start_datetime', 'local_segment_end_datetime']
+
+# Integer column types from narrowest to widest with their value ranges
+INTEGER_TYPES = [("TINYINT", -2**7, 2**7 - 1), ("SMALLINT", -2**15, 2**15 - 1), ("INT", -2**31, 2**31 - 1), ("BIGINT", -2**63, 2**63 - 1)]
+
+# Arrow types of the SQL column types inferred by scan_sensor_schema, used by --sink parquet
+PARQUET_TYPES = {"TINYINT": "int8", "SMALLINT": "int16", "INT": "int32", "BIGINT": "int64", "FLOAT": "float32", "DOUBLE": "float64", "TEXT": "string"}
+
+# Names of the SQL integer column types (from INTEGER_TYPES).  prepare_chunk casts float chunk columns of these types to
+# nullable Int64 for --stream.
+INTEGER_SQL_TYPES = [sql_type for sql_type, low, high in INTEGER_TYPES]
+
+# Table in the target database recording which participant files were loaded by --incremental
+MANIFEST_TABLE = 'rapids_upload_manifest'
 
 
 def file_to_sensor(file_name):
@@ -22,7 +49,402 @@ def sensor_to_file(sensor_name):
     file_name = prefix + sensor_name + suffix
     return file_name
 
-def main():
+def feature_column_map(columns):
+    # RAPIDS feature columns are named phone_<sensor>_<provider>_<feature>, shorten them to <provider initial>_<feature>.
+    # Returns {original name: new name} for the feature columns in columns.
+    column_map = {}
+    for column_name in columns:
+        if column_name[:5] != "phone":
+            continue
+        parts = column_name.split('_')
+        provider_name = parts[2]
+        feature_name = '_'.join(parts[3:])
+        column_map[column_name] = provider_name[0] + '_' + feature_name.replace('.', '_')
+    return column_map
+
+def read_participant_features(csv_file_path, csv_schemas, sensor):
+    # Read a participant's feature CSV with the feature columns renamed.  Only the segment and feature columns are
+    # parsed, with the dtypes csv_schemas (a csv_reader.CsvSchemaCache) shares between all participants of sensor.
+    with open(csv_file_path, newline='') as csv_in:
+        columns = next(csv.reader(csv_in), [])
+    column_map = feature_column_map(columns)
+    df = csv_schemas.read(sensor, csv_file_path, usecols=[c for c in columns if c in SEGMENT_COLUMNS or c in column_map])
+    return df.rename(columns=column_map)
+
+def stream_participant_features(csv_file_path, csv_schemas, sensor, chunk_rows):
+    # read_participant_features as a generator of chunks of chunk_rows rows, with the feature columns not renamed yet.
+    # Returns (chunks, {original name: new name}).
+    with open(csv_file_path, newline='') as csv_in:
+        columns = next(csv.reader(csv_in), [])
+    column_map = feature_column_map(columns)
+    chunks = csv_schemas.read_chunks(sensor, csv_file_path, usecols=[c for c in columns if c in SEGMENT_COLUMNS or c in column_map], chunk_rows=chunk_rows)
+    return chunks, column_map
+
+def participant_frames(directory_path, participant, sensor, csv_schemas, chunk_rows=None):
+    # The renamed features of a participant as one DataFrame, or in chunks of chunk_rows rows when it is set
+    csv_file_path = os.path.join(directory_path, participant, f'phone_{sensor}.csv')
+    if not chunk_rows:
+        yield read_participant_features(csv_file_path, csv_schemas, sensor)
+        return
+    chunks, column_map = stream_participant_features(csv_file_path, csv_schemas, sensor, chunk_rows)
+    for df in chunks:
+        yield df.rename(columns=column_map)
+
+def scan_sensor_schema(directory_path, participants, sensor, csv_schemas, chunk_rows=None, empty_type="DOUBLE"):
+    # One pass over every participant's CSV for sensor (chunk by chunk with chunk_rows).  Returns the union of the
+    # (renamed) feature columns in order of first appearance, each with the narrowest SQL type that holds all of its
+    # values (empty_type for numeric columns without any value).
+    states = {}
+    for participant in participants:
+        for df in participant_frames(directory_path, participant, sensor, csv_schemas, chunk_rows):
+            for column_name in df.columns:
+                if column_name in SEGMENT_COLUMNS:
+                    continue
+                state = states.setdefault(column_name, {"numeric": True, "integer": True, "float32": True, "min": None, "max": None})
+                if not pd.api.types.is_numeric_dtype(df[column_name]):
+                    state["numeric"] = False
+                    continue
+                values = df[column_name].dropna().to_numpy(dtype=np.float64)
+                if len(values) == 0:
+                    continue
+                finite = np.isfinite(values)
+                state["integer"] = state["integer"] and bool(finite.all() and (values == np.floor(values)).all())
+                state["float32"] = state["float32"] and bool(np.array_equal(values.astype(np.float32).astype(np.float64), values, equal_nan=True))
+                state["min"] = values[finite].min(initial=np.inf) if state["min"] is None else min(state["min"], values[finite].min(initial=np.inf))
+                state["max"] = values[finite].max(initial=-np.inf) if state["max"] is None else max(state["max"], values[finite].max(initial=-np.inf))
+
+    schema = {}
+    for column_name, state in states.items():
+        if not state["numeric"]:
+            schema[column_name] = "TEXT"
+        elif state["min"] is None:
+            schema[column_name] = empty_type
+        elif state["integer"]:
+            # Whole numbers beyond the BIGINT range are stored as DOUBLE
+            schema[column_name] = next((sql_type for sql_type, low, high in INTEGER_TYPES if low <= state["min"] and state["max"] <= high), "DOUBLE")
+        elif state["float32"]:
+            schema[column_name] = "FLOAT"
+        else:
+            schema[column_name] = "DOUBLE"
+    return schema
+
+def sensor_table_name(args, target, sensor):
+    # Returns the table name for sensor and the same name quoted and prefixed with the schema for use in SQL text
+    new_table_name = f'{args.table_name}${sensor}${args.level}'
+    qualified_table_name = target["preparer"].quote(new_table_name)
+    if target["schema"] is not None:
+        qualified_table_name = f'{target["schema"]}.{qualified_table_name}'
+    return new_table_name, qualified_table_name
+
+def create_sensor_table(connection, args, target, sensor):
+    new_table_name, qualified_table_name = sensor_table_name(args, target, sensor)
+    collate = target["collate"]
+    drop_query = f'DROP TABLE IF EXISTS {qualified_table_name};'
+    drop_query = text(drop_query)
+    connection.execute(drop_query)
+    query_start = f'''
+    CREATE TABLE {qualified_table_name} (
+    local_segment VARCHAR(255){collate},
+    local_segment_label VARCHAR(255){collate},
+    local_segment_start_datetime DATETIME,
+    local_segment_end_datetime DATETIME,
+    '''
+    query_end = f'''
+    pid VARCHAR(255){collate}
+    );
+    '''
+    query_middle = ""
+    for column_name, data_type in target["schemas"][sensor].items():
+        if data_type == "TEXT":
+            data_type += collate
+        query_middle += f"{column_name} {data_type},\n"
+    create_query = query_start + query_middle + query_end      
+    create_query = text(create_query)
+    connection.execute(create_query)
+    # Index names are unique per database on some backends, so they are derived from the table name
+    index_name = 'pid_start_' + hashlib.sha1(new_table_name.encode()).hexdigest()[:12]
+    connection.execute(text(f'CREATE INDEX {index_name} ON {qualified_table_name} (pid, local_segment_start_datetime);'))
+
+def reflected_sql_type(column_type):
+    # The scan_sensor_schema name of a reflected column type, e.g. "INT" for INTEGER, other types by their base name
+    # (VARCHAR, DATETIME, ...)
+    name = str(column_type).upper().split('(')[0].split()[0]
+    return {"INTEGER": "INT", "REAL": "DOUBLE"}.get(name, name)
+
+def widen_sql_type(current, needed):
+    # The narrowest scan_sensor_schema type holding the values of both current (a column's type) and needed.  Columns
+    # that aren't numeric (TEXT, VARCHAR) hold anything.
+    integer_types = [sql_type for sql_type, low, high in INTEGER_TYPES]
+    if current == needed or current not in integer_types + ["FLOAT", "DOUBLE"]:
+        return current
+    if needed == "TEXT":
+        return "TEXT"
+    if current in integer_types and needed in integer_types:
+        return max(current, needed, key=integer_types.index)
+    # FLOAT holds TINYINT and SMALLINT values exactly, not wider integers
+    if {current, needed} <= {"TINYINT", "SMALLINT", "FLOAT"}:
+        return "FLOAT"
+    return "DOUBLE"
+
+def widen_sensor_table(engine, args, target, sensor, participants):
+    # --incremental keeps an existing table, whose column types were inferred from the participants of earlier uploads.
+    # Scan the files of the participants that changed since then and, before any of their rows is inserted, widen the
+    # columns whose type can't hold their values and add the columns the table lacks.  MySQL columns are changed with
+    # ALTER TABLE ... MODIFY (other databases such as SQLite store any value in any column).  The file hashes are kept
+    # in target["file_hashes"] for upload_sensor.  Sets target["schemas"][sensor] to the widened feature columns.
+    new_table_name, qualified_table_name = sensor_table_name(args, target, sensor)
+    with engine.connect() as connection:
+        manifest = read_manifest(connection, target, new_table_name)
+    changed = []
+    for participant in participants:
+        file_hash = file_sha256(os.path.join(target["directory_path"], participant, f'phone_{sensor}.csv'))
+        target["file_hashes"][(sensor, participant)] = file_hash
+        if manifest.get(participant) != file_hash:
+            changed.append(participant)
+
+    columns = {column["name"]: reflected_sql_type(column["type"]) for column in inspect(engine).get_columns(new_table_name, schema=target["schema"])}
+    schema = {column_name: sql_type for column_name, sql_type in columns.items() if column_name not in SEGMENT_COLUMNS + ['pid']}
+    scanned = scan_sensor_schema(target["directory_path"], changed, sensor, target["csv_schemas"], args.chunk_rows if args.stream else None, empty_type=None) if changed else {}
+    statements = []
+    for column_name, needed in scanned.items():
+        if column_name in SEGMENT_COLUMNS:
+            continue
+        if column_name not in columns:
+            schema[column_name] = needed or "DOUBLE"
+            statements.append(f'ALTER TABLE {qualified_table_name} ADD COLUMN {column_name} {schema[column_name]}{target["collate"] if schema[column_name] == "TEXT" else ""}')
+        elif needed is not None and widen_sql_type(columns[column_name], needed) != columns[column_name]:
+            schema[column_name] = widen_sql_type(columns[column_name], needed)
+            if engine.dialect.name == 'mysql':
+                statements.append(f'ALTER TABLE {qualified_table_name} MODIFY {column_name} {schema[column_name]}{target["collate"] if schema[column_name] == "TEXT" else ""}')
+    target["schemas"][sensor] = schema
+    if statements:
+        # DDL commits implicitly on MySQL, so the columns are changed before (and apart from) the upload's transaction
+        with engine.begin() as connection:
+            for statement in statements:
+                connection.execute(text(statement))
+        print(f"Changed {len(statements)} columns of {new_table_name} for the values of {len(changed)} changed participants.")
+
+def file_sha256(file_path):
+    file_hash = hashlib.sha256()
+    with open(file_path, 'rb') as file_in:
+        for block in iter(lambda: file_in.read(1 << 20), b''):
+            file_hash.update(block)
+    return file_hash.hexdigest()
+
+def manifest_table_name(target):
+    qualified_manifest_name = MANIFEST_TABLE
+    if target["schema"] is not None:
+        qualified_manifest_name = f'{target["schema"]}.{qualified_manifest_name}'
+    return qualified_manifest_name
+
+def create_manifest_table(connection, target):
+    collate = target["collate"]
+    connection.execute(text(f'''
+    CREATE TABLE IF NOT EXISTS {manifest_table_name(target)} (
+    table_name VARCHAR(255){collate} NOT NULL,
+    sensor VARCHAR(255){collate},
+    pid VARCHAR(255){collate} NOT NULL,
+    file_hash CHAR(64),
+    row_count INT,
+    loaded_at DATETIME,
+    PRIMARY KEY (table_name, pid)
+    );
+    '''))
+
+def read_manifest(connection, target, new_table_name):
+    # Returns {pid: file hash} of the participant files loaded into new_table_name
+    result = connection.execute(text(f'SELECT pid, file_hash FROM {manifest_table_name(target)} WHERE table_name = :table_name'), {"table_name": new_table_name})
+    return {pid: file_hash for pid, file_hash in result}
+
+def record_manifest(connection, target, new_table_name, sensor, participant, file_hash, row_count):
+    connection.execute(text(f'DELETE FROM {manifest_table_name(target)} WHERE table_name = :table_name AND pid = :pid'), {"table_name": new_table_name, "pid": participant})
+    connection.execute(text(f'INSERT INTO {manifest_table_name(target)} (table_name, sensor, pid, file_hash, row_count, loaded_at) VALUES (:table_name, :sensor, :pid, :file_hash, :row_count, :loaded_at)'),
+                       {"table_name": new_table_name, "sensor": sensor, "pid": participant, "file_hash": file_hash, "row_count": row_count, "loaded_at": datetime.datetime.now().replace(microsecond=0)})
+
+# End of a stage's output on a pipeline queue
+STREAM_DONE = object()
+
+def queue_put(out_queue, item, stop):
+    # Put item on the bounded out_queue, waiting while it is full.  Returns False when stop was set meanwhile.
+    while not stop.is_set():
+        try:
+            out_queue.put(item, timeout=0.1)
+            return True
+        except queue.Full:
+            pass
+    return False
+
+def queue_items(in_queue, stop):
+    # Yield the items put on in_queue until STREAM_DONE, re-raising an exception put by the stage before
+    while not stop.is_set():
+        try:
+            item = in_queue.get(timeout=0.1)
+        except queue.Empty:
+            continue
+        if item is STREAM_DONE:
+            return
+        if isinstance(item, BaseException):
+            raise item
+        yield item
+
+def pipeline_stage(items, out_queue, stop):
+    # Thread body of a stage: put the items of the iterable items on out_queue, then STREAM_DONE or the exception
+    # raised while producing them
+    try:
+        for item in items:
+            if not queue_put(out_queue, item, stop):
+                return
+        queue_put(out_queue, STREAM_DONE, stop)
+    except Exception as err:
+        queue_put(out_queue, err, stop)
+
+def stream_pipeline(chunks, transform, queue_depth):
+    # Yield transform(chunk) for each chunk of the iterable chunks.  The chunks are produced (parsed) in a reader thread
+    # and transformed in a second thread while the caller consumes (writes) the results, the stages being connected by
+    # queues of queue_depth chunks, so at most about 2 * queue_depth + 3 chunks are in memory.  An error in a stage is
+    # raised in the caller, the threads stop when the caller stops consuming.
+    parsed = queue.Queue(maxsize=queue_depth)
+    transformed = queue.Queue(maxsize=queue_depth)
+    stop = threading.Event()
+    threads = [threading.Thread(target=pipeline_stage, args=(chunks, parsed, stop), daemon=True),
+               threading.Thread(target=pipeline_stage, args=(map(transform, queue_items(parsed, stop)), transformed, stop), daemon=True)]
+    for thread in threads:
+        thread.start()
+    try:
+        yield from queue_items(transformed, stop)
+    finally:
+        stop.set()
+        for thread in threads:
+            thread.join()
+
+def prepare_chunk(df, column_map, participant, sensor_schema):
+    # Transform stage of the streaming upload: rename the feature columns, add pid and coerce the columns to what the
+    # table holds (categoricals to plain strings, integer columns read as floats because of missing values to
+    # nullable integers) so the writer only inserts
+    df = df.rename(columns=column_map)
+    for column_name in df.columns:
+        if isinstance(df[column_name].dtype, pd.CategoricalDtype):
+            df[column_name] = df[column_name].astype(object)
+        elif sensor_schema.get(column_name) in INTEGER_SQL_TYPES and pd.api.types.is_float_dtype(df[column_name]):
+            df[column_name] = df[column_name].astype("Int64")
+    df['pid'] = participant
+    return df
+
+def stream_participant(connection, args, target, sensor, new_table_name, csv_file_path, participant):
+    # Insert a participant's CSV chunk by chunk while the next chunks are parsed.  Returns the number of rows.
+    chunks, column_map = stream_participant_features(csv_file_path, target["csv_schemas"], sensor, args.chunk_rows)
+    sensor_schema = target["schemas"].get(sensor, {})
+    rows = 0
+    for df in stream_pipeline(chunks, lambda df: prepare_chunk(df, column_map, participant, sensor_schema), args.queue_depth):
+        with target["profiler"].stage("insert_rows", rows=len(df)):
+            db_access.bulk_insert(connection, new_table_name, df, schema=target["schema"], method=args.load_method, batch_size=args.batch_size)
+        rows += len(df)
+    return rows
+
+def upload_sensor(engine, args, target, sensor, participants, create_table):
+    # Upload the CSVs of participants for one sensor in a single transaction, creating the table first if create_table
+    # is set.  Errors are caught and returned so the other tables keep going.
+    # With --incremental, participants whose file hash matches the manifest are skipped and changed participants have
+    # their rows replaced (delete by pid, then insert).
+    new_table_name, qualified_table_name = sensor_table_name(args, target, sensor)
+    stats = {"table": new_table_name, "participants": len(participants), "rows": 0, "skipped": 0, "seconds": 0.0, "error": None}
+    start_time = time.perf_counter()
+    try:
+        with engine.begin() as connection:
+            if create_table:
+                create_sensor_table(connection, args, target, sensor)
+            manifest = read_manifest(connection, target, new_table_name) if args.incremental else {}
+            for participant in participants:
+                csv_file_path = os.path.join(target["directory_path"], participant, f'phone_{sensor}.csv')
+                if args.incremental:
+                    file_hash = target["file_hashes"].get((sensor, participant)) or file_sha256(csv_file_path)
+                    if manifest.get(participant) == file_hash:
+                        stats["skipped"] += 1
+                        continue
+                    if participant in manifest:
+                        connection.execute(text(f'DELETE FROM {qualified_table_name} WHERE pid = :pid'), {"pid": participant})
+                if args.stream:
+                    with target["profiler"].stage("stream_participant") as stage:
+                        rows = stream_participant(connection, args, target, sensor, new_table_name, csv_file_path, participant)
+                        stage["rows"] = rows
+                else:
+                    with target["profiler"].stage("read_participant_features") as stage:
+                        df = read_participant_features(csv_file_path, target["csv_schemas"], sensor)
+                        stage["rows"] = len(df)
+                    df['pid'] = participant
+                    with target["profiler"].stage("insert_rows", rows=len(df)):
+                        db_access.bulk_insert(connection, new_table_name, df, schema=target["schema"], method=args.load_method, batch_size=args.batch_size)
+                    rows = len(df)
+                stats["rows"] += rows
+                if args.incremental:
+                    record_manifest(connection, target, new_table_name, sensor, participant, file_hash, rows)
+    except Exception as err:
+        stats["error"] = str(err)
+        stats["rows"] = 0
+    stats["seconds"] = time.perf_counter() - start_time
+    if stats["error"] is None:
+        print(f"Uploaded {stats['rows']} rows from {len(participants) - stats['skipped']} participants ({stats['skipped']} unchanged) to {new_table_name} in {stats['seconds']:.1f}s ({stats['rows'] / max(stats['seconds'], 1e-9):.0f} rows/s)")
+    else:
+        print(f"Upload to {new_table_name} failed and was rolled back: {stats['error']}")
+    return stats
+
+def parquet_schema(sensor_schema):
+    import pyarrow as pa
+    fields = [(c, pa.string()) for c in SEGMENT_COLUMNS[:2]] + [(c, pa.timestamp('s')) for c in SEGMENT_COLUMNS[2:]]
+    fields += [(c, pa.type_for_alias(PARQUET_TYPES[sql_type])) for c, sql_type in sensor_schema.items()]
+    return pa.schema(fields)
+
+def write_sensor_parquet(args, target, sensor, participants):
+    # Write one sensor's features to <parquet_dir>/<table_name>_<level>/sensor=<sensor>/pid=<pid>/part-0.parquet, one
+    # participant at a time so only a single participant's rows are in memory.  All files share the schema inferred
+    # from every participant.  Returns the same stats as upload_sensor.
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+    import shutil
+    sensor_path = os.path.join(args.parquet_dir, f'{args.table_name}_{args.level}', f'sensor={sensor}')
+    stats = {"table": sensor_path, "participants": len(participants), "rows": 0, "skipped": 0, "seconds": 0.0, "error": None}
+    start_time = time.perf_counter()
+    try:
+        schema = parquet_schema(target["schemas"][sensor])
+        shutil.rmtree(sensor_path, ignore_errors=True)
+        for participant in participants:
+            with target["profiler"].stage("read_participant_features") as stage:
+                df = read_participant_features(os.path.join(target["directory_path"], participant, f'phone_{sensor}.csv'), target["csv_schemas"], sensor)
+                stage["rows"] = len(df)
+            for column_name in SEGMENT_COLUMNS[2:]:
+                df[column_name] = pd.to_datetime(df[column_name])
+            df = df.reindex(columns=schema.names)
+            participant_path = os.path.join(sensor_path, f'pid={participant}')
+            os.makedirs(participant_path, exist_ok=True)
+            with target["profiler"].stage("write_parquet", rows=len(df)):
+                pq.write_table(pa.Table.from_pandas(df, schema=schema, preserve_index=False), os.path.join(participant_path, 'part-0.parquet'), compression=args.compression)
+            stats["rows"] += len(df)
+    except Exception as err:
+        stats["error"] = str(err)
+    stats["seconds"] = time.perf_counter() - start_time
+    if stats["error"] is None:
+        print(f"Wrote {stats['rows']} rows from {len(participants)} participants to {sensor_path} in {stats['seconds']:.1f}s ({stats['rows'] / max(stats['seconds'], 1e-9):.0f} rows/s)")
+    else:
+        print(f"Writing {sensor_path} failed: {stats['error']}")
+    return stats
+
+def print_upload_summary(all_stats):
+    # Combine the stats of each table's shards into one line per table
+    tables = {}
+    for stats in all_stats:
+        table_stats = tables.setdefault(stats["table"], {"rows": 0, "skipped": 0, "seconds": 0.0, "shards": 0, "errors": []})
+        table_stats["rows"] += stats["rows"]
+        table_stats["skipped"] += stats["skipped"]
+        table_stats["seconds"] += stats["seconds"]
+        table_stats["shards"] += 1
+        if stats["error"] is not None:
+            table_stats["errors"].append(stats["error"])
+    print("Upload summary:")
+    for table_name, table_stats in tables.items():
+        status = "OK" if len(table_stats["errors"]) == 0 else f"FAILED ({len(table_stats['errors'])} of {table_stats['shards']} shards)"
+        print(f"  {table_name}: {status}, {table_stats['rows']} rows, {table_stats['skipped']} unchanged participants, {table_stats['seconds']:.1f}s, {table_stats['rows'] / max(table_stats['seconds'], 1e-9):.0f} rows/s")
+
+def parse_args(argv=None):
     parser = argparse.ArgumentParser()
     parser.add_argument('-d', dest='database', help='Name of the MySQL database you want to upload to.')
     parser.add_argument('-t', dest='table_name', help='Name the tables that will be created in MySQL, e.g. table_name$feature$level')
@@ -30,10 +452,29 @@ def main():
     parser.add_argument('-g', dest='level', help='Level of analysis done with RAPIDS. E.g. "daily" if time segments set at daily level. Argument only influences naming of table, e.g. table_name$feature$level.')
     parser.add_argument('-f', dest='features', nargs='+', default='search', help='List of behavioral features expected you want uploaded from your RAPIDS output. Leave blank for all features found in the output files.')
     parser.add_argument('-c', dest='collation', help='Desired collation for varchar and text columns.', default='utf8mb4_general_ci')
+    parser.add_argument('--load-method', dest='load_method', choices=['executemany', 'load_data', 'to_sql'], default='executemany', help='How rows are inserted: batched multi-row INSERTs (default), LOAD DATA LOCAL INFILE (MySQL only, falls back to executemany on other databases) or pandas to_sql.')
+    parser.add_argument('--batch-size', dest='batch_size', type=int, default=1000, help='Number of rows per INSERT with --load-method executemany (defaults to 1000).')
+    parser.add_argument('--workers', dest='workers', type=int, default=1, help='Number of sensor tables (or participant shards) uploaded in parallel, each on its own pooled connection (defaults to 1).')
+    parser.add_argument('--shards', dest='shards', type=int, default=1, help='Split the participants of each sensor into this many shards that are uploaded and committed separately (defaults to 1, one transaction per table).')
+    parser.add_argument('--incremental', dest='incremental', action='store_true', help=f'Keep existing tables and only load participants whose CSV changed since the last incremental upload (tracked in the {MANIFEST_TABLE} table).')
+    parser.add_argument('--stream', dest='stream', action='store_true', help='Upload each participant CSV in chunks: a reader thread parses the next chunks while the previous ones are inserted, so memory stays bounded for large feature files.')
+    parser.add_argument('--chunk-rows', dest='chunk_rows', type=int, default=csv_reader.DEFAULT_CHUNK_ROWS, help=f'Rows per chunk with --stream (defaults to {csv_reader.DEFAULT_CHUNK_ROWS}).')
+    parser.add_argument('--queue-depth', dest='queue_depth', type=int, default=2, help='Chunks waiting between the stages of --stream, which bounds its memory (defaults to 2).')
+    parser.add_argument('--sink', dest='sink', choices=['mysql', 'parquet'], default='mysql', help='Upload to the MySQL database (default) or write a Parquet dataset partitioned by sensor and pid instead.')
+    parser.add_argument('--parquet-dir', dest='parquet_dir', default='../../../data/processed/parquet/', help='Folder the Parquet dataset is written to with --sink parquet (defaults to ../../../data/processed/parquet/).')
+    parser.add_argument('--compression', dest='compression', default='zstd', help='Parquet compression codec (defaults to zstd).')
+    parser.add_argument('--mysqlconfig', dest='mysqlconfig', default=db_access.DEFAULT_MYSQLCONFIG, help='MySQL option file with the connection credentials (defaults to ~/.my.cnf).')
+    parser.add_argument('--db-url', dest='db_url', help='SQLAlchemy URL used instead of the MySQL connection, e.g. sqlite:///test.db for testing.')
+    parser.add_argument('--profile', dest='profile', help='Write the time, rows and peak memory of every stage of the upload to this JSON file.')
+    parser.add_argument('--profile-cprofile', dest='profile_cprofile', help='Write cProfile stats of the slowest stage to this file (read with pstats or snakeviz).')
 
-    args = parser.parse_args()
+    return parser.parse_args(argv)
 
-    if args.table_name == None or args.database == None or args.level == None:
+# Upload (or with --sink parquet write) the RAPIDS feature CSVs described by args.  A caller that already has an engine
+# and a profiler (e.g. run_rapids_pipeline.py) passes them in, they are then left open for it.  Returns the stats of
+# every table.
+def upload_features(args, engine=None, profiler=None):
+    if args.table_name == None or (args.database == None and args.sink == 'mysql') or args.level == None:
         print("Please ensure table_name (-t), database (-d), and level (-g) are specified. Your arguments were:")
         print('database:', args.database)
         print('table_name:', args.table_name)
@@ -43,26 +484,26 @@ def main():
         print('collation:', args.collation)
         exit(2)
 
-    host = '127.0.0.1'  # Specify the desired host
-    config_file = '~/.my.cnf'
-    database = args.database
-
-    # Construct the connection URL
-    connection_url = f'mysql+pymysql://@{host}/{database}'
+    own_profiler = profiler is None
+    if own_profiler:
+        profiler = stage_profiler.StageProfiler("rapids_csv_to_mysql", args.profile, args.profile_cprofile)
 
     # Create the SQLAlchemy engine
-    engine = create_engine(connection_url, connect_args={'read_default_file': config_file})
-
-    # Establish a connection
-    connection = engine.connect()
-
-    query = text('SELECT * FROM aware_device')
-
-    # Execute a query
-    result = connection.execute(query)
-
-    # Fetch the data
-    data = result.fetchall()
+    # The pool holds one connection per worker
+    own_engine = engine is None and args.sink == 'mysql'
+    if own_engine:
+        connect_args = {'local_infile': True} if args.load_method == 'load_data' and not args.db_url else {}
+        engine = db_access.create_db_engine(args.database, mysqlconfig=args.mysqlconfig, db_url=args.db_url, driver='pymysql', pool_size=args.workers, max_overflow=0, connect_args=connect_args)
+    if args.sink == 'mysql':
+        # Tables are created in the given MySQL database, other databases (e.g. SQLite) use their default schema and no collation
+        is_mysql = engine.dialect.name == 'mysql'
+        target = {"schema": args.database if is_mysql else None,
+                  "collate": f' COLLATE {args.collation}' if is_mysql else '',
+                  "preparer": engine.dialect.identifier_preparer}
+        if args.load_method == 'load_data' and not is_mysql:
+            print("LOAD DATA is only available on MySQL, using executemany instead.")
+    else:
+        target = {}
 
     # Get participant list
     # Get path for searching for participant names
@@ -121,59 +562,79 @@ def main():
     
     computed_sensors = [file_to_sensor(i) for i in upload_list]
     
+    target["directory_path"] = directory_path
+    target["schemas"] = {}
+    target["file_hashes"] = {}
+    # Feature CSVs are read with categorical segment columns and the same dtypes for every participant of a sensor
+    target["csv_schemas"] = csv_reader.CsvSchemaCache()
+    target["profiler"] = profiler
+
+    def run_stage(name, function, *function_args):
+        # Run an upload_sensor or write_sensor_parquet call as a profiled stage
+        with profiler.stage(name) as stage:
+            stats = function(*function_args)
+            stage["rows"] = stats["rows"]
+        return stats
+
+    if args.sink == 'parquet':
+        for sensor in computed_sensors:
+            with profiler.stage("scan_sensor_schema"):
+                target["schemas"][sensor] = scan_sensor_schema(directory_path, participants, sensor, target["csv_schemas"])
+        with ThreadPoolExecutor(max_workers=max(1, args.workers)) as executor:
+            all_stats = list(executor.map(lambda sensor: run_stage("write_sensor_parquet", write_sensor_parquet, args, target, sensor, participants), computed_sensors))
+        print_upload_summary(all_stats)
+        if own_profiler:
+            profiler.finish()
+        return all_stats
+
+    # With one shard a sensor table is dropped, created and filled in one transaction.  With more shards the tables are
+    # created first and each shard of participants is committed on its own.
+    # With --incremental existing tables are kept and only created when missing.
+    shard_count = max(1, min(args.shards, len(participants)))
+    if args.incremental:
+        with engine.begin() as connection:
+            create_manifest_table(connection, target)
+    existing_tables = set(inspect(engine).get_table_names(schema=target["schema"])) if args.incremental else set()
+    tasks = []
     for sensor in computed_sensors:
         print("Uploading:", sensor)
-        new_table_name = f'{args.table_name}${sensor}${args.level}'
-        drop_query = f'DROP TABLE IF EXISTS {args.database}.{new_table_name};'
-        drop_query = text(drop_query)
-        connection.execute(drop_query)
-        query_start = f'''
-        CREATE TABLE {args.database}.{new_table_name} (
-        local_segment VARCHAR(255) COLLATE {args.collation},
-        local_segment_label VARCHAR(255) COLLATE {args.collation},
-        local_segment_start_datetime DATETIME,
-        local_segment_end_datetime DATETIME,
-        '''
-        query_end = f'''
-        pid TEXT COLLATE {args.collation}
-        );
-        '''
-        csv_file_path = os.path.join(directory_path, participants[0], f'phone_{sensor}.csv')
-        # Read the CSV file into a DataFrame
-        df = pd.read_csv(csv_file_path)
-
-        # Print the DataFrame
-        old_columns = df.columns
-        new_columns = []
-        for column in old_columns:
-            if column[:5] != "phone":
-                continue
-            parts = column.split('_')
-            provider_name = parts[2]
-            column_name = '_'.join(parts[3:])
-            new_column = provider_name[0] + '_' + column_name.replace('.', '_')
-            new_columns.append(new_column)
-
-        data_type = "DOUBLE"
-        query_middle = ""
-        for column_name in new_columns:
-            query_middle += f"{column_name} {data_type},\n"
-        create_query = query_start + query_middle + query_end      
-        create_query = text(create_query)
-        result = connection.execute(create_query)
-
-        # Insert data for each participant
-        for participant in participants:
-            df = pd.read_csv(os.path.join(directory_path, participant, f'phone_{sensor}.csv'))
-            df.columns = list(df.columns[0:4]) + new_columns
-            df['pid'] = participant
-            df.to_sql(new_table_name, con=connection, if_exists='append', index=False)
-    
-    # Commit the changes
-    connection.commit()
+        new_table_name, qualified_table_name = sensor_table_name(args, target, sensor)
+        create_table = new_table_name not in existing_tables
+        if create_table:
+            # Column types are inferred from every participant's CSV
+            with profiler.stage("scan_sensor_schema"):
+                target["schemas"][sensor] = scan_sensor_schema(directory_path, participants, sensor, target["csv_schemas"], args.chunk_rows if args.stream else None)
+        if create_table and args.incremental:
+            # Forget manifest entries of a table that no longer exists
+            with engine.begin() as connection:
+                connection.execute(text(f'DELETE FROM {manifest_table_name(target)} WHERE table_name = :table_name'), {"table_name": new_table_name})
+        if not create_table:
+            # The kept table may be too narrow for the values of new and changed participants
+            with profiler.stage("widen_sensor_table"):
+                widen_sensor_table(engine, args, target, sensor, participants)
+        if shard_count == 1:
+            tasks.append((sensor, participants, create_table))
+        else:
+            if create_table:
+                with engine.begin() as connection:
+                    create_sensor_table(connection, args, target, sensor)
+            for shard in range(shard_count):
+                tasks.append((sensor, participants[shard::shard_count], False))
+
+    with ThreadPoolExecutor(max_workers=max(1, args.workers)) as executor:
+        all_stats = list(executor.map(lambda task: run_stage("upload_sensor", upload_sensor, engine, args, target, *task), tasks))
+    print_upload_summary(all_stats)
+    if own_engine:
+        db_access.print_query_stats(engine)
+        engine.dispose()
+    if own_profiler:
+        profiler.finish()
+    return all_stats
 
-    # Close the connection
-    connection.close()
+def main():
+    all_stats = upload_features(parse_args())
+    if any(stats["error"] is not None for stats in all_stats):
+        exit(1)
     
 
 if __name__ == '__main__':
@@ -0,0 +1,391 @@
+##############################################################################
+#
+#  run_rapids_pipeline.py
+#
+#  Runs the study refresh steps in one process: the RAPIDS participant file
+#  (create_rapids_participant_file.py), the TZCODES file
+#  (create_multiple_timezones.py) and, optionally, the upload of RAPIDS
+#  feature output (rapids_csv_to_mysql.py).  All steps share one database
+#  engine and the participants are handed from one step to the next in
+#  memory; files are only written as final outputs.
+#
+#  With --manifest the participant and time zone steps are run for every study
+#  listed in a CSV file, --jobs studies at a time over a shared connection
+#  pool.  A study that fails is reported in the batch summary and the others
+#  carry on.
+#
+################################################################################
+
+# Only light modules are imported here so that --help is fast, pandas, SQLAlchemy and the steps are imported when a
+# pipeline actually runs.
+import sys
+import os
+import getopt
+import shlex
+import csv
+import time
+
+STEPS = ["participants", "timezones", "upload"]
+# Columns of a --manifest file: database is required, the others override the command line option of the same name for
+# that study.  Empty values fall back to the command line option.
+MANIFEST_COLUMNS = ["database", "db_url", "device_source_table", "survey_source_table", "survey_col_name", "survey_time_col", "participant_file",
+                    "tzcodes_file", "participant_output", "tz_default"]
+# Options holding file paths, "{database}" in them is replaced by the study's database name
+PATH_OPTIONS = ["participant_file", "destination_file", "participant_output"]
+
+
+def usage():
+    print("python run_rapids_pipeline.py --database <database name> --survey_source_table <tablename> --survey_col_name <name of col in survey source table that matches 'label'>")
+    print("                              [--steps <participants,timezones,upload>] [--mysqlconfig <.my.cnf location>] [--db_url <SQLAlchemy URL>]")
+    print("                              [--device_source_table <tablename>] [--participant_file <participant CSV>] [--tzcodes_file <TZCODES CSV>]")
+    print("                              [--participant_output <modified participant CSV>] [--tz_default <remove|ignore|tzcode>] [--tz_mapping <CSV>]")
+    print("                              [--tz_output <rows|transitions>] [--survey_time_col <name of col with the time of each survey response>]")
+    print("                              [--device_pushdown] [--chunksize <rows per fetch>]")
+    print("                              [--upload_args \"<rapids_csv_to_mysql.py options>\"] [--profile <JSON report file>] [--profile_cprofile <pstats file>]")
+    print("                              [--cache_dir <table cache folder>] [--cache_max_mb <MB>] [--refresh]")
+    print("                              [--manifest <study CSV> [--jobs <concurrent studies>] [--summary <batch summary CSV>]] [--memory-budget <MB>] [--plan]")
+
+
+def as_read_from_csv(participants):
+    # The participant rows with the types create_multiple_timezones.py gets when it reads them from the participant
+    # file with pd.read_csv: missing value strings become NaN and columns of numbers (e.g. numeric labels) become numeric
+    import pandas as pd
+    import csv_reader
+    participants = participants.copy()
+    for column in participants.columns:
+        values = participants[column].where(~participants[column].isin(csv_reader.NA_VALUES))
+        try:
+            values = pd.to_numeric(values)
+        except (ValueError, TypeError):
+            pass
+        participants[column] = values
+    return participants
+
+
+def read_manifest(manifest_file, options):
+    # The options of each study listed in manifest_file: the command line options with the study's overrides.  Exits when
+    # the manifest is malformed or two studies would write to the same file.
+    with open(manifest_file, newline='') as manifest_in:
+        reader = csv.DictReader(manifest_in)
+        unknown_columns = [column for column in (reader.fieldnames or []) if column not in MANIFEST_COLUMNS]
+        if ("database" not in (reader.fieldnames or []) or len(unknown_columns) > 0):
+            print("The manifest needs a database column and may have the columns " + ", ".join(MANIFEST_COLUMNS) + "; unknown columns: " + ", ".join(unknown_columns))
+            exit(2)
+        rows = [row for row in reader if any(value.strip() for value in row.values() if value is not None)]
+
+    studies = []
+    for row in rows:
+        study = dict(options)
+        for column, value in row.items():
+            if (value is not None and value.strip() != ""):
+                study["destination_file" if column == "tzcodes_file" else column] = value.strip()
+        if (not study.get("database")):
+            print("Every manifest row needs a database.")
+            exit(2)
+        if ("timezones" in options["steps"] and (not study.get("survey_source_table") or not study.get("survey_col_name"))):
+            print("No survey_source_table or survey_col_name for study " + study["database"] + ".")
+            exit(2)
+        for option in PATH_OPTIONS:
+            study[option] = study[option].replace("{database}", study["database"])
+        studies.append(study)
+
+    written_files = [study[option] for study in studies for option in PATH_OPTIONS]
+    duplicates = sorted(set(path for path in written_files if written_files.count(path) > 1))
+    if (len(duplicates) > 0):
+        print("Several studies would write to " + ", ".join(duplicates) + ". Put {database} in the file options or give each study its own files in the manifest.")
+        exit(2)
+    return studies
+
+
+def run_study(engine, options, profiler, tables, now, schema=None, prefix=""):
+    # Run the participant and time zone steps for one study, reading its tables from schema (the engine's database when
+    # None).  Device tables too large for --memory-budget are streamed, with --plan only the plan is printed.  Messages
+    # start with prefix.  Returns the study's summary row.
+    import pandas as pd
+    import create_rapids_participant_file
+    import create_multiple_timezones
+    import execution_plan
+
+    def say(message):
+        # One write per message so that the lines of studies running at the same time don't run into each other
+        print(prefix + message + "\n", end="", flush=True)
+
+    start = time.perf_counter()
+    summary = {"database" : options.get("database"), "status" : "ok", "participants" : None, "tzcodes_rows" : None, "seconds" : None, "error" : None}
+    memory_budget = options["memory_budget"] * 1024 * 1024
+    plan_steps = []
+    # Stays None when the participants step doesn't run
+    participants_strategy = None
+    with profiler.stage("plan"):
+        if ("participants" in options["steps"]):
+            participants_estimate, participants_strategy = create_rapids_participant_file.plan_device_read(engine, options["device_source_table"], memory_budget, schema)
+            plan_steps.append(("participants", [participants_estimate], participants_strategy, None))
+        if ("timezones" in options["steps"]):
+            timezones_estimate, timezones_strategy = create_multiple_timezones.plan_device_read(engine, options["device_source_table"], memory_budget, schema)
+            plan_steps.append(("timezones", [timezones_estimate], timezones_strategy, "only the participants' devices" if options["device_pushdown"] else None))
+    if (options["plan"]):
+        execution_plan.print_plan("run_rapids_pipeline.py" + ("" if prefix == "" else " " + prefix.strip()), plan_steps, memory_budget)
+        summary["status"] = "planned"
+        return summary
+
+    participants = None
+    if ("participants" in options["steps"]):
+        if (participants_strategy == "streaming"):
+            say("The " + options["device_source_table"] + " table doesn't fit in the memory budget (" + execution_plan.describe(participants_estimate) + "), streaming it.")
+        with profiler.stage("read_device_table") as stage:
+            if (participants_strategy == "streaming"):
+                df, rows = create_rapids_participant_file.stream_device_participants(engine, options["device_source_table"], options["chunksize"], schema)
+            else:
+                df = create_rapids_participant_file.read_device_rows(engine, options["device_source_table"], options["chunksize"], tables, schema)
+                rows = len(df)
+            stage["rows"] = rows
+        say("Retrieved " + str(rows) + " " + options["device_source_table"] + " table rows.")
+        if (rows > 0):
+            with profiler.stage("build_participants", rows=len(df)):
+                participants = create_rapids_participant_file.build_participants(df, now)
+            with profiler.stage("write_participant_file", rows=len(participants)):
+                create_rapids_participant_file.write_participant_file(participants, options["participant_file"])
+            say("Wrote " + str(len(participants)) + " participant entries to " + options["participant_file"] + ".")
+            summary["participants"] = len(participants)
+        del df
+
+    if ("timezones" in options["steps"]):
+        if (participants is None):
+            with profiler.stage("read_participant_file") as stage:
+                participant_df = pd.read_csv(options["participant_file"])
+                stage["rows"] = len(participant_df)
+        else:
+            participant_df = as_read_from_csv(participants)
+        if (timezones_strategy == "streaming" and participants_strategy != "streaming"):
+            say("The " + options["device_source_table"] + " table doesn't fit in the memory budget (" + execution_plan.describe(timezones_estimate) + "), streaming it.")
+        final_df, modified_participant_df, message = create_multiple_timezones.create_timezones(engine, participant_df, dict(options, strategy=timezones_strategy), profiler, tables, schema)
+        if (modified_participant_df is not None):
+            with profiler.stage("write_participant_file", rows=len(modified_participant_df)):
+                modified_participant_df.to_csv(options["participant_output"], index=False)
+        with profiler.stage("write_tzcodes_file", rows=len(final_df)):
+            final_df.to_csv(options["destination_file"], index=False)
+        say(message)
+        say("Created " + options["destination_file"] + ". Please change file path field in [TIMEZONE][TZCODES_FILE] config.yaml as needed.")
+        summary["tzcodes_rows"] = len(final_df)
+
+    summary["seconds"] = round(time.perf_counter() - start, 3)
+    return summary
+
+
+def run_batch(studies, options, profiler, tables, now):
+    # Run the studies, options["jobs"] at a time.  Studies without their own db_url share one engine (without a default
+    # database) whose pool has a connection per job and read their tables from their database.  A failing study is
+    # recorded in its summary row and doesn't stop the others.  Returns the summary rows in manifest order.
+    import concurrent.futures
+    import db_access
+
+    shared_engine = None
+    if (any(not study.get("db_url") or study["db_url"] == options["db_url"] for study in studies)):
+        shared_engine = db_access.create_db_engine(None, options["mysqlconfig"], options["db_url"], pool_size=options["jobs"])
+
+    def run_one(study):
+        prefix = "[" + study["database"] + "] "
+        start = time.perf_counter()
+        engine = None
+        try:
+            if (study.get("db_url") and study["db_url"] != options["db_url"]):
+                engine = db_access.create_db_engine(study["database"], options["mysqlconfig"], study["db_url"], pool_size=1)
+                summary = run_study(engine, study, profiler, tables, now, None, prefix)
+            else:
+                summary = run_study(shared_engine, study, profiler, tables, now, study["database"], prefix)
+        except Exception as err:
+            print(prefix + "Failed: " + type(err).__name__ + ": " + str(err) + "\n", end="", flush=True)
+            summary = {"database" : study["database"], "status" : "failed", "participants" : None, "tzcodes_rows" : None,
+                       "seconds" : round(time.perf_counter() - start, 3), "error" : type(err).__name__ + ": " + str(err)}
+        finally:
+            if (engine is not None):
+                db_access.print_query_stats(engine)
+                engine.dispose()
+        return summary
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=options["jobs"]) as executor:
+        summaries = list(executor.map(run_one, studies))
+    if (shared_engine is not None):
+        db_access.print_query_stats(shared_engine)
+        shared_engine.dispose()
+    return summaries
+
+
+def write_batch_summary(summaries, summary_file):
+    import pandas as pd
+    summary_df = pd.DataFrame(summaries, columns=["database", "status", "participants", "tzcodes_rows", "seconds", "error"])
+    summary_df = summary_df.astype({"participants" : "Int64", "tzcodes_rows" : "Int64"})
+    print("Batch summary:")
+    print(summary_df.drop(columns="error").to_string(index=False))
+    summary_df.to_csv(summary_file, index=False)
+    failed = summary_df[summary_df["status"] != "ok"]
+    print(str(len(summary_df) - len(failed)) + " of " + str(len(summary_df)) + " studies succeeded. Wrote the batch summary to " + summary_file + ".")
+
+
+def main():
+
+    try:
+        optlist, args = getopt.getopt(sys.argv[1:], "h", ["help", "steps=", "mysqlconfig=", "database=", "db_url=", "device_source_table=", "survey_source_table=", "survey_col_name=",
+                                                          "participant_file=", "tzcodes_file=", "participant_output=", "tz_default=", "tz_mapping=", "tz_output=", "survey_time_col=",
+                                                          "device_pushdown", "chunksize=", "upload_args=", "profile=", "profile_cprofile=",
+                                                          "cache_dir=", "cache_max_mb=", "refresh", "manifest=", "jobs=", "summary=",
+                                                          "memory-budget=", "plan"])
+    except getopt.GetoptError as err:
+        print(err)
+        usage()
+        sys.exit(2)
+
+    options = {}
+    options["steps"] = ["participants", "timezones"]
+    options["mysqlconfig"] = str(os.path.expanduser("~")) + '/.my.cnf'
+    options["db_url"] = None
+    options["device_source_table"] = "aware_device"
+    options["participant_file"] = "../../data/external/participant_file.csv"
+    options["destination_file"] = "../../data/external/multiple_timezones.csv"
+    options["participant_output"] = "../../data/external/participant_file_modified.csv"
+    options["tz_default"] = "remove"
+    options["tz_mapping"] = None
+    options["tz_output"] = "rows"
+    options["survey_time_col"] = None
+    options["device_pushdown"] = False
+    options["chunksize"] = 50000
+    options["upload_args"] = []
+    options["profile"] = None
+    options["profile_cprofile"] = None
+    options["cache_dir"] = None
+    options["cache_max_mb"] = None
+    options["refresh"] = False
+    options["manifest"] = None
+    options["jobs"] = 4
+    options["summary"] = None
+    options["memory_budget"] = None
+    options["plan"] = False
+
+    for option_tuple in optlist:
+        if (option_tuple[0] in ["-h", "--help"]):
+            usage()
+            sys.exit(0)
+        elif (option_tuple[0] == "--steps"):
+            options["steps"] = option_tuple[1].split(",")
+        elif (option_tuple[0] == "--mysqlconfig"):
+            options["mysqlconfig"] = option_tuple[1]
+        elif (option_tuple[0] == "--database"):
+            options["database"] = option_tuple[1]
+        elif (option_tuple[0] == "--db_url"):
+            options["db_url"] = option_tuple[1]
+        elif (option_tuple[0] == "--device_source_table"):
+            options["device_source_table"] = option_tuple[1]
+        elif (option_tuple[0] == "--survey_source_table"):
+            options["survey_source_table"] = option_tuple[1]
+        elif (option_tuple[0] == "--survey_col_name"):
+            options["survey_col_name"] = option_tuple[1]
+        elif (option_tuple[0] == "--participant_file"):
+            options["participant_file"] = option_tuple[1]
+        elif (option_tuple[0] == "--tzcodes_file"):
+            options["destination_file"] = option_tuple[1]
+        elif (option_tuple[0] == "--participant_output"):
+            options["participant_output"] = option_tuple[1]
+        elif (option_tuple[0] == "--tz_default"):
+            options["tz_default"] = option_tuple[1]
+        elif (option_tuple[0] == "--tz_mapping"):
+            options["tz_mapping"] = option_tuple[1]
+        elif (option_tuple[0] == "--tz_output"):
+            options["tz_output"] = option_tuple[1]
+        elif (option_tuple[0] == "--survey_time_col"):
+            options["survey_time_col"] = option_tuple[1]
+        elif (option_tuple[0] == "--device_pushdown"):
+            options["device_pushdown"] = True
+        elif (option_tuple[0] == "--chunksize"):
+            options["chunksize"] = int(option_tuple[1])
+        elif (option_tuple[0] == "--upload_args"):
+            options["upload_args"] = shlex.split(option_tuple[1])
+        elif (option_tuple[0] == "--profile"):
+            options["profile"] = option_tuple[1]
+        elif (option_tuple[0] == "--profile_cprofile"):
+            options["profile_cprofile"] = option_tuple[1]
+        elif (option_tuple[0] == "--cache_dir"):
+            options["cache_dir"] = option_tuple[1]
+        elif (option_tuple[0] == "--cache_max_mb"):
+            options["cache_max_mb"] = int(option_tuple[1])
+        elif (option_tuple[0] == "--refresh"):
+            options["refresh"] = True
+        elif (option_tuple[0] == "--manifest"):
+            options["manifest"] = option_tuple[1]
+        elif (option_tuple[0] == "--jobs"):
+            options["jobs"] = max(1, int(option_tuple[1]))
+        elif (option_tuple[0] == "--summary"):
+            options["summary"] = option_tuple[1]
+        elif (option_tuple[0] == "--memory-budget"):
+            options["memory_budget"] = int(option_tuple[1])
+        elif (option_tuple[0] == "--plan"):
+            options["plan"] = True
+
+    if (options["manifest"] is not None):
+        # The survey options and the database come from the manifest when they are not given here
+        if (any(step not in STEPS for step in options["steps"]) or "upload" in options["steps"]):
+            print("--manifest runs the participants and timezones steps only, upload each study's features with rapids_csv_to_mysql.py.")
+            usage()
+            exit(2)
+    elif (any(step not in STEPS for step in options["steps"]) or not "database" in options
+            or ("timezones" in options["steps"] and (not "survey_source_table" in options or not "survey_col_name" in options))):
+        usage()
+        exit(2)
+
+    import datetime as dt
+    import db_access
+    import stage_profiler
+    import create_rapids_participant_file
+    import create_multiple_timezones
+    import rapids_csv_to_mysql
+    import table_cache
+    import execution_plan
+
+    now = dt.datetime.now()
+    print("Starting run_rapids_pipeline.py (" + ", ".join(options["steps"]) + "): " + str(now))
+    options["memory_budget"] = execution_plan.DEFAULT_MEMORY_BUDGET_MB if options["memory_budget"] is None else options["memory_budget"]
+    options["tz_mapping"] = create_multiple_timezones.TZ_CODES if options["tz_mapping"] is None else create_multiple_timezones.read_tz_mapping(options["tz_mapping"])
+    profiler = stage_profiler.StageProfiler("run_rapids_pipeline", options["profile"], options["profile_cprofile"])
+    tables = table_cache.TableCache(options["cache_dir"], table_cache.DEFAULT_CACHE_MAX_MB if options["cache_max_mb"] is None else options["cache_max_mb"], options["refresh"])
+
+    if (options["manifest"] is not None):
+        studies = read_manifest(options["manifest"], options)
+        print("Running " + str(len(studies)) + " studies from " + options["manifest"] + ", " + str(options["jobs"]) + " at a time.")
+        summaries = run_batch(studies, options, profiler, tables, now)
+        if (options["plan"]):
+            profiler.finish()
+            return
+        summary_file = options["summary"] if options["summary"] is not None else os.path.splitext(options["manifest"])[0] + "_summary.csv"
+        write_batch_summary(summaries, summary_file)
+        profiler.finish()
+        if (any(summary["status"] != "ok" for summary in summaries)):
+            exit(1)
+        return
+
+    # The upload options are parsed up front so a mistake in them stops the pipeline before any work is done.  The
+    # engine's pool has a connection for each upload worker.
+    upload_args = None
+    if ("upload" in options["steps"]):
+        upload_args = options["upload_args"] if "-d" in options["upload_args"] else ["-d", options["database"]] + options["upload_args"]
+        upload_args = rapids_csv_to_mysql.parse_args(upload_args)
+    connect_args = {'local_infile': True} if upload_args is not None and upload_args.load_method == 'load_data' and options["db_url"] is None else {}
+    engine = db_access.create_db_engine(options["database"], options["mysqlconfig"], options["db_url"], pool_size=max(1, 1 if upload_args is None else upload_args.workers),
+                                        connect_args=connect_args)
+
+    run_study(engine, options, profiler, tables, now)
+
+    failed = False
+    if ("upload" in options["steps"] and options["plan"]):
+        print("The upload step is not planned, it reads one participant's CSV file at a time.")
+    elif ("upload" in options["steps"]):
+        all_stats = rapids_csv_to_mysql.upload_features(upload_args, engine, profiler)
+        failed = any(stats["error"] is not None for stats in all_stats)
+
+    db_access.print_query_stats(engine)
+    engine.dispose()
+    profiler.finish()
+    if (failed):
+        exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,185 @@
+##############################################################################
+#
+#  stage_profiler.py
+#
+#  Stage level profiling for the helper scripts' --profile option.  The
+#  scripts wrap their main steps in named stages; for every stage the wall
+#  time, number of rows processed, peak traced (tracemalloc) memory and peak
+#  RSS are recorded and written to a JSON report at the end of the run.
+#  Optionally the hottest top level stage is also profiled with cProfile.
+#
+################################################################################
+
+import os
+import sys
+import json
+import time
+import threading
+import tracemalloc
+import cProfile
+import pstats
+import contextlib
+import datetime as dt
+
+# Version of the JSON report layout, increased whenever a field changes meaning or is removed
+REPORT_FORMAT_VERSION = 1
+# Seconds between two RSS samples while stages are running
+RSS_SAMPLE_INTERVAL = 0.01
+
+
+def current_rss_mb():
+    # Resident set size of this process, None where /proc is not available
+    try:
+        with open("/proc/self/statm") as statm:
+            return int(statm.read().split()[1]) * os.sysconf("SC_PAGE_SIZE") / (1024 * 1024)
+    except (OSError, ValueError, IndexError):
+        return None
+
+
+def max_rss_mb():
+    # Peak resident set size of this process so far
+    try:
+        import resource
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / (1024 if sys.platform != "darwin" else 1024 * 1024)
+    except ImportError:
+        return None
+
+
+class StageProfiler:
+    # Records named stages of a script run.  A disabled profiler (no --profile) hands out stages that record nothing.
+    # Stages can be nested and can run concurrently in threads: every open stage's memory peak is updated before the
+    # tracemalloc peak is reset for a new stage, and by a thread sampling the RSS.
+
+    def __init__(self, script, report_file=None, cprofile_file=None):
+        self.script = script
+        self.report_file = report_file
+        self.cprofile_file = cprofile_file
+        self.enabled = report_file is not None or cprofile_file is not None
+        self.lock = threading.Lock()
+        self.local = threading.local()
+        self.open_stages = []
+        self.stages = {}
+        self.profiles = {}
+        self.started = dt.datetime.now()
+        self.start = time.perf_counter()
+        self.sampler = None
+        if (self.enabled):
+            tracemalloc.start()
+            if (current_rss_mb() is not None):
+                self.sampler = threading.Thread(target=self.sample_rss, daemon=True)
+                self.sampler.start()
+
+    def sample_rss(self):
+        while (self.enabled):
+            rss = current_rss_mb()
+            with self.lock:
+                for frame in self.open_stages:
+                    frame["rss_peak"] = max(frame["rss_peak"], rss)
+            time.sleep(RSS_SAMPLE_INTERVAL)
+
+    def fold_memory_peak(self):
+        # Called with the lock held: every open stage keeps the highest traced memory seen while it was open
+        peak = tracemalloc.get_traced_memory()[1]
+        for frame in self.open_stages:
+            frame["traced_peak"] = max(frame["traced_peak"], peak)
+
+    # Use as "with profiler.stage(name) as stage:", setting stage["rows"] to the number of rows the stage processed.
+    # Setting stage["discard"] leaves the call out of the report.
+    @contextlib.contextmanager
+    def stage(self, name, rows=None):
+        frame = {"name" : name, "rows" : rows}
+        if (not self.enabled):
+            yield frame
+            return
+        stack = self.local.__dict__.setdefault("stack", [])
+        profile = None
+        if (self.cprofile_file is not None and len(stack) == 0):
+            # Only top level stages are profiled, cProfile can't nest
+            profile = cProfile.Profile()
+        with self.lock:
+            self.fold_memory_peak()
+            tracemalloc.reset_peak()
+            frame["traced_start"] = frame["traced_peak"] = tracemalloc.get_traced_memory()[0]
+            frame["rss_peak"] = current_rss_mb() or 0.0
+            self.open_stages.append(frame)
+        stack.append(name)
+        start = time.perf_counter()
+        if (profile is not None):
+            try:
+                profile.enable()
+            except ValueError:
+                # Another thread is already profiling one of its stages
+                profile = None
+        try:
+            yield frame
+        finally:
+            if (profile is not None):
+                profile.disable()
+            seconds = time.perf_counter() - start
+            stack.pop()
+            with self.lock:
+                self.fold_memory_peak()
+                self.open_stages.remove(frame)
+                if (frame.get("discard")):
+                    return
+                stats = self.stages.setdefault(name, {"name" : name, "calls" : 0, "seconds" : 0.0, "rows" : None, "peak_traced_mb" : 0.0, "peak_rss_mb" : None})
+                stats["calls"] += 1
+                stats["seconds"] += seconds
+                if (frame["rows"] is not None):
+                    stats["rows"] = (stats["rows"] or 0) + int(frame["rows"])
+                stats["peak_traced_mb"] = max(stats["peak_traced_mb"], (frame["traced_peak"] - frame["traced_start"]) / (1024 * 1024))
+                if (self.sampler is not None):
+                    stats["peak_rss_mb"] = max(stats["peak_rss_mb"] or 0.0, frame["rss_peak"])
+                if (profile is not None):
+                    self.profiles.setdefault(name, []).append(profile)
+
+    # Iterate over iterable, timing the production of every item as one call of the stage name with one row
+    def iterate(self, name, iterable):
+        iterator = iter(iterable)
+        while (True):
+            with self.stage(name, rows=1) as frame:
+                try:
+                    item = next(iterator)
+                except StopIteration:
+                    frame["discard"] = True
+                    return
+            yield item
+
+    def report(self):
+        return {"format_version" : REPORT_FORMAT_VERSION,
+                "script" : self.script,
+                "argv" : sys.argv[1:],
+                "started" : self.started.isoformat(timespec="seconds"),
+                "total_seconds" : time.perf_counter() - self.start,
+                "peak_traced_mb" : tracemalloc.get_traced_memory()[1] / (1024 * 1024) if tracemalloc.is_tracing() else None,
+                "peak_rss_mb" : max_rss_mb(),
+                "stages" : list(self.stages.values()),
+                "cprofile" : None}
+
+    # Stop profiling, write the JSON report (and the cProfile stats of the hottest profiled stage) and print a summary
+    def finish(self):
+        if (not self.enabled):
+            return None
+        with self.lock:
+            self.fold_memory_peak()
+        report = self.report()
+        self.enabled = False
+        tracemalloc.stop()
+        if (self.cprofile_file is not None and len(self.profiles) > 0):
+            hottest = max(self.profiles.keys(), key=lambda name: self.stages[name]["seconds"])
+            # The profiles of every call of the stage are added up
+            pstats.Stats(*self.profiles[hottest]).dump_stats(self.cprofile_file)
+            report["cprofile"] = {"stage" : hottest, "file" : self.cprofile_file}
+        if (self.report_file is not None):
+            with open(self.report_file, "w") as report_out:
+                json.dump(report, report_out, indent=1)
+        print("Profile of " + self.script + ": " + format(report["total_seconds"], ".2f") + "s"
+              + ("" if report["peak_rss_mb"] is None else ", peak RSS " + format(report["peak_rss_mb"], ".1f") + " MB"))
+        for stats in sorted(report["stages"], key=lambda stats: stats["seconds"], reverse=True):
+            print("  " + format(stats["seconds"], "8.2f") + "s " + format(stats["calls"], "6d") + "x "
+                  + ("          " if stats["rows"] is None else format(stats["rows"], "10d")) + " rows " + format(stats["peak_traced_mb"], "8.1f") + " MB  " + stats["name"])
+        if (report["cprofile"] is not None):
+            print("Wrote cProfile stats of stage " + report["cprofile"]["stage"] + " to " + self.cprofile_file)
+        if (self.report_file is not None):
+            print("Wrote profile report to " + self.report_file)
+        return report
@@ -0,0 +1,143 @@
+##############################################################################
+#
+#  table_cache.py
+#
+#  Local snapshot cache of the source tables the helper scripts pull from
+#  the database (aware_device, the time zone survey table).  Pulled tables
+#  are stored as Parquet files keyed by database, table and columns, together
+#  with a cheap fingerprint computed on the server: the row count and
+#  MAX(timestamp), or CHECKSUM TABLE on MySQL for tables without a timestamp
+#  column.  A later run with the same fingerprint reads the snapshot instead
+#  of the table.  The cache is bounded in size, the least recently used
+#  snapshots are evicted first.
+#
+################################################################################
+
+import os
+import json
+import time
+import hashlib
+import threading
+import sqlalchemy as db
+import pandas as pd
+
+DEFAULT_CACHE_MAX_MB = 1024
+# Index of the snapshots in the cache directory
+INDEX_FILE = "table_cache.json"
+
+
+def table_fingerprint(engine, table, schema=None, timestamp_column="timestamp"):
+    # Cheap server-side fingerprint of table (in schema, the engine's database when None), None when there is no cheap
+    # way to fingerprint it (a table without a timestamp column on a database other than MySQL).  Appended rows change
+    # it, rows edited in place may not.
+    columns = [column["name"] for column in db.inspect(engine).get_columns(table, schema=schema)]
+    with engine.connect() as connection:
+        if timestamp_column in columns:
+            source_table = db.table(table, db.column(timestamp_column), schema=schema)
+            rows, max_timestamp = connection.execute(db.select(db.func.count(), db.func.max(source_table.c[timestamp_column])).select_from(source_table)).one()
+            return [int(rows), str(max_timestamp)]
+        if engine.dialect.name == 'mysql':
+            preparer = engine.dialect.identifier_preparer
+            qualified_table = preparer.quote(table) if schema is None else preparer.quote_schema(schema) + "." + preparer.quote(table)
+            checksum = connection.execute(db.text("CHECKSUM TABLE " + qualified_table)).one()[1]
+            return ["checksum", str(checksum)]
+    return None
+
+
+class TableCache:
+    # Snapshots of source tables in cache_dir.  A cache without cache_dir (no --cache_dir) is disabled and reads every
+    # table from the database.  With refresh set every table is read from the database and its snapshot replaced.
+    # Safe to use from several threads; separate processes sharing cache_dir may lose each other's index updates, which
+    # only costs a re-read.
+
+    def __init__(self, cache_dir=None, max_mb=DEFAULT_CACHE_MAX_MB, refresh=False):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_mb * 1024 * 1024
+        self.refresh = refresh
+        self.enabled = cache_dir is not None
+        self.lock = threading.Lock()
+        if self.enabled:
+            try:
+                import pyarrow
+            except ImportError:
+                print("The table cache needs the pyarrow library, reading every table from the database.")
+                self.enabled = False
+        if self.enabled:
+            os.makedirs(cache_dir, exist_ok=True)
+
+    def load_index(self):
+        index_file = os.path.join(self.cache_dir, INDEX_FILE)
+        if os.path.exists(index_file):
+            with open(index_file) as index_in:
+                index = json.load(index_in)
+        else:
+            index = {"entries" : {}}
+        # Forget snapshots whose file was deleted
+        index["entries"] = {file_name : entry for file_name, entry in index["entries"].items() if os.path.exists(os.path.join(self.cache_dir, file_name))}
+        return index
+
+    def save_index(self, index):
+        index_file = os.path.join(self.cache_dir, INDEX_FILE)
+        with open(index_file + ".tmp", "w") as index_out:
+            json.dump(index, index_out, indent=1)
+        os.replace(index_file + ".tmp", index_file)
+
+    def evict(self, index):
+        # Remove the least recently used snapshots until the cache fits in max_bytes
+        entries = sorted(index["entries"].items(), key=lambda item: item[1]["last_used"])
+        total = sum(entry["bytes"] for file_name, entry in entries)
+        for file_name, entry in entries:
+            if total <= self.max_bytes:
+                break
+            os.remove(os.path.join(self.cache_dir, file_name))
+            del index["entries"][file_name]
+            total -= entry["bytes"]
+            print("Evicted the " + entry["table"] + " snapshot from the table cache.")
+
+    # Return the columns of table (all of them when columns is None) in schema (the engine's database when None) as a
+    # DataFrame.  The snapshot is used when the table's fingerprint is unchanged, a snapshot of more columns of the
+    # same table also serves.  Otherwise load() reads the table from the database and the result is stored.
+    def read(self, engine, table, columns, load, schema=None):
+        if not self.enabled:
+            return load()
+        database = engine.url.render_as_string(hide_password=True) + ("" if schema is None else " " + schema)
+        fingerprint = table_fingerprint(engine, table, schema)
+        if fingerprint is None:
+            return load()
+        with self.lock:
+            index = self.load_index()
+            if not self.refresh:
+                for file_name, entry in index["entries"].items():
+                    if (entry["database"] == database and entry["table"] == table and entry["fingerprint"] == fingerprint
+                            and (entry["columns"] is None if columns is None else set(columns) <= set(entry["stored_columns"]))):
+                        entry["last_used"] = time.time()
+                        self.save_index(index)
+                        print("Read " + table + " from the table cache (" + str(entry["rows"]) + " rows, unchanged since " + entry["created"] + ").")
+                        return pd.read_parquet(os.path.join(self.cache_dir, file_name), columns=columns)
+
+        df = load()
+        key = json.dumps([database, table, columns])
+        file_name = hashlib.sha1(key.encode()).hexdigest()[:16] + ".parquet"
+        cache_file = os.path.join(self.cache_dir, file_name)
+        try:
+            df.to_parquet(cache_file + ".tmp", index=False)
+        except (ValueError, TypeError, NotImplementedError) as err:
+            # e.g. object columns pyarrow can't convert
+            print("Could not store " + table + " in the table cache: " + str(err))
+            if os.path.exists(cache_file + ".tmp"):
+                os.remove(cache_file + ".tmp")
+            return df
+        with self.lock:
+            index = self.load_index()
+            # Snapshots of an earlier state of the table can't be used any more
+            for stale_file in [f for f, entry in index["entries"].items() if entry["database"] == database and entry["table"] == table
+                               and entry["fingerprint"] != fingerprint and f != file_name]:
+                os.remove(os.path.join(self.cache_dir, stale_file))
+                del index["entries"][stale_file]
+            os.replace(cache_file + ".tmp", cache_file)
+            index["entries"][file_name] = {"database" : database, "table" : table, "columns" : columns, "stored_columns" : list(df.columns),
+                                           "fingerprint" : fingerprint, "rows" : len(df), "bytes" : os.path.getsize(cache_file),
+                                           "created" : time.strftime("%Y-%m-%d %H:%M:%S"), "last_used" : time.time()}
+            self.evict(index)
+            self.save_index(index)
+        return df